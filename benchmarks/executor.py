@@ -0,0 +1,250 @@
+"""Measures the overhead of the executor on synthetic workflows.
+
+Workflows of no-op hooks provided by a generated plugin are built for each
+scenario and size, then ``load_config``, ``plugin_from_entrypoint``,
+``_execute_hook`` and ``execute`` are timed. Times are the median over the
+repeats, divided by the number of hooks. Allocations are measured on one
+extra run with tracemalloc.
+
+    uv run python benchmarks/executor.py --output results.json
+    uv run python benchmarks/executor.py --baseline results.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+from rich.console import Console
+from stdlibx.cancel import default_token
+from stdlibx.result.types import Ok
+
+from bex_hooks.exec._interface import Context
+from bex_hooks.exec.conditions import ConditionEvaluator
+from bex_hooks.exec.config import load_config
+from bex_hooks.exec.executor import _execute_hook, execute
+from bex_hooks.exec.plugin import PluginRegistry, plugin_from_entrypoint
+from bex_hooks.exec.ui import CliUI
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+_PLUGIN_MODULE = "bex_bench_plugin"
+_PLUGIN_SOURCE = """\
+from bex_hooks.exec._interface import Context, LayeredMapping
+
+__hooks__ = ("bench/set",)
+
+
+def get_hooks():
+    return {"bench/set": set_metadata}
+
+
+def set_metadata(token, args, ctx, *, ui):
+    return Context(
+        working_dir=ctx.working_dir,
+        metadata=LayeredMapping(ctx.metadata, {args["key"]: args["value"]}),
+        environ=ctx.environ,
+    )
+"""
+
+_SCENARIOS: dict[str, Callable[[int], str]] = {
+    "sequential": lambda index: f"  - id: bench/set\n    key: k{index}\n    value: v\n",
+    "parallel": lambda index: (
+        f"  - id: bench/set\n    name: h{index}\n    needs: []\n"
+        f"    key: k{index}\n    value: v\n"
+    ),
+    "conditions": lambda index: (
+        f"  - id: bench/set\n    if: env.HOME != '' && platform != ''\n"
+        f"    key: k{index}\n    value: v\n"
+    ),
+    "huge-environ": lambda index: (
+        f"  - id: bench/set\n    key: k{index}\n    value: v\n"
+    ),
+}
+_HUGE_ENVIRON_SIZE = 10_000
+
+
+def _measure(func: Callable[[], Any], repeat: int, count: int) -> dict[str, float]:
+    func()  # warm up
+
+    durations: list[int] = []
+    for _ in range(repeat):
+        start = time.perf_counter_ns()
+        func()
+        durations.append(time.perf_counter_ns() - start)
+
+    tracemalloc.start()
+    blocks = sys.getallocatedblocks()
+    func()
+    blocks = sys.getallocatedblocks() - blocks
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    median = statistics.median(durations)
+    return {
+        "us_per_hook": median / count / 1000,
+        "hooks_per_second": count / (median / 1e9),
+        "peak_bytes_per_hook": peak / count,
+        "retained_blocks_per_hook": blocks / count,
+    }
+
+
+def _unwrap(value: Any) -> Any:
+    match value:
+        case Ok(inner):
+            return inner
+        case _:
+            raise RuntimeError(value)
+
+
+def _run_scenario(
+    directory: Path, scenario: str, hooks: int, repeat: int
+) -> dict[str, dict[str, float]]:
+    workflow = directory / f"{scenario}-{hooks}.yaml"
+    workflow.write_text(
+        f"config:\n  plugins:\n    - {_PLUGIN_MODULE}\nhooks:\n"
+        + "".join(_SCENARIOS[scenario](index) for index in range(hooks))
+    )
+    environ = (
+        {f"BENCH_{index}": "x" * 32 for index in range(_HUGE_ENVIRON_SIZE)}
+        if scenario == "huge-environ"
+        else {}
+    )
+    environ["HOME"] = "/home/bench"
+
+    env = _unwrap(load_config(directory, workflow, use_cache=False))
+    ui = CliUI(Console(file=io.StringIO()), log_level=logging.ERROR)
+    token = default_token()
+
+    def _plugin_from_entrypoint() -> None:
+        sys.modules.pop(_PLUGIN_MODULE, None)
+        _unwrap(plugin_from_entrypoint(_PLUGIN_MODULE))
+
+    plugins = PluginRegistry()
+    _unwrap(plugins.register(_PLUGIN_MODULE))
+    ctx = Context(
+        working_dir=str(directory),
+        metadata={"platform": platform.system().lower(), "arch": "bench"},
+        environ=environ,
+    )
+
+    def _execute_hooks() -> None:
+        conditions = ConditionEvaluator()
+        state_dir = directory / ".bex" / "state"
+        for hook in env.hooks:
+            _unwrap(
+                _execute_hook(token, ui, plugins, hook, ctx, conditions, state_dir, [])
+            )
+
+    return {
+        "load_config": _measure(
+            lambda: _unwrap(load_config(directory, workflow, use_cache=False)),
+            repeat,
+            hooks,
+        ),
+        "load_config (cached)": _measure(
+            lambda: _unwrap(load_config(directory, workflow)), repeat, hooks
+        ),
+        "plugin_from_entrypoint": _measure(_plugin_from_entrypoint, repeat, 1),
+        "_execute_hook": _measure(_execute_hooks, repeat, hooks),
+        "execute": _measure(
+            lambda: _unwrap(execute(token, ui, {}, dict(environ), env)),
+            repeat,
+            hooks,
+        ),
+    }
+
+
+def _git_revision() -> str | None:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=Path(__file__).parent,
+            text=True,
+            stderr=subprocess.DEVNULL,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _print_results(
+    results: dict[str, dict[str, dict[str, float]]],
+    baseline: dict[str, dict[str, dict[str, float]]] | None,
+) -> None:
+    for case, benchmarks in results.items():
+        print(case)
+        for name, metrics in benchmarks.items():
+            line = (
+                f"  {name:<24}{metrics['us_per_hook']:>12.1f} us/hook"
+                f"{metrics['hooks_per_second']:>14.0f} hooks/s"
+                f"{metrics['peak_bytes_per_hook']:>12.0f} B/hook"
+            )
+            previous = (baseline or {}).get(case, {}).get(name)
+            if previous is not None:
+                line += f"  x{metrics['us_per_hook'] / previous['us_per_hook']:.2f}"
+            print(line)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--scenario", choices=sorted(_SCENARIOS), action="append", dest="scenarios"
+    )
+    parser.add_argument(
+        "--hooks", type=int, action="append", help="Default to 10, 100 and 500"
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", type=Path, help="Write the results as JSON")
+    parser.add_argument("--baseline", type=Path, help="Compare to previous results")
+    args = parser.parse_args()
+
+    baseline = (
+        json.loads(args.baseline.read_text())["results"]
+        if args.baseline is not None
+        else None
+    )
+
+    results: dict[str, dict[str, dict[str, float]]] = {}
+    with tempfile.TemporaryDirectory() as _directory:
+        directory = Path(_directory)
+        (directory / f"{_PLUGIN_MODULE}.py").write_text(_PLUGIN_SOURCE)
+        sys.path.insert(0, str(directory))
+
+        for scenario in args.scenarios or list(_SCENARIOS):
+            for hooks in args.hooks or [10, 100, 500]:
+                results[f"{scenario}/{hooks}"] = _run_scenario(
+                    directory, scenario, hooks, args.repeat
+                )
+
+    _print_results(results, baseline)
+    if args.output is not None:
+        args.output.write_text(
+            json.dumps(
+                {
+                    "revision": _git_revision(),
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "cpus": os.cpu_count(),
+                    "results": results,
+                },
+                indent=4,
+            )
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,67 @@
+"""Checks the import time of the CLI against the budget in startup.json.
+
+Each module is imported in a fresh interpreter with ``-X importtime``, the
+best cumulative time over a few runs is compared to ``max_ms``, and the
+modules listed in ``forbidden`` must not be imported at all.
+
+    uv run python benchmarks/startup.py
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+_BUDGET_FILE = Path(__file__).with_name("startup.json")
+_IMPORTTIME_PATTERN = re.compile(
+    r"^import time:\s+(?P<self>\d+) \|\s+(?P<cumulative>\d+) \|(?P<name>.*)$"
+)
+
+
+def _import_times(module: str) -> dict[str, int]:
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stderr
+
+    times: dict[str, int] = {}
+    for line in output.splitlines():
+        match = _IMPORTTIME_PATTERN.match(line)
+        if match is not None:
+            times[match["name"].strip()] = int(match["cumulative"])
+    return times
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget", type=Path, default=_BUDGET_FILE)
+    args = parser.parse_args()
+
+    budget = json.loads(args.budget.read_text())
+    failed = False
+    for module, limits in budget.items():
+        runs = [_import_times(module) for _ in range(args.runs)]
+        best_ms = min(times[module] for times in runs) / 1000
+        imported = set().union(*runs)
+
+        status = "ok" if best_ms <= limits["max_ms"] else "over budget"
+        print(f"{module}: {best_ms:.1f}ms (budget {limits['max_ms']}ms) {status}")
+        failed |= best_ms > limits["max_ms"]
+
+        for name in limits.get("forbidden", []):
+            if name in imported:
+                print(f"  imports {name}")
+                failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
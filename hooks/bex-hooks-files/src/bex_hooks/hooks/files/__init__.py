@@ -2,17 +2,64 @@ from __future__ import annotations
 
 from typing import TYPE_CHECKING
 
-from bex_hooks.hooks.files.file import archive, download, inline
+from bex_hooks.hooks.files.file import (
+    archive,
+    archive_keys,
+    archive_outputs,
+    download,
+    download_keys,
+    download_outputs,
+    inline,
+    inline_keys,
+    inline_outputs,
+)
 
 if TYPE_CHECKING:
     from collections.abc import Mapping
 
-    from bex_hooks.hooks.files._interface import HookFunc
+    from bex_hooks.hooks.files._interface import (
+        AsyncHookFunc,
+        HookFilesFunc,
+        HookFunc,
+        HookKeysFunc,
+    )
 
 
-def get_hooks() -> Mapping[str, HookFunc]:
+# Read by the executor without importing the plugin, keep in sync with get_hooks
+__hooks__ = (
+    "files/archive",
+    "files/download",
+    "files/inline",
+)
+
+
+def get_hooks() -> Mapping[str, HookFunc | AsyncHookFunc]:
     return {
         "files/archive": archive,
         "files/download": download,
         "files/inline": inline,
     }
+
+
+def get_hook_outputs() -> Mapping[str, HookFilesFunc]:
+    return {
+        "files/archive": archive_outputs,
+        "files/download": download_outputs,
+        "files/inline": inline_outputs,
+    }
+
+
+def get_hook_environ() -> Mapping[str, HookKeysFunc]:
+    return {
+        "files/archive": archive_keys,
+        "files/download": download_keys,
+        "files/inline": inline_keys,
+    }
+
+
+def get_hook_metadata() -> Mapping[str, HookKeysFunc]:
+    return {
+        "files/archive": archive_keys,
+        "files/download": download_keys,
+        "files/inline": inline_keys,
+    }
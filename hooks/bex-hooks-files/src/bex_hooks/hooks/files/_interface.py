@@ -1,13 +1,32 @@
 from __future__ import annotations
 
+from collections.abc import Mapping
 from dataclasses import dataclass
-from typing import TYPE_CHECKING, Any, Literal, NoReturn, Protocol, Self, TypeGuard
+from types import MappingProxyType
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Literal,
+    NoReturn,
+    Protocol,
+    Self,
+    TypeGuard,
+    TypeVar,
+    runtime_checkable,
+)
 
 if TYPE_CHECKING:
-    from collections.abc import Callable, Mapping
+    from collections.abc import Callable, Iterable, Iterator
+    from contextlib import AbstractContextManager
     from types import TracebackType
 
 
+_V = TypeVar("_V")
+_V_co = TypeVar("_V_co", covariant=True)
+_MAX_LAYERS = 32
+_LAYERED_TYPES: dict[type, bool] = {}
+
+
 # --- Helpers ---
 @dataclass(frozen=True)
 class Context:
@@ -16,6 +35,99 @@ class Context:
     environ: Mapping[str, str]
 
 
+class LayeredMapping(Mapping[str, _V]):
+    # A read-only mapping made of the changes of one step over the mapping of
+    # the previous step, so that a step does not copy what it does not change.
+    __slots__ = ("__changes", "__depth", "__flat", "__lookup", "__parent", "__removed")
+
+    def __init__(
+        self,
+        parent: Mapping[str, _V],
+        changes: Mapping[str, _V] | None = None,
+        removed: Iterable[str] = (),
+    ) -> None:
+        self.__parent = parent
+        self.__changes = dict(changes or {})
+        self.__removed = frozenset(key for key in removed if key not in self.__changes)
+        self.__flat: dict[str, _V] | None = None
+
+        # Lookups go through every layer, so long chains are flattened
+        self.__lookup: Mapping[str, _V] = parent
+        self.__depth = 1
+        if is_layered_mapping(parent):
+            if parent.depth < _MAX_LAYERS:
+                self.__depth = parent.depth + 1
+            elif isinstance(parent, LayeredMapping):
+                self.__lookup = parent.__flatten()
+            else:
+                self.__lookup = parent.flatten()
+
+    @property
+    def parent(self) -> Mapping[str, _V]:
+        return self.__parent
+
+    @property
+    def changes(self) -> Mapping[str, _V]:
+        return MappingProxyType(self.__changes)
+
+    @property
+    def removed(self) -> frozenset[str]:
+        return self.__removed
+
+    @property
+    def depth(self) -> int:
+        return self.__depth
+
+    def flatten(self) -> dict[str, _V]:
+        return dict(self.__flatten())
+
+    def __getitem__(self, key: str) -> _V:
+        if key in self.__changes:
+            return self.__changes[key]
+        if key in self.__removed:
+            raise KeyError(key)
+        return self.__lookup[key]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.__flatten())
+
+    def __len__(self) -> int:
+        return len(self.__flatten())
+
+    def __repr__(self) -> str:
+        return f"LayeredMapping({self.__flatten()!r})"
+
+    def __flatten(self) -> dict[str, _V]:
+        if self.__flat is None:
+            layers: list[LayeredMapping[_V]] = []
+            current: Mapping[str, _V] = self
+            while isinstance(current, LayeredMapping) and current.__flat is None:
+                layers.append(current)
+                current = current.__lookup
+
+            flat = dict(
+                current.__flat if isinstance(current, LayeredMapping) else current
+            )
+            for layer in reversed(layers):
+                for key in layer.__removed:
+                    flat.pop(key, None)
+                flat.update(layer.__changes)
+            self.__flat = flat
+        return self.__flat
+
+
+def is_layered_mapping(
+    mapping: Mapping[str, _V],
+) -> TypeGuard[LayeredMappingLike[_V]]:
+    # Each plugin has its own copy of LayeredMapping, so layers are detected
+    # by their shape. Protocol checks are slow, the result is kept per type.
+    cls = type(mapping)
+    layered = _LAYERED_TYPES.get(cls)
+    if layered is None:
+        layered = _LAYERED_TYPES[cls] = isinstance(mapping, LayeredMappingLike)
+    return layered
+
+
 def is_token_cancelled(
     token: CancellationToken,
 ) -> TypeGuard[CancelledCancellationToken]:
@@ -34,6 +146,38 @@ class HookFunc(Protocol):
     ) -> ContextLike: ...
 
 
+class AsyncHookFunc(Protocol):
+    async def __call__(
+        self,
+        token: CancellationToken,
+        args: Mapping[str, Any],
+        ctx: ContextLike,
+        *,
+        ui: UI,
+    ) -> ContextLike: ...
+
+
+class HookFilesFunc(Protocol):
+    def __call__(self, args: Mapping[str, Any], ctx: ContextLike) -> Iterable[str]: ...
+
+
+class HookKeysFunc(Protocol):
+    def __call__(self, args: Mapping[str, Any], ctx: ContextLike) -> Iterable[str]: ...
+
+
+@runtime_checkable
+class LayeredMappingLike(Protocol[_V_co]):
+    @property
+    def parent(self) -> Mapping[str, _V_co]: ...
+    @property
+    def changes(self) -> Mapping[str, _V_co]: ...
+    @property
+    def removed(self) -> frozenset[str]: ...
+    @property
+    def depth(self) -> int: ...
+    def flatten(self) -> dict[str, _V_co]: ...
+
+
 class ContextLike(Protocol):
     @property
     def working_dir(self) -> str: ...
@@ -63,6 +207,8 @@ class UI(Protocol):
     def progress(self) -> UIProgress: ...
     def log(self, *objects: Any, end: str = "\n") -> None: ...
     def print(self, *objects: Any, end: str = "\n") -> None: ...
+    def span(self, name: str, /, **args: Any) -> AbstractContextManager[Any]: ...
+    def metric(self, name: str, value: float, /) -> None: ...
 
 
 class UIScope(Protocol):
@@ -0,0 +1,287 @@
+# Copied in each plugin package, which can not depend on bex-hooks, the copies
+# are checked to be identical by tests/test_vendored.py.
+from __future__ import annotations
+
+import contextlib
+import logging
+import os
+import shutil
+import sqlite3
+import stat
+import sys
+import time
+import uuid
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, Literal
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable, Iterator, Mapping
+
+Materialization = Literal["reflink", "hardlink", "copy"]
+
+# Clones the extents of a file on filesystems with copy-on-write support
+# (btrfs, xfs, ...), see ioctl_ficlone(2).
+_FICLONE = 0x40049409
+
+_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS refs (
+    path TEXT NOT NULL,
+    workflow TEXT NOT NULL,
+    PRIMARY KEY (path, workflow)
+);
+CREATE TABLE IF NOT EXISTS targets (
+    target TEXT PRIMARY KEY,
+    path TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+"""
+_INDEX_VERSION = 1
+
+# Index databases this process created or found with their schema, the
+# schema is then not checked again by every connection.
+_created_indexes: set[Path] = set()
+
+
+@dataclass(frozen=True)
+class CacheEntry:
+    # Relative to the cache directory, e.g. `files/sha256/<hex>`
+    path: str
+    size: int
+    accessed: float
+    # Working directories of the workflows which used the entry
+    workflows: frozenset[str]
+
+
+def cache_dir(working_dir: str, environ: Mapping[str, str]) -> Path:
+    # Shared by every workspace of the machine when set, otherwise each
+    # workspace keeps its own cache.
+    value = environ.get("BEX_CACHE_DIR", "")
+    if len(value) > 0:
+        return Path(value).expanduser()
+    return Path(working_dir) / ".bex" / "cache"
+
+
+class CacheIndex:
+    # Size, last access and users of the entries of a cache directory, in a
+    # SQLite database shared by the processes using the cache.
+    __slots__ = ("__root",)
+
+    def __init__(self, root: Path) -> None:
+        self.__root = root
+
+    @property
+    def root(self) -> Path:
+        return self.__root
+
+    def exists(self) -> bool:
+        return (self.__root / "index.sqlite").is_file()
+
+    def touch(
+        self, path: Path, *, workflow: str | None = None, target: Path | None = None
+    ) -> None:
+        # The target is the file made from the entry, the executor touches the
+        # entry by its target when it replays a hook instead of running it.
+        name = path.relative_to(self.__root).as_posix()
+        size = path.stat().st_size
+        with self.__connect() as conn:
+            conn.execute(
+                "INSERT INTO entries VALUES (?, ?, ?) ON CONFLICT (path) "
+                "DO UPDATE SET size = excluded.size, accessed = excluded.accessed",
+                (name, size, time.time()),
+            )
+            if workflow is not None:
+                conn.execute(
+                    "INSERT OR IGNORE INTO refs VALUES (?, ?)", (name, workflow)
+                )
+            if target is not None:
+                conn.execute(
+                    "INSERT OR REPLACE INTO targets VALUES (?, ?)",
+                    (str(target), name),
+                )
+
+    def touch_targets(self, targets: Iterable[str]) -> None:
+        accessed = time.time()
+        with self.__connect() as conn:
+            conn.executemany(
+                "UPDATE entries SET accessed = ? WHERE path IN "
+                "(SELECT path FROM targets WHERE target = ?)",
+                ((accessed, target) for target in targets),
+            )
+
+    def size(self) -> int:
+        with self.__connect() as conn:
+            return conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()[0]
+
+    def entries(self) -> list[CacheEntry]:
+        # Least recently used first
+        with self.__connect() as conn:
+            workflows: dict[str, set[str]] = {}
+            for name, workflow in conn.execute("SELECT path, workflow FROM refs"):
+                workflows.setdefault(name, set()).add(workflow)
+            return [
+                CacheEntry(name, size, accessed, frozenset(workflows.get(name, ())))
+                for name, size, accessed in conn.execute(
+                    "SELECT path, size, accessed FROM entries ORDER BY accessed"
+                )
+            ]
+
+    def remove(self, names: Iterable[str]) -> None:
+        with self.__connect() as conn:
+            for name in names:
+                conn.execute("DELETE FROM entries WHERE path = ?", (name,))
+                conn.execute("DELETE FROM refs WHERE path = ?", (name,))
+                conn.execute("DELETE FROM targets WHERE path = ?", (name,))
+
+    @contextlib.contextmanager
+    def __connect(self) -> Iterator[sqlite3.Connection]:
+        database = self.__root / "index.sqlite"
+        # Checked again once the file is gone, e.g. when the cache was removed
+        created = database in _created_indexes and database.is_file()
+        if not created:
+            self.__root.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(database, timeout=30)
+        try:
+            # Commits do not wait for the disk, the index can be rebuilt by
+            # `bex exec cache verify`.
+            conn.execute("PRAGMA synchronous = NORMAL")
+            if not created:
+                _create_index(conn)
+                _created_indexes.add(database)
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+
+def _create_index(conn: sqlite3.Connection) -> None:
+    # Readers do not wait for writers. The journal mode is kept in the
+    # database, like the schema it is only set when the database is created.
+    if conn.execute("PRAGMA user_version").fetchone()[0] < _INDEX_VERSION:
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.executescript(_INDEX_SCHEMA)
+        conn.execute(f"PRAGMA user_version = {_INDEX_VERSION}")
+
+
+class ContentStore:
+    # Files stored by the digest of their content, `<root>/<algorithm>/<hex>`
+    __slots__ = ("__index", "__root", "__workflow")
+
+    def __init__(
+        self,
+        root: Path,
+        index: CacheIndex | None = None,
+        *,
+        workflow: str | None = None,
+    ) -> None:
+        self.__root = root
+        self.__index = index
+        self.__workflow = workflow
+
+    @property
+    def root(self) -> Path:
+        return self.__root
+
+    def path(self, algorithm: str, digest: str) -> Path:
+        return self.__root / algorithm / digest
+
+    def get(
+        self, algorithm: str, digest: str, *, target: Path | None = None
+    ) -> Path | None:
+        path = self.path(algorithm, digest)
+        if not path.is_file():
+            return None
+        self.__touch(path, target)
+        return path
+
+    def add(
+        self, algorithm: str, digest: str, source: Path, *, target: Path | None = None
+    ) -> Path:
+        path = self.path(algorithm, digest)
+        if path.is_file():
+            source.unlink(missing_ok=True)
+            self.__touch(path, target)
+            return path
+
+        # Moved next to the object then renamed, so that other processes
+        # never see a partial object.
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp = path.with_name(f".{path.name}.{uuid.uuid4().hex}")
+        try:
+            shutil.move(source, temp)
+            # Objects may be hard linked into workspaces, they are read-only
+            # so that writing to one target does not change the others, and
+            # readable by the other users sharing the store.
+            temp.chmod(stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            os.replace(temp, path)
+        except BaseException:
+            temp.unlink(missing_ok=True)
+            raise
+        self.__touch(path, target)
+        return path
+
+    def __touch(self, path: Path, target: Path | None) -> None:
+        # The index only decides what is evicted first, failing to update it
+        # does not fail the hook.
+        if self.__index is None:
+            return
+        try:
+            self.__index.touch(path, workflow=self.__workflow, target=target)
+        except (OSError, sqlite3.Error) as err:
+            logging.getLogger("bex_hooks.store").warning(
+                "Failed to update the cache index: %s", err
+            )
+
+
+def materialize(
+    source: Path, target: Path, *, hardlink: bool = False
+) -> Materialization:
+    # Written next to the target then renamed, replacing the previous target.
+    # Reflinks and copies are writable, hard links share the read-only stored
+    # file and are only made when the caller does not write to the target.
+    target.parent.mkdir(parents=True, exist_ok=True)
+    temp = target.with_name(f".{target.name}.{uuid.uuid4().hex}")
+    try:
+        method: Materialization
+        if _reflink(source, temp):
+            method = "reflink"
+        elif hardlink and _hardlink(source, temp):
+            method = "hardlink"
+        else:
+            shutil.copyfile(source, temp)
+            method = "copy"
+        os.replace(temp, target)
+    except BaseException:
+        temp.unlink(missing_ok=True)
+        raise
+    return method
+
+
+def _reflink(source: Path, target: Path) -> bool:
+    if sys.platform != "linux":
+        return False
+
+    import fcntl
+
+    try:
+        with open(source, "rb") as src, open(target, "xb") as dest:
+            fcntl.ioctl(dest.fileno(), _FICLONE, src.fileno())
+    except OSError:
+        target.unlink(missing_ok=True)
+        return False
+    return True
+
+
+def _hardlink(source: Path, target: Path) -> bool:
+    try:
+        os.link(source, target)
+    except OSError:
+        return False
+    return True
@@ -1,6 +1,7 @@
 from __future__ import annotations
 
-import hashlib
+import asyncio
+import logging
 import shutil
 import zipfile
 from pathlib import Path
@@ -9,205 +10,295 @@ from typing import TYPE_CHECKING, Any
 
 from pydantic import BaseModel, Field
 
-from bex_hooks.hooks.files.utils import download_file
+from bex_hooks.hooks.files._store import (
+    CacheIndex,
+    ContentStore,
+    cache_dir,
+    materialize,
+)
+from bex_hooks.hooks.files.utils import download_file, file_digest
 
 if TYPE_CHECKING:
-    from collections.abc import Mapping
+    from collections.abc import Iterable, Mapping
+
+    from bex_hooks.hooks.files._interface import (
+        UI,
+        CancellationToken,
+        ContextLike,
+        UIProgress,
+    )
+
+
+class _ArchiveArgs(BaseModel):
+    source: str
+    source_hash: str
+    target: str
+    format_: str = Field(validation_alias="format")
+    keep_source: bool = Field(default=True)
+    parts: int = Field(default=4, ge=1)
+    min_part_size: int = Field(default=16 * 1024 * 1024, ge=1)
 
-    from bex_hooks.hooks.files._interface import UI, CancellationToken, ContextLike
 
+class _DownloadArgs(BaseModel):
+    source: str
+    source_hash: str
+    target: str
+    keep_source: bool = Field(default=True)
+    hardlink: bool = Field(default=False)
+    parts: int = Field(default=4, ge=1)
+    min_part_size: int = Field(default=16 * 1024 * 1024, ge=1)
 
-def archive(
+
+class _InlineArgs(BaseModel):
+    content: str
+    target: str
+
+
+async def archive(
     token: CancellationToken, args: Mapping[str, Any], ctx: ContextLike, *, ui: UI
 ) -> ContextLike:
-    class _Args(BaseModel):
-        source: str
-        source_hash: str
-        target: str
-        format_: str = Field(validation_alias="format")
-        keep_source: bool = Field(default=True)
-
-    data = _Args.model_validate(args, from_attributes=False)
-    target = Path(
-        Template(data.target).substitute(
-            {
-                "working_dir": ctx.working_dir,
-                "metadata": ctx.metadata,
-                "environ": ctx.environ,
-            }
-        )
-    )
+    data = _ArchiveArgs.model_validate(args, from_attributes=False)
+    target = _render_path(data.target, ctx)
     enforce_toplevel = args.get("enforce_toplevel", False)
 
     hash_algo, hash_hex = data.source_hash.split(":")
-    cached_file = (
-        Path(ctx.working_dir) / ".bex" / "cache" / "files" / hash_algo / hash_hex
-    )
-    if cached_file.exists() and cached_file.is_file():
+    store = _content_store(ctx)
+    cached_file = store.get(hash_algo, hash_hex, target=target)
+    if cached_file is not None:
         ui.print("Using {}".format(cached_file))
-        filename = cached_file
+        _path = cached_file
     else:
-        with ui.progress() as pb:
-            task_id = pb.add_task(
-                "Downloading {}".format(target.relative_to(ctx.working_dir))
-            )
-            filename = download_file(
-                token,
-                data.source,
-                report_hook=lambda completed, total: pb.update(
-                    task_id, completed=completed, total=total if total > 0 else None
-                ),
-            )
-
-    _path = Path(filename)
-    if hash_hex != hashlib.new(hash_algo, _path.read_bytes()).hexdigest():
-        msg = f"Hash mismatched when downloading {data.source}"
-        raise ValueError(msg)
+        _path, _digest = await _download(token, ui, data, target, ctx, hash_algo)
+        if hash_hex != _digest:
+            _path.unlink(missing_ok=True)
+            msg = f"Hash mismatched when downloading {data.source}"
+            raise ValueError(msg)
 
     # TODO: Don't extract if file has not changed
     try:
-        with ui.progress() as pb:
+        with ui.span("extract", format=data.format_), ui.progress() as pb:
             if data.format_ == "zip":
-                with zipfile.ZipFile(filename) as archive:
-                    has_single_toplevel = True
-                    if not enforce_toplevel or (
-                        len(
-                            {
-                                Path(name).parts[0]
-                                for name in archive.namelist()
-                                if not name.startswith("__MACOSX")
-                            }
-                        )
-                        > 1
-                    ):
-                        has_single_toplevel = False
-
-                    _members = archive.infolist()
-                    task_id = pb.add_task(
-                        "Extracting {}".format(target.relative_to(ctx.working_dir)),
-                        total=len(_members),
-                    )
-                    for member in _members:
-                        token.raise_if_cancelled()
-
-                        member_path = Path(member.filename)
-                        relative_path = (
-                            Path(*member_path.parts[1:])
-                            if has_single_toplevel
-                            else member_path
-                        )
-                        target_path = (Path(target) / relative_path).resolve()
-                        target_path.parent.mkdir(parents=True, exist_ok=True)
-
-                        if member.is_dir():
-                            target_path.mkdir(parents=True, exist_ok=True)
-                        else:
-                            with (
-                                archive.open(member) as source,
-                                open(target_path, "wb") as target_file,
-                            ):
-                                target_file.write(source.read())
-
-                        pb.advance(task_id, 1)
+                await asyncio.to_thread(
+                    _extract_zip,
+                    token,
+                    _path,
+                    target,
+                    pb,
+                    "Extracting {}".format(target.relative_to(ctx.working_dir)),
+                    enforce_toplevel=enforce_toplevel,
+                )
     finally:
-        if _path.exists() and data.keep_source is True:
-            cached_file.parent.mkdir(parents=True, exist_ok=True)
-            shutil.move(_path, cached_file)
-        elif _path.exists():
+        if cached_file is None and _path.exists() and data.keep_source is True:
+            store.add(hash_algo, hash_hex, _path, target=target)
+        elif cached_file is None and _path.exists():
             _path.unlink()
 
     return ctx
 
 
-def download(
+def archive_outputs(args: Mapping[str, Any], ctx: ContextLike) -> Iterable[str]:
+    data = _ArchiveArgs.model_validate(args, from_attributes=False)
+    return [str(_render_path(data.target, ctx))]
+
+
+def archive_keys(args: Mapping[str, Any], ctx: ContextLike) -> Iterable[str]:
+    data = _ArchiveArgs.model_validate(args, from_attributes=False)
+    return _template_keys(data.target)
+
+
+async def download(
     token: CancellationToken, args: Mapping[str, Any], ctx: ContextLike, *, ui: UI
 ) -> ContextLike:
-    class _Args(BaseModel):
-        source: str
-        source_hash: str
-        target: str
-        keep_source: bool = Field(default=True)
-
-    data = _Args.model_validate(args, from_attributes=False)
-    target = Path(
-        Template(data.target).substitute(
-            {
-                "working_dir": ctx.working_dir,
-                "metadata": ctx.metadata,
-                "environ": ctx.environ,
-            }
-        )
-    )
+    data = _DownloadArgs.model_validate(args, from_attributes=False)
+    target = _render_path(data.target, ctx)
 
     hash_algo, hash_hex = data.source_hash.split(":")
-    if (
-        target.exists()
-        and hashlib.new(hash_algo, target.read_bytes()).hexdigest() == hash_hex
+    store = _content_store(ctx)
+    if target.exists() and (
+        _is_same_file(target, store.path(hash_algo, hash_hex))
+        or await asyncio.to_thread(file_digest, hash_algo, target) == hash_hex
     ):
         ui.print("Skipping, file already exists {}".format(target))
+        # Recorded as used, so that it is not the first entry evicted
+        store.get(hash_algo, hash_hex, target=target)
         return ctx
 
-    cached_file = (
-        Path(ctx.working_dir) / ".bex" / "cache" / "files" / hash_algo / hash_hex
-    )
-    if cached_file.exists() and cached_file.is_file():
+    # Stored files were verified when they were added, and are checked by
+    # `bex exec cache verify`, they are not hashed again.
+    cached_file = store.get(hash_algo, hash_hex, target=target)
+    if cached_file is not None:
         ui.log("Using {}".format(cached_file))
-        filename = cached_file
+        _path = cached_file
     else:
-        with ui.progress() as pb:
-            task_id = pb.add_task(
-                "Downloading {}".format(target.relative_to(ctx.working_dir))
-            )
-            filename = download_file(
-                token,
-                data.source,
-                report_hook=lambda completed, total: pb.update(
-                    task_id, completed=completed, total=total if total > 0 else None
-                ),
-            )
+        _path, _digest = await _download(token, ui, data, target, ctx, hash_algo)
+        if hash_hex != _digest:
+            _path.unlink(missing_ok=True)
+            msg = f"Hash mismatched when downloading {data.source}"
+            raise ValueError(msg)
 
-    _path = Path(filename)
-    if hash_hex != hashlib.new(hash_algo, _path.read_bytes()).hexdigest():
-        msg = f"Hash mismatched when downloading {data.source}"
-        raise ValueError(msg)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    if cached_file is None and data.keep_source is False:
+        await asyncio.to_thread(shutil.move, _path, target)
+        return ctx
 
-    try:
-        target.parent.mkdir(parents=True, exist_ok=True)
-        shutil.copy(_path, target)
-    finally:
-        if _path.exists() and data.keep_source is True:
-            cached_file.parent.mkdir(parents=True, exist_ok=True)
-            shutil.move(_path, cached_file)
-        elif _path.exists():
-            _path.unlink()
+    if cached_file is None:
+        downloaded = _path
+        try:
+            _path = await asyncio.to_thread(
+                store.add, hash_algo, hash_hex, _path, target=target
+            )
+        finally:
+            downloaded.unlink(missing_ok=True)
 
+    # Targets share the stored file when the filesystem allows it
+    method = await asyncio.to_thread(materialize, _path, target, hardlink=data.hardlink)
+    logging.getLogger("bex_hooks.hooks.files").debug(
+        "Materialized %s from %s (%s)", target, _path, method
+    )
     return ctx
 
 
+def download_outputs(args: Mapping[str, Any], ctx: ContextLike) -> Iterable[str]:
+    data = _DownloadArgs.model_validate(args, from_attributes=False)
+    return [str(_render_path(data.target, ctx))]
+
+
+def download_keys(args: Mapping[str, Any], ctx: ContextLike) -> Iterable[str]:
+    data = _DownloadArgs.model_validate(args, from_attributes=False)
+    return _template_keys(data.target)
+
+
 def inline(
     token: CancellationToken, args: Mapping[str, Any], ctx: ContextLike, *, ui: UI
 ) -> ContextLike:
-    class _Args(BaseModel):
-        content: str
-        target: str
+    data = _InlineArgs.model_validate(args, from_attributes=False)
+    content = _render(data.content, ctx)
+    target = _render_path(data.target, ctx)
 
-    data = _Args.model_validate(args, from_attributes=False)
-    content = Template(data.content).substitute(
+    target.write_text(content)
+    return ctx
+
+
+def inline_outputs(args: Mapping[str, Any], ctx: ContextLike) -> Iterable[str]:
+    data = _InlineArgs.model_validate(args, from_attributes=False)
+    return [str(_render_path(data.target, ctx))]
+
+
+def inline_keys(args: Mapping[str, Any], ctx: ContextLike) -> Iterable[str]:
+    data = _InlineArgs.model_validate(args, from_attributes=False)
+    return _template_keys(data.target, data.content)
+
+
+def _content_store(ctx: ContextLike) -> ContentStore:
+    cache = cache_dir(ctx.working_dir, ctx.environ)
+    return ContentStore(cache / "files", CacheIndex(cache), workflow=ctx.working_dir)
+
+
+async def _download(
+    token: CancellationToken,
+    ui: UI,
+    data: _ArchiveArgs | _DownloadArgs,
+    target: Path,
+    ctx: ContextLike,
+    algorithm: str,
+) -> tuple[Path, str]:
+    with ui.span("download", url=data.source), ui.progress() as pb:
+        task_id = pb.add_task(
+            "Downloading {}".format(target.relative_to(ctx.working_dir))
+        )
+        _path, digest, received = await download_file(
+            token,
+            data.source,
+            algorithm=algorithm,
+            parts=data.parts,
+            min_part_size=data.min_part_size,
+            # Kept when interrupted, and resumed by the next run
+            partial=cache_dir(ctx.working_dir, ctx.environ)
+            / "partial"
+            / algorithm
+            / data.source_hash.split(":")[1],
+            report_hook=lambda completed, total: pb.update(
+                task_id, completed=completed, total=total if total > 0 else None
+            ),
+        )
+    # Resumed downloads only count the bytes received by this run
+    ui.metric("downloaded_bytes", received)
+    return _path, digest
+
+
+def _is_same_file(path: Path, other: Path) -> bool:
+    # A target hard linked from the store does not need to be hashed
+    try:
+        return path.samefile(other)
+    except OSError:
+        return False
+
+
+def _extract_zip(
+    token: CancellationToken,
+    filename: Path,
+    target: Path,
+    pb: UIProgress,
+    description: str,
+    *,
+    enforce_toplevel: bool,
+) -> None:
+    with zipfile.ZipFile(filename) as archive:
+        has_single_toplevel = True
+        if not enforce_toplevel or (
+            len(
+                {
+                    Path(name).parts[0]
+                    for name in archive.namelist()
+                    if not name.startswith("__MACOSX")
+                }
+            )
+            > 1
+        ):
+            has_single_toplevel = False
+
+        _members = archive.infolist()
+        task_id = pb.add_task(description, total=len(_members))
+        for member in _members:
+            token.raise_if_cancelled()
+
+            member_path = Path(member.filename)
+            relative_path = (
+                Path(*member_path.parts[1:]) if has_single_toplevel else member_path
+            )
+            target_path = (Path(target) / relative_path).resolve()
+            target_path.parent.mkdir(parents=True, exist_ok=True)
+
+            if member.is_dir():
+                target_path.mkdir(parents=True, exist_ok=True)
+            else:
+                with (
+                    archive.open(member) as source,
+                    open(target_path, "wb") as target_file,
+                ):
+                    shutil.copyfileobj(source, target_file)
+
+            pb.advance(task_id, 1)
+
+
+def _render(template: str, ctx: ContextLike) -> str:
+    return Template(template).substitute(
         {
             "working_dir": ctx.working_dir,
             "metadata": ctx.metadata,
             "environ": ctx.environ,
         }
     )
-    target = Path(
-        Template(data.target).substitute(
-            {
-                "working_dir": ctx.working_dir,
-                "metadata": ctx.metadata,
-                "environ": ctx.environ,
-            }
-        )
-    )
 
-    target.write_text(content)
-    return ctx
+
+def _template_keys(*templates: str) -> list[str]:
+    # Templates substitute the whole metadata or environment, the hooks read
+    # no other variable.
+    identifiers = {
+        name for template in templates for name in Template(template).get_identifiers()
+    }
+    return ["*"] if not identifiers.isdisjoint({"metadata", "environ"}) else []
+
+
+def _render_path(template: str, ctx: ContextLike) -> Path:
+    return Path(_render(template, ctx))
@@ -1,8 +1,18 @@
 from __future__ import annotations
 
+import asyncio
 import contextlib
 import datetime as dt
+import hashlib
+import json
+import logging
+import os
+import sys
 import tempfile
+import threading
+import time
+import uuid
+from dataclasses import asdict, dataclass
 from pathlib import Path
 from typing import TYPE_CHECKING, Any
 
@@ -10,44 +20,432 @@ import httpx
 
 from bex_hooks.hooks.files._interface import is_token_cancelled
 
+# Ranged downloads, files smaller than two parts use a single connection
+_PARTS = 4
+_MIN_PART_SIZE = 16 * 1024 * 1024
+# Size of the reads of the parts written, to compute the digest
+_HASH_CHUNK_SIZE = 1024 * 1024
+# Seconds between saves of the progress of a partial download
+_SAVE_INTERVAL = 1.0
+
 if TYPE_CHECKING:
-    from collections.abc import Callable
+    from collections.abc import AsyncIterator, Callable, Iterator
 
     from bex_hooks.hooks.files._interface import CancellationToken
 
+_clients: dict[
+    asyncio.AbstractEventLoop, tuple[httpx.AsyncClient, AsyncIterator[None]]
+] = {}
+_clients_lock = threading.Lock()
+
+
+async def http_client() -> httpx.AsyncClient:
+    # Shared by the downloads running in the same event loop, so that they
+    # reuse connections. A client can not be used by another event loop, it
+    # is closed when its loop shuts down its async generators.
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        entry = _clients.get(loop)
+        if entry is not None:
+            return entry[0]
+        client = httpx.AsyncClient(follow_redirects=True)
+        lifetime = _client_lifetime(loop, client)
+        _clients[loop] = (client, lifetime)
+    await anext(lifetime)
+    return client
+
 
-def download_file(
+async def _client_lifetime(
+    loop: asyncio.AbstractEventLoop, client: httpx.AsyncClient
+) -> AsyncIterator[None]:
+    try:
+        yield
+    finally:
+        with _clients_lock:
+            _clients.pop(loop, None)
+        await client.aclose()
+
+
+async def download_file(
     token: CancellationToken,
     source: str,
     *,
+    algorithm: str = "sha256",
     chunk_size: int | None = None,
     report_hook: Callable[[int, int], Any] | None = None,
-) -> Path:
-    with (
-        tempfile.NamedTemporaryFile(delete=False) as dest,
-        httpx.stream(
-            "GET", source, follow_redirects=True, headers={"Accept-Encoding": ""}
-        ) as response,
-    ):
-        _content_len = (
-            int(response.headers["Content-Length"])
-            if "Content-Length" in response.headers
-            else -1
+    parts: int = _PARTS,
+    min_part_size: int = _MIN_PART_SIZE,
+    partial: Path | None = None,
+) -> tuple[Path, str, int]:
+    # With `partial`, the download is written to that path and kept when it
+    # is interrupted, to be resumed by the next call with the same path. The
+    # bytes received by this call are returned with the digest.
+    with _partial_file(partial) as (_path, resumable):
+        try:
+            digest, received = await _download(
+                token,
+                source,
+                _path,
+                algorithm=algorithm,
+                chunk_size=chunk_size,
+                report_hook=report_hook,
+                parts=parts,
+                min_part_size=min_part_size,
+                resumable=resumable,
+            )
+        except BaseException:
+            # Including the cancellation of the task
+            if not resumable or not _sidecar(_path).is_file():
+                _path.unlink(missing_ok=True)
+            raise
+
+        if is_token_cancelled(token):
+            if not resumable or not _sidecar(_path).is_file():
+                _path.unlink(missing_ok=True)
+            raise token.get_error()
+
+        _sidecar(_path).unlink(missing_ok=True)
+        if not resumable:
+            return _path, digest, received
+
+        # Renamed while locked, so that another process does not resume the
+        # completed file while the caller moves it.
+        completed = _path.with_name(f".{_path.name}.{uuid.uuid4().hex}")
+        os.replace(_path, completed)
+        return completed, digest, received
+
+
+@dataclass
+class _Resume:
+    # Saved next to a partial download, to resume it with range requests
+    source: str
+    url: str
+    validator: str | None
+    bounds: list[tuple[int, int]]
+    written: list[int]
+
+
+class _RangeError(ValueError): ...
+
+
+async def _download(
+    token: CancellationToken,
+    source: str,
+    path: Path,
+    *,
+    algorithm: str,
+    chunk_size: int | None,
+    report_hook: Callable[[int, int], Any] | None,
+    parts: int,
+    min_part_size: int,
+    resumable: bool,
+) -> tuple[str, int]:
+    # The digest is computed while the chunks are written, so that the file
+    # is not read again to verify it.
+    logger = logging.getLogger("bex_hooks.hooks.files")
+    received = 0
+
+    def _received(size: int) -> None:
+        nonlocal received
+        received += size
+
+    client = await http_client()
+    resume = _load_resume(path, source) if resumable else None
+    if resume is not None:
+        logger.info("Resuming the download of %s", source)
+        digest = hashlib.new(algorithm)
+        try:
+            await _download_parts(
+                token,
+                client,
+                path,
+                resume,
+                digest,
+                chunk_size=chunk_size,
+                report_hook=report_hook,
+                on_received=_received,
+                resumable=resumable,
+            )
+        except _RangeError as err:
+            logger.info("Restarting the download of %s: %s", source, err)
+        else:
+            return digest.hexdigest(), received
+
+    _sidecar(path).unlink(missing_ok=True)
+    digest = hashlib.new(algorithm)
+    try:
+        async with client.stream(
+            "GET", source, headers={"Accept-Encoding": ""}
+        ) as response:
+            _content_len = (
+                int(response.headers["Content-Length"])
+                if "Content-Length" in response.headers
+                else -1
+            )
+
+            # Large files are fetched in parts over several connections, and
+            # interrupted downloads are resumed, when the server supports
+            # ranges. The first part is read from this response.
+            if (
+                response.status_code == 200
+                and _content_len >= 0
+                and "bytes" in response.headers.get("Accept-Ranges", "")
+                and "Content-Encoding" not in response.headers
+            ):
+                bounds = _part_bounds(_content_len, parts, min_part_size)
+                with open(path, "wb") as dest:  # noqa: ASYNC230
+                    dest.truncate(_content_len)
+                await _download_parts(
+                    token,
+                    client,
+                    path,
+                    _Resume(
+                        source=source,
+                        url=str(response.url),
+                        validator=_validator(response),
+                        bounds=bounds,
+                        written=[0] * len(bounds),
+                    ),
+                    digest,
+                    chunk_size=chunk_size,
+                    report_hook=report_hook,
+                    on_received=_received,
+                    resumable=resumable,
+                    response=response,
+                )
+                return digest.hexdigest(), received
+
+            await _download_stream(
+                token,
+                response,
+                path,
+                digest,
+                chunk_size=chunk_size,
+                report_hook=report_hook,
+                on_received=_received,
+            )
+            return digest.hexdigest(), received
+    except _RangeError as err:
+        # Some servers advertise ranges but return the whole file
+        logger.info("Downloading %s without ranges: %s", source, err)
+
+    _sidecar(path).unlink(missing_ok=True)
+    digest = hashlib.new(algorithm)
+    async with client.stream(
+        "GET", source, headers={"Accept-Encoding": ""}
+    ) as response:
+        await _download_stream(
+            token,
+            response,
+            path,
+            digest,
+            chunk_size=chunk_size,
+            report_hook=report_hook,
+            on_received=_received,
         )
+    return digest.hexdigest(), received
 
-        chunk_iter = response.iter_bytes(chunk_size)
-        with contextlib.suppress(StopIteration):
-            while token.is_cancelled() is False:
-                dest.write(next(chunk_iter))
-                if callable(report_hook):
-                    report_hook(response.num_bytes_downloaded, _content_len)
 
-        _path = Path(dest.name)
-        if is_token_cancelled(token) and _path.exists():
-            _path.unlink()
-            raise token.get_error()
+async def _download_stream(
+    token: CancellationToken,
+    response: httpx.Response,
+    path: Path,
+    digest: hashlib._Hash,
+    *,
+    chunk_size: int | None,
+    report_hook: Callable[[int, int], Any] | None,
+    on_received: Callable[[int], Any],
+) -> None:
+    _content_len = (
+        int(response.headers["Content-Length"])
+        if "Content-Length" in response.headers
+        else -1
+    )
+    with open(path, "wb") as dest:  # noqa: ASYNC230
+        async for chunk in response.aiter_bytes(chunk_size):
+            if token.is_cancelled():
+                break
+            dest.write(chunk)
+            digest.update(chunk)
+            on_received(len(chunk))
+            if callable(report_hook):
+                report_hook(response.num_bytes_downloaded, _content_len)
+
+
+async def _download_parts(
+    token: CancellationToken,
+    client: httpx.AsyncClient,
+    path: Path,
+    resume: _Resume,
+    digest: hashlib._Hash,
+    *,
+    chunk_size: int | None,
+    report_hook: Callable[[int, int], Any] | None,
+    resumable: bool,
+    on_received: Callable[[int], Any],
+    response: httpx.Response | None = None,
+) -> None:
+    bounds, written = resume.bounds, resume.written
+    size = bounds[-1][1]
+    hashed = 0
+    saved = time.monotonic()
+
+    def _save() -> None:
+        # Without a validator, a changed file could not be detected
+        if resumable and resume.validator is not None:
+            _save_resume(path, resume)
+
+    with open(path, "rb", buffering=0) as reader:  # noqa: ASYNC230
+
+        def _hash_written() -> None:
+            # The digest follows the bytes written contiguously from the
+            # start of the file, which are read back while in the page cache.
+            nonlocal hashed
+            for index, (start, end) in enumerate(bounds):
+                if hashed >= end:
+                    continue
+                available = start + written[index]
+                while hashed < available:
+                    reader.seek(hashed)
+                    data = reader.read(min(available - hashed, _HASH_CHUNK_SIZE))
+                    digest.update(data)
+                    hashed += len(data)
+                if available < end:
+                    return
+
+        async def _write(index: int, response_: httpx.Response) -> None:
+            nonlocal saved
+            start, end = bounds[index]
+            with open(path, "r+b", buffering=0) as dest:  # noqa: ASYNC230
+                dest.seek(start + written[index])
+                async for chunk in response_.aiter_bytes(chunk_size):
+                    if token.is_cancelled():
+                        return
+                    # The first part is read from a response for the whole file
+                    on_received(len(chunk))
+                    data = chunk[: end - start - written[index]]
+                    dest.write(data)
+                    written[index] += len(data)
+                    _hash_written()
+                    if callable(report_hook):
+                        report_hook(sum(written), size)
+                    if time.monotonic() - saved >= _SAVE_INTERVAL:
+                        saved = time.monotonic()
+                        _save()
+                    if written[index] == end - start:
+                        break
+
+            if written[index] != end - start:
+                msg = f"Server returned less than the range of {resume.url}"
+                raise ValueError(msg)
+
+        async def _fetch(index: int) -> None:
+            start, end = bounds[index]
+            if written[index] == end - start:
+                return
+            if index == 0 and response is not None:
+                await _write(index, response)
+                return
+
+            headers = {
+                "Accept-Encoding": "",
+                "Range": f"bytes={start + written[index]}-{end - 1}",
+            }
+            if resume.validator is not None:
+                headers["If-Range"] = resume.validator
+            async with client.stream("GET", resume.url, headers=headers) as response_:
+                if response_.status_code != 206:
+                    msg = f"Server did not return the range {headers['Range']}"
+                    raise _RangeError(msg)
+                await _write(index, response_)
+
+        _hash_written()
+        # The first error cancels the other parts
+        tasks = [asyncio.ensure_future(_fetch(index)) for index in range(len(bounds))]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            _save()
+
+
+def _part_bounds(size: int, parts: int, min_part_size: int) -> list[tuple[int, int]]:
+    count = max(min(parts, size // max(min_part_size, 1)), 1)
+    return [
+        (size * index // count, size * (index + 1) // count) for index in range(count)
+    ]
+
+
+def _validator(response: httpx.Response) -> str | None:
+    # Weak entity tags can not be used in If-Range
+    etag = response.headers.get("ETag")
+    if etag is not None and not etag.startswith("W/"):
+        return etag
+    return response.headers.get("Last-Modified")
+
+
+@contextlib.contextmanager
+def _partial_file(partial: Path | None) -> Iterator[tuple[Path, bool]]:
+    # Partial downloads are locked, another process downloading the same file
+    # at the same time uses a temporary file instead.
+    if partial is not None and sys.platform != "win32":
+        import fcntl
+
+        partial.parent.mkdir(parents=True, exist_ok=True)
+        with open(partial, "ab") as lock:
+            try:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                pass
+            else:
+                yield partial, True
+                return
+
+    dest = tempfile.NamedTemporaryFile(delete=False)  # noqa: SIM115
+    dest.close()
+    yield Path(dest.name), False
+
+
+def _sidecar(path: Path) -> Path:
+    return path.with_name(f"{path.name}.json")
+
+
+def _load_resume(path: Path, source: str) -> _Resume | None:
+    try:
+        data = json.loads(_sidecar(path).read_text(encoding="utf-8"))
+        resume = _Resume(
+            source=data["source"],
+            url=data["url"],
+            validator=data["validator"],
+            bounds=[(start, end) for start, end in data["bounds"]],
+            written=list(data["written"]),
+        )
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+    if (
+        resume.source != source
+        or len(resume.bounds) != len(resume.written)
+        or len(resume.bounds) == 0
+        or path.stat().st_size != resume.bounds[-1][1]
+    ):
+        return None
+    return resume
+
+
+def _save_resume(path: Path, resume: _Resume) -> None:
+    sidecar = _sidecar(path)
+    temp = sidecar.with_name(f".{sidecar.name}.{uuid.uuid4().hex}")
+    temp.write_text(json.dumps(asdict(resume)), encoding="utf-8")
+    os.replace(temp, sidecar)
+
 
-        return _path
+def file_digest(algorithm: str, path: Path) -> str:
+    # Read in chunks, the memory used does not depend on the size of the file
+    with open(path, "rb") as src:
+        return hashlib.file_digest(src, algorithm).hexdigest()
 
 
 class EtaCalculator:
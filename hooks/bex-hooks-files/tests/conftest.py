@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import TYPE_CHECKING
+
+import pytest
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+
+_CHUNK_SIZE = 16 * 1024
+
+
+@dataclass
+class RangeServer:
+    # Serves `content` with ranges, `If-Range` and a strong ETag. Responses
+    # for the whole file wait `delay` seconds between chunks, so that the
+    # ranges of a download complete before its first part.
+    url: str
+    content: bytes
+    etag: str = '"v1"'
+    ignore_ranges: bool = False
+    delay: float = 0.0
+    requests: list[dict[str, str]] = field(default_factory=list)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: _Server
+
+    def do_GET(self) -> None:
+        state = self.server.state
+        state.requests.append(dict(self.headers))
+
+        content, status = state.content, 200
+        range_ = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        if (
+            range_ is not None
+            and not state.ignore_ranges
+            and if_range in (None, state.etag)
+        ):
+            start, end = (int(value) for value in range_[6:].split("-"))
+            content, status = content[start : end + 1], 206
+
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(content)))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", state.etag)
+        if status == 206:
+            self.send_header(
+                "Content-Range",
+                f"bytes {start}-{start + len(content) - 1}/{len(state.content)}",
+            )
+        self.end_headers()
+
+        try:
+            for offset in range(0, len(content), _CHUNK_SIZE):
+                if status == 200 and state.delay > 0:
+                    time.sleep(state.delay)
+                self.wfile.write(content[offset : offset + _CHUNK_SIZE])
+        except ConnectionError:
+            # The client cancelled the download
+            self.close_connection = True
+
+    def log_message(self, format: str, *args: object) -> None:
+        pass
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    state: RangeServer
+
+
+@pytest.fixture
+def range_server() -> Iterator[RangeServer]:
+    server = _Server(("127.0.0.1", 0), _Handler)
+    server.state = RangeServer(
+        url=f"http://127.0.0.1:{server.server_address[1]}/file",
+        content=bytes(range(256)) * 4096,
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server.state
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+from typing import TYPE_CHECKING, Any
+
+import pytest
+from stdlibx.cancel import (
+    CancellationTokenCancelledError,
+    default_token,
+    with_cancel,
+)
+
+from bex_hooks.hooks.files.utils import _part_bounds, _sidecar, download_file
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+    from tests.conftest import RangeServer
+
+# 1 MiB files are split in 4 ranges
+_PARTS = {"parts": 4, "min_part_size": 256 * 1024}
+
+
+def _download(server: RangeServer, **kwargs: Any) -> tuple[Path, str, int]:
+    kwargs.setdefault("token", default_token())
+    return asyncio.run(download_file(source=server.url, **_PARTS, **kwargs))
+
+
+def _ranges(server: RangeServer) -> list[str | None]:
+    return [request.get("Range") for request in server.requests]
+
+
+def test_part_bounds():
+    assert _part_bounds(10, 4, 2) == [(0, 2), (2, 5), (5, 7), (7, 10)]
+    assert _part_bounds(10, 4, 4) == [(0, 5), (5, 10)]
+    assert _part_bounds(10, 4, 20) == [(0, 10)]
+    assert _part_bounds(0, 4, 1) == [(0, 0)]
+
+
+def test_ranges_written_out_of_order(range_server: RangeServer):
+    # The first part is the slowest, the digest still follows the file order
+    range_server.delay = 0.01
+
+    path, digest, received = _download(range_server)
+
+    assert path.read_bytes() == range_server.content
+    assert digest == hashlib.sha256(range_server.content).hexdigest()
+    assert received >= len(range_server.content)
+    # The remaining ranges are requested concurrently, in any order
+    ranges = _ranges(range_server)
+    assert ranges[0] is None
+    assert sorted(ranges[1:]) == [
+        "bytes=262144-524287",
+        "bytes=524288-786431",
+        "bytes=786432-1048575",
+    ]
+
+
+def test_small_files_are_not_split(range_server: RangeServer):
+    range_server.content = range_server.content[: 256 * 1024]
+
+    _, digest, _ = _download(range_server)
+
+    assert digest == hashlib.sha256(range_server.content).hexdigest()
+    assert _ranges(range_server) == [None]
+
+
+def test_server_ignoring_ranges(range_server: RangeServer):
+    range_server.ignore_ranges = True
+
+    path, digest, _ = _download(range_server)
+
+    assert path.read_bytes() == range_server.content
+    assert digest == hashlib.sha256(range_server.content).hexdigest()
+    # The whole file, the ranges answered with it, then a single stream
+    assert _ranges(range_server)[-1] is None
+
+
+def _cancelled_download(server: RangeServer, partial: Path) -> None:
+    server.delay = 0.02
+    token, cancel = with_cancel(default_token())
+    with pytest.raises(CancellationTokenCancelledError):
+        _download(
+            server,
+            token=token,
+            partial=partial,
+            report_hook=lambda completed, total: cancel(),
+        )
+    server.delay = 0.0
+
+
+def test_cancellation_keeps_partial_download(range_server: RangeServer, tmp_path: Path):
+    partial = tmp_path / "partial"
+    _cancelled_download(range_server, partial)
+
+    assert partial.is_file()
+    assert _sidecar(partial).is_file()
+
+
+def test_cancellation_without_partial_removes_file(
+    range_server: RangeServer, tmp_path: Path
+):
+    range_server.delay = 0.02
+    token, cancel = with_cancel(default_token())
+    paths: list[Path] = []
+
+    async def _run() -> None:
+        task = asyncio.ensure_future(download_file(token, range_server.url, **_PARTS))
+        while len(range_server.requests) == 0:
+            await asyncio.sleep(0.01)
+        cancel()
+        with pytest.raises(CancellationTokenCancelledError):
+            paths.append((await task)[0])
+
+    asyncio.run(_run())
+    assert paths == []
+
+
+def test_resume_requests_missing_bytes(range_server: RangeServer, tmp_path: Path):
+    partial = tmp_path / "partial"
+    _cancelled_download(range_server, partial)
+    requested = len(range_server.requests)
+
+    path, digest, received = _download(range_server, partial=partial)
+
+    assert path.read_bytes() == range_server.content
+    assert digest == hashlib.sha256(range_server.content).hexdigest()
+    assert 0 < received < len(range_server.content)
+    resumed = range_server.requests[requested:]
+    assert len(resumed) > 0
+    assert all(request.get("If-Range") == '"v1"' for request in resumed)
+    assert all(request.get("Range") is not None for request in resumed)
+    assert not _sidecar(partial).exists()
+
+
+def test_resume_restarts_when_file_changed(range_server: RangeServer, tmp_path: Path):
+    partial = tmp_path / "partial"
+    _cancelled_download(range_server, partial)
+    range_server.content = bytes(reversed(range_server.content))
+    range_server.etag = '"v2"'
+    requested = len(range_server.requests)
+
+    path, digest, _ = _download(range_server, partial=partial)
+
+    assert path.read_bytes() == range_server.content
+    assert digest == hashlib.sha256(range_server.content).hexdigest()
+    # A full request follows the range rejected by If-Range
+    assert None in _ranges(range_server)[requested:]
@@ -2,15 +2,60 @@ from __future__ import annotations
 
 from typing import TYPE_CHECKING
 
-from bex_hooks.hooks.python.setup import setup_python
+from bex_hooks.hooks.python.setup import (
+    setup_python,
+    setup_python_environ,
+    setup_python_inputs,
+    setup_python_metadata,
+    setup_python_outputs,
+    setup_python_patterns,
+)
 
 if TYPE_CHECKING:
     from collections.abc import Mapping
 
-    from bex_hooks.hooks.python._interface import HookFunc
+    from bex_hooks.hooks.python._interface import (
+        HookFilesFunc,
+        HookFunc,
+        HookKeysFunc,
+    )
+
+
+# Read by the executor without importing the plugin, keep in sync with get_hooks
+__hooks__ = ("python/setup-python",)
 
 
 def get_hooks() -> Mapping[str, HookFunc]:
     return {
         "python/setup-python": setup_python,
     }
+
+
+def get_hook_inputs() -> Mapping[str, HookFilesFunc]:
+    return {
+        "python/setup-python": setup_python_inputs,
+    }
+
+
+def get_hook_outputs() -> Mapping[str, HookFilesFunc]:
+    return {
+        "python/setup-python": setup_python_outputs,
+    }
+
+
+def get_hook_environ() -> Mapping[str, HookKeysFunc]:
+    return {
+        "python/setup-python": setup_python_environ,
+    }
+
+
+def get_hook_metadata() -> Mapping[str, HookKeysFunc]:
+    return {
+        "python/setup-python": setup_python_metadata,
+    }
+
+
+def get_hook_patterns() -> Mapping[str, HookFilesFunc]:
+    return {
+        "python/setup-python": setup_python_patterns,
+    }
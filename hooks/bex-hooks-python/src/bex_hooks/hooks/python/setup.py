@@ -4,12 +4,18 @@ import datetime as dt
 import glob
 import itertools
 import logging
+import os
 import platform
+import shutil
+import sqlite3
 import stat
 import subprocess
 import sys
 import sysconfig
 import tarfile
+import threading
+import time
+import uuid
 import zipfile
 from collections import defaultdict
 from pathlib import Path
@@ -17,13 +23,14 @@ from string import Template
 from typing import TYPE_CHECKING, Any
 from urllib.parse import urljoin
 
-import httpx
 from pydantic import BaseModel, Field
 
-from bex_hooks.hooks.python._interface import Context
+from bex_hooks.hooks.python._interface import Context, LayeredMapping
+from bex_hooks.hooks.python._store import CacheIndex, cache_dir, materialize
 from bex_hooks.hooks.python.utils import (
     append_path,
     download_file,
+    http_client,
     prepend_path,
     wait_process,
 )
@@ -33,9 +40,22 @@ if TYPE_CHECKING:
 
     from bex_hooks.hooks.python._interface import UI, CancellationToken, ContextLike
 
+# Read by the hook and by uv, the environment created only depends on these
+_ENVIRON_KEYS = ("PATH", "PYTHONPATH", "PYTHONHOME", "UV_*")
+
 _UV_RELEASES_URL = "https://api.github.com/repos/astral-sh/uv/releases"
 _UV_DOWNLOAD_URL = "https://github.com/astral-sh/uv/releases/download/{version}/"
 
+# Binaries of uv installed by this process, by version, so that workflows
+# running in the same process download each version once.
+_uv_binaries: dict[str, Path] = {}
+_uv_locks: defaultdict[str, threading.Lock] = defaultdict(threading.Lock)
+# Latest release of uv with the time it was fetched, a long running process
+# fetches it again after the TTL so that it picks up new releases.
+_UV_LATEST_TTL = 600.0
+_uv_latest: tuple[float, str] | None = None
+_uv_latest_lock = threading.Lock()
+
 
 class _Args(BaseModel):
     version: str
@@ -52,32 +72,19 @@ def setup_python(
 ) -> ContextLike:
     data = _Args.model_validate(args, from_attributes=False)
 
-    bex_dir = Path(ctx.working_dir) / ".bex"
     root_dir = Path(ctx.working_dir) / "python"
     root_dir.mkdir(exist_ok=True)
 
-    uv = _download_uv(token, ui, bex_dir / "cache" / "uv", version=data.uv_version)
+    cache = cache_dir(ctx.working_dir, ctx.environ)
+    uv = _download_uv(token, ui, cache / "uv", version=data.uv_version)
     if uv is None:
         msg = "Failed to download uv"
         raise RuntimeError(msg)
-
-    req_files = list(
-        itertools.chain(
-            *[
-                glob.iglob(
-                    Template(file).substitute(
-                        {
-                            "working_dir": ctx.working_dir,
-                            "metadata": ctx.metadata,
-                            "environ": ctx.environ,
-                        }
-                    ),
-                    recursive=True,
-                )
-                for file in data.requirements_file
-            ]
-        )
+    _touch_cache(
+        CacheIndex(cache), uv, ctx.working_dir, _venv_python_bin(root_dir / ".venv")
     )
+
+    req_files = _requirement_files(data, ctx)
     for file in req_files:
         ui.log("Discovered requirement file: {}".format(file))
 
@@ -99,28 +106,106 @@ def setup_python(
     # Configure PYTHONPATH environment variables
     _python_path = _get_python_path(python_bin)
 
-    _metadata = dict(ctx.metadata)
-    _environ = dict(ctx.environ)
-    _metadata["python_bin"] = str(python_bin)
+    _metadata = {"python_bin": str(python_bin)}
+    _environ: dict[str, str] = {}
+    _removed_environ: set[str] = set()
 
     venv_dir = root_dir / ".venv"
     if data.activate_env is True:
         _environ["VIRTUAL_ENV"] = str(venv_dir)
         _environ["VENV_DIR"] = str(venv_dir)
         _environ["PATH"] = prepend_path(
-            _environ["PATH"],
+            ctx.environ["PATH"],
             str(venv_dir / ("Scripts" if platform.system() == "Windows" else "bin")),
         )
         _environ["VIRTUAL_ENV_PROMPT"] = Path(ctx.working_dir).name
-        if "PYTHONHOME" in _environ:
-            del _environ["PYTHONHOME"]
+        if "PYTHONHOME" in ctx.environ:
+            _removed_environ.add("PYTHONHOME")
 
     if data.set_python_path is True and _python_path:
         _environ["PYTHONPATH"] = append_path(
-            _environ.get("PYTHONPATH", ""), str(Path(_python_path))
+            ctx.environ.get("PYTHONPATH", ""), str(Path(_python_path))
+        )
+
+    return Context(
+        ctx.working_dir,
+        LayeredMapping(ctx.metadata, _metadata),
+        LayeredMapping(ctx.environ, _environ, _removed_environ),
+    )
+
+
+def setup_python_inputs(args: Mapping[str, Any], ctx: ContextLike) -> Iterable[str]:
+    data = _Args.model_validate(args, from_attributes=False)
+    return _requirement_files(data, ctx)
+
+
+def setup_python_patterns(args: Mapping[str, Any], ctx: ContextLike) -> Iterable[str]:
+    data = _Args.model_validate(args, from_attributes=False)
+    return _requirement_patterns(data, ctx)
+
+
+def setup_python_outputs(args: Mapping[str, Any], ctx: ContextLike) -> Iterable[str]:
+    root_dir = Path(ctx.working_dir) / "python"
+    return [
+        str(root_dir / "requirements.txt"),
+        str(root_dir / ".venv" / "pyvenv.cfg"),
+        str(_venv_python_bin(root_dir / ".venv")),
+    ]
+
+
+def setup_python_environ(args: Mapping[str, Any], ctx: ContextLike) -> Iterable[str]:
+    data = _Args.model_validate(args, from_attributes=False)
+    if "environ" in _template_identifiers(data, ctx):
+        return ["*"]
+    return list(_ENVIRON_KEYS)
+
+
+def setup_python_metadata(args: Mapping[str, Any], ctx: ContextLike) -> Iterable[str]:
+    data = _Args.model_validate(args, from_attributes=False)
+    if "metadata" in _template_identifiers(data, ctx):
+        return ["*"]
+    return []
+
+
+def _template_identifiers(data: _Args, ctx: ContextLike) -> set[str]:
+    # Templates substitute the whole metadata or environment
+    templates = [data.requirements, *data.requirements_file]
+    templates.extend(Path(file).read_text() for file in _requirement_files(data, ctx))
+    return {
+        name for template in templates for name in Template(template).get_identifiers()
+    }
+
+
+def _requirement_files(data: _Args, ctx: ContextLike) -> list[str]:
+    return list(
+        itertools.chain(
+            *[
+                glob.iglob(pattern, recursive=True)
+                for pattern in _requirement_patterns(data, ctx)
+            ]
+        )
+    )
+
+
+def _requirement_patterns(data: _Args, ctx: ContextLike) -> list[str]:
+    return [
+        Template(file).substitute(
+            {
+                "working_dir": ctx.working_dir,
+                "metadata": ctx.metadata,
+                "environ": ctx.environ,
+            }
         )
+        for file in data.requirements_file
+    ]
+
 
-    return Context(ctx.working_dir, _metadata, _environ)
+def _venv_python_bin(venv_dir: Path) -> Path:
+    return (
+        venv_dir
+        / ("Scripts" if platform.system() == "Windows" else "bin")
+        / ("python.exe" if platform.system() == "Windows" else "python")
+    )
 
 
 def _create_isolated_environment(
@@ -139,28 +224,30 @@ def _create_isolated_environment(
     venv_dir = root_dir / ".venv"
     requirements_in = root_dir / "requirements.in"
     requirements_txt = root_dir / "requirements.txt"
-    python_bin = (
-        venv_dir
-        / ("Scripts" if platform.system() == "Windows" else "bin")
-        / ("python.exe" if platform.system() == "Windows" else "python")
-    )
+    python_bin = _venv_python_bin(venv_dir)
+    # uv runs with the environment of the workflow rather than the one of
+    # this process, which a server or a batch shares between workflows
+    environ = dict(ctx.environ)
     with ui.scope("[not dim]Updating virtual environment[/not dim]"):
-        create_venc_rc = wait_process(
-            token,
-            [
-                str(uv_bin),
-                "venv",
-                "--allow-existing",
-                "--no-project",
-                "--seed",
-                "--python",
-                python_specifier,
-                "--python-preference",
-                "only-managed",
-                str(venv_dir),
-            ],
-            callback=logger.debug,
-        )
+        with ui.span("uv venv"):
+            create_venc_rc = wait_process(
+                token,
+                [
+                    str(uv_bin),
+                    "venv",
+                    "--allow-existing",
+                    "--no-project",
+                    "--seed",
+                    "--python",
+                    python_specifier,
+                    "--python-preference",
+                    "only-managed",
+                    str(venv_dir),
+                ],
+                callback=logger.debug,
+                ui=ui,
+                env=environ,
+            )
         if create_venc_rc != 0:
             return None
 
@@ -182,42 +269,48 @@ def _create_isolated_environment(
             .encode("utf-8")
         )
 
-        lock_pip_requirements_rc = wait_process(
-            token,
-            [
-                str(uv_bin),
-                "pip",
-                "compile",
-                "--python",
-                str(python_bin),
-                "--emit-index-url",
-                str(requirements_in),
-                "-o",
-                str(requirements_txt),
-            ],
-            callback=logger.debug,
-        )
+        with ui.span("uv pip compile"):
+            lock_pip_requirements_rc = wait_process(
+                token,
+                [
+                    str(uv_bin),
+                    "pip",
+                    "compile",
+                    "--python",
+                    str(python_bin),
+                    "--emit-index-url",
+                    str(requirements_in),
+                    "-o",
+                    str(requirements_txt),
+                ],
+                callback=logger.debug,
+                ui=ui,
+                env=environ,
+            )
         if lock_pip_requirements_rc != 0:
             return None
 
         logger.info("Locked dependencies")
 
-        sync_pip_requirements_rc = wait_process(
-            token,
-            [
-                str(uv_bin),
-                "pip",
-                "install",
-                "--python",
-                str(python_bin),
-            ]
-            + (["--exact"] if inexact is False else [])
-            + [
-                "-r",
-                str(requirements_txt),
-            ],
-            callback=logger.debug,
-        )
+        with ui.span("uv pip install"):
+            sync_pip_requirements_rc = wait_process(
+                token,
+                [
+                    str(uv_bin),
+                    "pip",
+                    "install",
+                    "--python",
+                    str(python_bin),
+                ]
+                + (["--exact"] if inexact is False else [])
+                + [
+                    "-r",
+                    str(requirements_txt),
+                ],
+                callback=logger.debug,
+                ui=ui,
+                env=environ,
+            )
         if sync_pip_requirements_rc != 0:
             return None
 
@@ -242,16 +335,31 @@ def _download_uv(
 
     logger.info("Resolved uv version to %s", version)
 
+    with _uv_locks[version]:
+        uv_bin = _install_uv(token, ui, directory, version)
+        if uv_bin is not None:
+            _uv_binaries[version] = uv_bin
+        return uv_bin
+
+
+def _install_uv(token: CancellationToken, ui: UI, directory: Path, version: str):
     exe = ".exe" if sys.platform == "win32" else ""
     uv_bin = directory / f"uv-{version}{exe}"
     if uv_bin.exists():
         return uv_bin
 
+    installed = _uv_binaries.get(version)
+    if installed is not None and installed.is_file():
+        # Binaries are never written to, the installs can share one file
+        materialize(installed, uv_bin, hardlink=True)
+        uv_bin.chmod(uv_bin.stat().st_mode | stat.S_IXUSR)
+        return uv_bin
+
     filename, target = _get_uv_release_info()
     if filename is None or target is None:
         return None
 
-    with ui.progress() as pb:
+    with ui.span("download uv", version=version), ui.progress() as pb:
         task_id = pb.add_task(f"Downloading uv {version}")
         temp_filename = download_file(
             token,
@@ -260,15 +368,20 @@ def _download_uv(
                 task_id, total=total, completed=curr
             ),
         )
+    ui.metric("downloaded_bytes", temp_filename.stat().st_size)
 
+    # Extracted next to the binary then renamed, the directory may be shared
+    # with other processes through BEX_CACHE_DIR.
+    directory.mkdir(parents=True, exist_ok=True)
+    temp_bin = uv_bin.with_name(f".{uv_bin.name}.{uuid.uuid4().hex}")
     try:
         if filename.endswith(".zip"):
             with (
                 zipfile.ZipFile(temp_filename, "r") as archive,
                 archive.open(archive.getinfo(f"uv{exe}")) as source,
-                open(uv_bin, "wb") as target_file,
+                open(temp_bin, "wb") as target_file,
             ):
-                target_file.write(source.read())
+                shutil.copyfileobj(source, target_file)
         else:
             with tarfile.open(temp_filename, "r:gz") as archive:
                 source = archive.extractfile(f"{target}/uv{exe}")
@@ -278,18 +391,29 @@ def _download_uv(
 
                 with (
                     source,
-                    open(uv_bin, "wb") as target_file,
+                    open(temp_bin, "wb") as target_file,
                 ):
-                    target_file.write(source.read())
+                    shutil.copyfileobj(source, target_file)
 
-        uv_bin.chmod(uv_bin.stat().st_mode | stat.S_IXUSR)
+        temp_bin.chmod(temp_bin.stat().st_mode | stat.S_IXUSR)
+        os.replace(temp_bin, uv_bin)
         return uv_bin
     finally:
+        temp_bin.unlink(missing_ok=True)
         _path = Path(temp_filename)
         if _path.exists():
             _path.unlink()
 
 
+def _touch_cache(index: CacheIndex, path: Path, workflow: str, target: Path) -> None:
+    try:
+        index.touch(path, workflow=workflow, target=target)
+    except (OSError, sqlite3.Error) as err:
+        logging.getLogger("bex_hooks.hooks.python").warning(
+            "Failed to update the cache index: %s", err
+        )
+
+
 def _get_python_path(python_bin: Path):
     try:
         _output = subprocess.check_output(
@@ -311,7 +435,21 @@ def _get_python_path(python_bin: Path):
 
 
 def _get_uv_latest_version() -> str | None:
-    response = httpx.get(_UV_RELEASES_URL).json()
+    global _uv_latest
+    with _uv_latest_lock:
+        if _uv_latest is not None and (
+            time.monotonic() - _uv_latest[0] < _UV_LATEST_TTL
+        ):
+            return _uv_latest[1]
+
+        version = _fetch_uv_latest_version()
+        if version is not None:
+            _uv_latest = (time.monotonic(), version)
+        return version
+
+
+def _fetch_uv_latest_version() -> str | None:
+    response = http_client().get(_UV_RELEASES_URL).json()
     releases = (
         (entry["name"], dt.datetime.fromisoformat(entry["published_at"]))
         for entry in response
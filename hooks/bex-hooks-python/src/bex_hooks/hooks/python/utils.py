@@ -2,9 +2,11 @@ from __future__ import annotations
 
 import contextlib
 import datetime as dt
+import os
 import platform
 import subprocess
 import tempfile
+import threading
 from pathlib import Path
 from typing import TYPE_CHECKING, Any
 
@@ -18,7 +20,7 @@ from bex_hooks.hooks.python._interface import is_token_cancelled
 if TYPE_CHECKING:
     from collections.abc import Callable, Sequence
 
-    from bex_hooks.hooks.python._interface import CancellationToken
+    from bex_hooks.hooks.python._interface import UI, CancellationToken
 
 
 def append_path(previous: str, *values: str) -> str:
@@ -39,6 +41,20 @@ def prepend_path(previous: str, *values: str) -> str:
     return path_sep.join([value for value in previous_path if len(value) > 0])
 
 
+_client: httpx.Client | None = None
+_client_lock = threading.Lock()
+
+
+def http_client() -> httpx.Client:
+    # Shared by the hooks of every workflow running in the process, so that
+    # they reuse connections.
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = httpx.Client(follow_redirects=True)
+        return _client
+
+
 def download_file(
     token: CancellationToken,
     source: str,
@@ -48,8 +64,8 @@ def download_file(
 ) -> Path:
     with (
         tempfile.NamedTemporaryFile(delete=False) as dest,
-        httpx.stream(
-            "GET", source, follow_redirects=True, headers={"Accept-Encoding": ""}
+        http_client().stream(
+            "GET", source, headers={"Accept-Encoding": ""}
         ) as response,
     ):
         _content_len = (
@@ -58,12 +74,30 @@ def download_file(
             else -1
         )
 
+        # Closing the response interrupts a read waiting for the server, so
+        # that timeouts do not wait for the next chunk. Tokens can not
+        # unregister callbacks, the hook's token would keep every response
+        # downloaded with it, so the callback only holds the current one.
+        downloading = [response]
+
+        def _close(_: Exception) -> None:
+            for item in downloading:
+                item.close()
+
+        token.register(_close)
+
         chunk_iter = response.iter_bytes(chunk_size)
-        with contextlib.suppress(StopIteration):
-            while token.is_cancelled() is False:
-                dest.write(next(chunk_iter))
-                if callable(report_hook):
-                    report_hook(response.num_bytes_downloaded, _content_len)
+        try:
+            with contextlib.suppress(StopIteration):
+                while token.is_cancelled() is False:
+                    dest.write(next(chunk_iter))
+                    if callable(report_hook):
+                        report_hook(response.num_bytes_downloaded, _content_len)
+        except httpx.HTTPError:
+            if not token.is_cancelled():
+                raise
+        finally:
+            downloading.clear()
 
         _path = Path(dest.name)
         if is_token_cancelled(token) and _path.exists():
@@ -79,9 +113,12 @@ def wait_process(
     /,
     *,
     callback: Callable[[str], Any] | None = None,
-    timeout: float | None = None,
+    timeout: float | None = 10,
+    ui: UI | None = None,
     **kwargs,
 ) -> int:
+    # With `ui`, the CPU time of the process and of the processes it waited
+    # for is reported as the `cpu_time` metric.
     class _ProcessEndedError(Exception): ...
 
     process = subprocess.Popen(
@@ -93,27 +130,34 @@ def wait_process(
         **kwargs,
     )
 
+    def _kill_process():
+        if _is_running(process):
+            process.kill()
+
     def _terminate_process(_: Exception | None):
-        if process.poll() is not None:
+        if not _is_running(process):
             return
 
+        # The process is killed if it does not exit in time, without blocking
+        # the thread that cancelled the token.
         process.terminate()
-        try:
-            process.wait(timeout=timeout)
-        except subprocess.TimeoutExpired:
-            process.kill()
-            process.wait()
+        if timeout is not None:
+            killer = threading.Timer(timeout, _kill_process)
+            killer.daemon = True
+            killer.start()
 
     token.register(_terminate_process)
+    if token.is_cancelled():
+        _terminate_process(None)
 
     while True:
         _result = flow(
             option.maybe(lambda: process.stdout),
             option.map_or_else(
-                lambda: result.ok("\n") if process.poll() is None else result.ok(""),
+                lambda: result.ok("\n") if _is_running(process) else result.ok(""),
                 result.safe(
                     lambda stdout: (
-                        stdout.readline() or "\n" if process.poll() is None else ""
+                        stdout.readline() or "\n" if _is_running(process) else ""
                     )
                 ),
             ),
@@ -131,11 +175,41 @@ def wait_process(
             case Ok(line) if callback is not None:
                 callback(line)
             case Error(_ProcessEndedError()):
+                returncode = _reap_process(process, ui)
                 token.raise_if_cancelled()
-                return process.poll()  # type: ignore
+                return returncode
             case Error():
                 _terminate_process(None)
-                return process.poll()  # type: ignore
+                return _reap_process(process, ui)
+
+
+def _is_running(process: subprocess.Popen[str]) -> bool:
+    # The process is not reaped, so that its resource usage can be read
+    if process.returncode is not None or not hasattr(os, "waitid"):
+        return process.poll() is None
+    try:
+        return (
+            os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT)
+            is None
+        )
+    except ChildProcessError:
+        return process.poll() is None
+
+
+def _reap_process(process: subprocess.Popen[str], ui: UI | None) -> int:
+    # Measured for this process only, RUSAGE_CHILDREN would include the
+    # processes of the other hooks running in parallel.
+    if process.returncode is None and hasattr(os, "wait4"):
+        try:
+            _, status, usage = os.wait4(process.pid, 0)
+        except ChildProcessError:
+            # Reaped by Popen, when the process was cancelled
+            pass
+        else:
+            process.returncode = os.waitstatus_to_exitcode(status)
+            if ui is not None:
+                ui.metric("cpu_time", usage.ru_utime + usage.ru_stime)
+    return process.wait()
 
 
 class EtaCalculator:
@@ -0,0 +1,168 @@
+from __future__ import annotations
+
+import hashlib
+import re
+import shutil
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Literal
+
+from stdlibx import result
+
+from bex_hooks.exec._store import CacheEntry
+from bex_hooks.exec.errors import BexExecError
+
+if TYPE_CHECKING:
+    from collections.abc import Mapping
+    from pathlib import Path
+
+    from stdlibx.result.types import Result
+
+    from bex_hooks.exec._store import CacheIndex
+
+DEFAULT_MAX_SIZE = 10 * 1024**3
+# Interrupted downloads are kept to be resumed, until they were not written
+# to for this long.
+PARTIAL_MAX_AGE = 7 * 24 * 60 * 60
+
+Problem = Literal["missing", "size", "digest", "untracked"]
+
+_SIZE_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+_SIZE_PATTERN = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$", re.IGNORECASE)
+
+
+@dataclass(frozen=True)
+class CacheProblem:
+    entry: CacheEntry
+    problem: Problem
+
+
+def cache_limit(environ: Mapping[str, str]) -> Result[int, Exception]:
+    value = environ.get("BEX_CACHE_MAX_SIZE", "")
+    if len(value) == 0:
+        return result.ok(DEFAULT_MAX_SIZE)
+    return parse_size(value)
+
+
+def parse_size(value: str) -> Result[int, Exception]:
+    match _SIZE_PATTERN.match(value):
+        case None:
+            return result.error(BexExecError(f"Invalid size: '{value}'"))
+        case matched:
+            return result.ok(int(float(matched[1]) * _SIZE_UNITS[matched[2].upper()]))
+
+
+def format_size(size: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            return f"{size:.0f}{unit}" if unit == "B" else f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}TiB"
+
+
+def collect(
+    index: CacheIndex, max_size: int, *, before: float | None = None
+) -> Result[list[CacheEntry], Exception]:
+    # Evicts the least recently used entries until the cache fits, entries
+    # used since `before` are kept, e.g. the ones of the current workflow.
+    def _collect() -> list[CacheEntry]:
+        evicted = _collect_partial(index.root)
+        if not index.exists():
+            return evicted
+
+        size = index.size()
+        if size <= max_size:
+            return evicted
+
+        for entry in index.entries():
+            if size <= max_size or (before is not None and entry.accessed >= before):
+                break
+            _remove(index.root / entry.path)
+            evicted.append(entry)
+            size -= entry.size
+        index.remove(entry.path for entry in evicted)
+        return evicted
+
+    return result.try_(_collect)
+
+
+def verify(index: CacheIndex) -> Result[list[CacheProblem], Exception]:
+    # Entries whose file is missing or was modified are removed, files of the
+    # store which are not in the index are added to it.
+    def _verify() -> list[CacheProblem]:
+        problems: list[CacheProblem] = []
+        entries = index.entries()
+        for entry in entries:
+            path = index.root / entry.path
+            if not path.exists():
+                problems.append(CacheProblem(entry, "missing"))
+            elif path.is_file() and path.stat().st_size != entry.size:
+                problems.append(CacheProblem(entry, "size"))
+            elif _stored_digest(index.root, path) not in (None, path.name):
+                problems.append(CacheProblem(entry, "digest"))
+
+        for problem in problems:
+            _remove(index.root / problem.entry.path)
+        index.remove(problem.entry.path for problem in problems)
+
+        indexed = {entry.path for entry in entries}
+        for path in sorted((index.root / "files").glob("*/*")):
+            name = path.relative_to(index.root).as_posix()
+            if name in indexed or not path.is_file() or path.name.startswith("."):
+                continue
+            if _stored_digest(index.root, path) != path.name:
+                _remove(path)
+                problems.append(
+                    CacheProblem(CacheEntry(name, 0, 0, frozenset()), "digest")
+                )
+                continue
+            index.touch(path)
+            problems.append(
+                CacheProblem(
+                    CacheEntry(name, path.stat().st_size, 0, frozenset()), "untracked"
+                )
+            )
+        return problems
+
+    return result.try_(_verify)
+
+
+def _collect_partial(root: Path) -> list[CacheEntry]:
+    # Partial downloads are not in the index, they are only written by the
+    # hook downloading them.
+    expired = time.time() - PARTIAL_MAX_AGE
+    evicted: list[CacheEntry] = []
+    for path in sorted((root / "partial").glob("*/*")):
+        try:
+            _stat = path.stat()
+        except FileNotFoundError:
+            continue
+        if not path.is_file() or _stat.st_mtime >= expired:
+            continue
+        path.unlink(missing_ok=True)
+        evicted.append(
+            CacheEntry(
+                path.relative_to(root).as_posix(),
+                _stat.st_size,
+                _stat.st_mtime,
+                frozenset(),
+            )
+        )
+    return evicted
+
+
+def _stored_digest(root: Path, path: Path) -> str | None:
+    # Only the files of the content-addressed store can be verified
+    parts = path.relative_to(root).parts
+    if len(parts) != 3 or parts[0] != "files":
+        return None
+
+    with open(path, "rb") as src:
+        return hashlib.file_digest(src, parts[1]).hexdigest()
+
+
+def _remove(path: Path) -> None:
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        path.unlink(missing_ok=True)
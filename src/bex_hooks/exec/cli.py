@@ -6,24 +6,33 @@ import os
 import signal
 import subprocess
 import sys
+from enum import Enum
 from pathlib import Path
-from typing import TYPE_CHECKING, Annotated
+from typing import TYPE_CHECKING, Annotated, Any
 
-import shellingham
 import typer
 from rich.console import Console
-from rich.traceback import Traceback
 from stdlibx import result
-from stdlibx.cancel import CancellationTokenCancelledError, default_token, with_cancel
+from stdlibx.cancel import (
+    CancellationTokenCancelledError,
+    CancellationTokenTimeoutError,
+    default_token,
+    with_cancel,
+    with_timeout,
+)
 from stdlibx.compose import flow
 from stdlibx.result.types import Error, Ok
 
-from bex_hooks.exec.config import load_config
-from bex_hooks.exec.executor import execute
-from bex_hooks.exec.ui import CliUI
+from bex_hooks.exec.errors import BexTimeoutError
 
 if TYPE_CHECKING:
-    from bex_hooks.exec._interface import ContextLike
+    from stdlibx.cancel import CancellationToken
+    from stdlibx.result.types import Result
+
+    from bex_hooks.exec._interface import UI, ContextLike
+    from bex_hooks.exec._store import CacheIndex
+    from bex_hooks.exec.config import Environment
+    from bex_hooks.exec.trace import Tracer
 
 
 class _FormatCommandError(Exception):
@@ -33,7 +42,36 @@ class _FormatCommandError(Exception):
         self.value = value
 
 
+class _UIKind(str, Enum):
+    RICH = "rich"
+    JSON = "json"
+
+
+_TraceOption = Annotated[
+    Path | None,
+    typer.Option(
+        "--trace",
+        file_okay=True,
+        dir_okay=False,
+        writable=True,
+        resolve_path=True,
+        envvar="BEX_TRACE",
+    ),
+]
+
+_DeadlineOption = Annotated[
+    float | None,
+    typer.Option(
+        "--deadline",
+        min=0,
+        envvar="BEX_DEADLINE",
+        help="Seconds after which the running hooks are stopped.",
+    ),
+]
+
 app = typer.Typer(add_completion=False, name="bex")
+cache_app = typer.Typer(help="Inspect and clean the cache of downloaded files.")
+app.add_typer(cache_app, name="cache")
 
 
 def main():
@@ -71,44 +109,182 @@ def callback(
     verbosity: Annotated[
         int, typer.Option("--verbose", "-v", count=True, envvar="BEX_VERBOSITY")
     ] = 0,
+    no_config_cache: Annotated[
+        bool, typer.Option("--no-config-cache", envvar="BEX_NO_CONFIG_CACHE")
+    ] = False,
+    server: Annotated[
+        Path | None,
+        typer.Option(
+            "--server",
+            dir_okay=False,
+            resolve_path=True,
+            envvar="BEX_SERVER",
+            help="Socket of a 'bex exec serve' process to execute workflows.",
+        ),
+    ] = None,
+    ui: Annotated[
+        _UIKind,
+        typer.Option(
+            "--ui",
+            envvar="BEX_UI",
+            help="'json' writes the progress as JSON lines to stderr, e.g. on CI.",
+        ),
+    ] = _UIKind.RICH,
 ):
     ctx.ensure_object(dict)
-    console = Console()
+    ctx.obj["log_level"] = {
+        0: logging.WARN,
+        1: logging.INFO,
+        2: logging.DEBUG,
+    }.get(verbosity, logging.DEBUG)
+    ctx.obj["console"] = Console()
+    ctx.obj["directory"] = Path(os.getcwd()) if directory is None else directory
+    ctx.obj["file"] = file
+    ctx.obj["use_config_cache"] = not no_config_cache
+    ctx.obj["server"] = server
+    ctx.obj["ui"] = ui
 
-    match load_config(Path(os.getcwd()) if directory is None else directory, file):
+
+def _create_ui(ctx: typer.Context, console: Console, tracer: Tracer | None) -> UI:
+    if ctx.obj["ui"] is _UIKind.JSON:
+        from bex_hooks.exec.json_ui import JsonUI
+
+        return JsonUI(sys.stderr, log_level=ctx.obj["log_level"], tracer=tracer)
+
+    from bex_hooks.exec.ui import CliUI
+
+    return CliUI(console, log_level=ctx.obj["log_level"], tracer=tracer)
+
+
+def _load_environment(
+    ctx: typer.Context, ui: UI, tracer: Tracer | None, trace: Path | None
+) -> Environment:
+    from bex_hooks.exec.config import load_config
+
+    console: Console = ctx.obj["console"]
+    with ui.span("load config"):
+        config_result = load_config(
+            ctx.obj["directory"],
+            ctx.obj["file"],
+            use_cache=ctx.obj["use_config_cache"],
+        )
+
+    match config_result:
         case Ok(env):
-            ctx.obj["log_level"] = {
-                0: logging.WARN,
-                1: logging.INFO,
-                2: logging.DEBUG,
-            }.get(verbosity, logging.DEBUG)
-            ctx.obj["console"] = console
-            ctx.obj["env"] = env
+            return env
         case Error(err):
-            console.print("Failed to execute environment", style="red")
-            console.print(
-                Traceback(Traceback.extract(type(err), err, err.__traceback__)),
-                style="dim",
-            )
+            if tracer is not None and trace is not None:
+                tracer.write(trace)
+            console.print("Failed to load environment", style="red")
+            _print_traceback(console, err)
             ctx.exit(1)
 
 
-@app.command(context_settings={"allow_interspersed_args": False})
-def run(ctx: typer.Context, command: list[str]):
-    console: Console = ctx.obj["console"]
+def _execute_environment(
+    ctx: typer.Context, trace: Path | None, deadline: float | None
+) -> Result[ContextLike, Exception]:
+    if ctx.obj["server"] is not None:
+        from bex_hooks.exec.server import document_result
+
+        match _request_environment(ctx, deadline):
+            case Ok(document):
+                return document_result(document)
+            case Error(err):
+                logging.getLogger("bex_hooks.cli").warning(
+                    "Failed to reach the server, executing locally: %s", err
+                )
+
+    if trace is None:
+        match _cached_environment(ctx):
+            case Ok(cached) if cached is not None:
+                # The rich UI is not created, its progress bars are not needed
+                if ctx.obj["ui"] is _UIKind.JSON:
+                    _create_ui(ctx, ctx.obj["console"], None).print(
+                        "Environment is up to date"
+                    )
+                else:
+                    ctx.obj["console"].print("Environment is up to date")
+                return result.ok(cached)
+            case Error(err):
+                logging.getLogger("bex_hooks.cli").warning(
+                    "Failed to load the previous context: %s", err
+                )
+
+    # Imported here so that commands which do not execute the environment,
+    # and the help, do not pay for loading them.
+    from bex_hooks.exec.executor import execute
+    from bex_hooks.exec.trace import Tracer
+
+    tracer = Tracer() if trace is not None else None
+    ui = _create_ui(ctx, ctx.obj["console"], tracer)
+    env = _load_environment(ctx, ui, tracer, trace)
 
     token, cancel = with_cancel(default_token())
     signal.signal(signal.SIGTERM, lambda _, __: cancel())
     signal.signal(signal.SIGINT, lambda _, __: cancel())
+    if deadline is not None:
+        token, _ = with_timeout(token, deadline)
 
-    exec_result = execute(
-        token,
-        CliUI(console, log_level=ctx.obj["log_level"]),
-        {},
-        dict(os.environ),
-        ctx.obj["env"],
+    exec_result = execute(token, ui, {}, dict(os.environ), env)
+    if tracer is not None and trace is not None:
+        tracer.write(trace)
+    return exec_result
+
+
+def _cached_environment(ctx: typer.Context) -> Result[ContextLike | None, Exception]:
+    # Checked before loading the configuration and the executor, which a run
+    # where nothing changed does not need.
+    from bex_hooks.exec.context import initial_context
+    from bex_hooks.exec.plugin import distributions_key
+    from bex_hooks.exec.state import cached_context
+
+    directory: Path = ctx.obj["directory"]
+    file: Path | None = ctx.obj["file"] or next(
+        (
+            directory / name
+            for name in ("bex.yaml", "bex.yml")
+            if (directory / name).is_file()
+        ),
+        None,
+    )
+    if file is None:
+        return result.ok(None)
+
+    return cached_context(
+        directory / ".bex" / "state" / "context.json",
+        file,
+        distributions_key(),
+        initial_context(str(directory), {}, dict(os.environ)),
+    )
+
+
+def _request_environment(
+    ctx: typer.Context, deadline: float | None
+) -> Result[dict[str, Any], Exception]:
+    from bex_hooks.exec.server import request
+
+    return request(
+        ctx.obj["server"],
+        {
+            "directory": str(ctx.obj["directory"]),
+            "file": str(ctx.obj["file"]) if ctx.obj["file"] is not None else None,
+            "environ": dict(os.environ),
+            "use_config_cache": ctx.obj["use_config_cache"],
+            "deadline": deadline,
+        },
     )
 
+
+@app.command(context_settings={"allow_interspersed_args": False})
+def run(
+    ctx: typer.Context,
+    command: list[str],
+    trace: _TraceOption = None,
+    deadline: _DeadlineOption = None,
+):
+    console: Console = ctx.obj["console"]
+    exec_result = _execute_environment(ctx, trace, deadline)
+
     def _format_command(value: ContextLike, cmd: list[str]):
         try:
             return [item.format_map(value.metadata) for item in cmd]
@@ -135,6 +311,12 @@ def run(ctx: typer.Context, command: list[str]):
         case Error(CancellationTokenCancelledError()):
             console.print("Process was cancelled", style="red")
             ctx.exit(3)
+        case Error(BexTimeoutError() as err):
+            console.print(err.msg, style="red")
+            ctx.exit(5)
+        case Error(CancellationTokenTimeoutError()):
+            console.print("Deadline exceeded", style="red")
+            ctx.exit(5)
         case Error(_FormatCommandError() as err):
             console.print(
                 f"Failed to prepare command, '{err.key}' is not in metadata",
@@ -144,32 +326,22 @@ def run(ctx: typer.Context, command: list[str]):
             ctx.exit(4)
         case Error(err):
             console.print("Failed to execute environment", style="red")
-            console.print(
-                Traceback(Traceback.extract(type(err), err, err.__traceback__)),
-                style="dim",
-            )
+            _print_traceback(console, err)
             ctx.exit(2)
 
 
 @app.command()
-def shell(ctx: typer.Context):
+def shell(
+    ctx: typer.Context, trace: _TraceOption = None, deadline: _DeadlineOption = None
+):
     console: Console = ctx.obj["console"]
-
-    token, cancel = with_cancel(default_token())
-    signal.signal(signal.SIGTERM, lambda _, __: cancel())
-    signal.signal(signal.SIGINT, lambda _, __: cancel())
-
-    exec_result = execute(
-        token,
-        CliUI(console, log_level=ctx.obj["log_level"]),
-        {},
-        dict(os.environ),
-        ctx.obj["env"],
-    )
+    exec_result = _execute_environment(ctx, trace, deadline)
 
     match exec_result:
         case Ok(value):
             console.print("Executed environment successfully", style="green")
+            import shellingham
+
             shell, path = shellingham.detect_shell()
             args = []
             if shell in ("powershell", "pwsh"):
@@ -185,30 +357,24 @@ def shell(ctx: typer.Context):
         case Error(CancellationTokenCancelledError()):
             console.print("Process was cancelled", style="red")
             ctx.exit(3)
+        case Error(BexTimeoutError() as err):
+            console.print(err.msg, style="red")
+            ctx.exit(5)
+        case Error(CancellationTokenTimeoutError()):
+            console.print("Deadline exceeded", style="red")
+            ctx.exit(5)
         case Error(err):
             console.print("Failed to execute environment", style="red")
-            console.print(
-                Traceback(Traceback.extract(type(err), err, err.__traceback__)),
-                style="dim",
-            )
+            _print_traceback(console, err)
             ctx.exit(2)
 
 
 @app.command()
-def export(ctx: typer.Context):
+def export(
+    ctx: typer.Context, trace: _TraceOption = None, deadline: _DeadlineOption = None
+):
     console: Console = ctx.obj["console"]
-
-    token, cancel = with_cancel(default_token())
-    signal.signal(signal.SIGTERM, lambda _, __: cancel())
-    signal.signal(signal.SIGINT, lambda _, __: cancel())
-
-    exec_result = execute(
-        token,
-        CliUI(console, log_level=ctx.obj["log_level"]),
-        {},
-        dict(os.environ),
-        ctx.obj["env"],
-    )
+    exec_result = _execute_environment(ctx, trace, deadline)
 
     match exec_result:
         case Ok(value):
@@ -226,10 +392,355 @@ def export(ctx: typer.Context):
         case Error(CancellationTokenCancelledError()):
             console.print("Process was cancelled", style="red")
             ctx.exit(3)
+        case Error(BexTimeoutError() as err):
+            console.print(err.msg, style="red")
+            ctx.exit(5)
+        case Error(CancellationTokenTimeoutError()):
+            console.print("Deadline exceeded", style="red")
+            ctx.exit(5)
         case Error(err):
             console.print("Failed to execute environment", style="red")
+            _print_traceback(console, err)
+            ctx.exit(2)
+
+
+@app.command()
+def watch(
+    ctx: typer.Context,
+    interval: Annotated[
+        float, typer.Option(min=0.05, help="Seconds between checks for changes.")
+    ] = 0.5,
+    debounce: Annotated[
+        float, typer.Option(min=0, help="Seconds without changes before running.")
+    ] = 0.2,
+):
+    from bex_hooks.exec.config import load_config
+    from bex_hooks.exec.watch import watch as watch_environment
+
+    console: Console = ctx.obj["console"]
+    ui = _create_ui(ctx, console, None)
+
+    token, cancel = with_cancel(default_token())
+    signal.signal(signal.SIGTERM, lambda _, __: cancel())
+    signal.signal(signal.SIGINT, lambda _, __: cancel())
+
+    match watch_environment(
+        token,
+        ui,
+        lambda: load_config(
+            ctx.obj["directory"],
+            ctx.obj["file"],
+            use_cache=ctx.obj["use_config_cache"],
+        ),
+        {},
+        dict(os.environ),
+        interval=interval,
+        debounce=debounce,
+    ):
+        case Ok(_):
+            pass
+        case Error(err):
+            console.print("Failed to load environment", style="red")
+            _print_traceback(console, err)
+            ctx.exit(1)
+
+
+@app.command()
+def batch(
+    ctx: typer.Context,
+    workflows: Annotated[
+        list[str], typer.Argument(help="Workflow files, directories or globs.")
+    ],
+    jobs: Annotated[
+        int | None,
+        typer.Option("--jobs", "-j", min=1, help="Workflows running at once."),
+    ] = None,
+    trace: _TraceOption = None,
+    deadline: _DeadlineOption = None,
+):
+    from concurrent.futures import ThreadPoolExecutor
+
+    from bex_hooks.exec.trace import Tracer
+
+    # Documents are written to stdout, everything else goes to stderr
+    console = Console(stderr=True)
+    tracer = Tracer() if trace is not None else None
+    ui = _create_ui(ctx, console, tracer)
+
+    files = _batch_files(workflows)
+    if len(files) == 0:
+        console.print("No workflow found", style="red")
+        ctx.exit(1)
+
+    token, cancel = with_cancel(default_token())
+    signal.signal(signal.SIGTERM, lambda _, __: cancel())
+    signal.signal(signal.SIGINT, lambda _, __: cancel())
+    if deadline is not None:
+        token, _ = with_timeout(token, deadline)
+
+    failed = False
+    with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="bex-batch") as pool:
+        futures = [
+            pool.submit(_execute_workflow, token, ui, file, ctx.obj["use_config_cache"])
+            for file in files
+        ]
+        # Printed in the order of the files, as soon as each one is done
+        for future in futures:
+            document = future.result()
+            failed |= document["status"] != "success"
+            sys.stdout.write(json.dumps(document) + "\n")
+            sys.stdout.flush()
+
+    if tracer is not None and trace is not None:
+        tracer.write(trace)
+    ctx.exit(2 if failed else 0)
+
+
+def _batch_files(workflows: list[str]) -> list[Path]:
+    import glob
+
+    files: dict[Path, None] = {}
+    for workflow in workflows:
+        for match in sorted(glob.glob(workflow, recursive=True)) or [workflow]:
+            path = Path(match).resolve()
+            if path.is_dir():
+                path = next(
+                    (
+                        candidate
+                        for name in ("bex.yaml", "bex.yml")
+                        if (candidate := path / name).is_file()
+                    ),
+                    path / "bex.yaml",
+                )
+            files[path] = None
+    return list(files)
+
+
+def _execute_workflow(
+    token: CancellationToken, ui: UI, file: Path, use_cache: bool
+) -> dict[str, Any]:
+    from bex_hooks.exec.config import load_config
+    from bex_hooks.exec.executor import execute
+    from bex_hooks.exec.server import result_document
+
+    with ui.span("workflow", file=file):
+        return result_document(
+            file,
+            flow(
+                load_config(file.parent, file, use_cache=use_cache),
+                result.and_then(
+                    lambda env: execute(token, ui, {}, dict(os.environ), env)
+                ),
+            ),
+        )
+
+
+@app.command()
+def serve(
+    ctx: typer.Context,
+    socket: Annotated[
+        Path | None,
+        typer.Option(
+            "--socket",
+            dir_okay=False,
+            resolve_path=True,
+            help="Defaults to .bex/serve.sock in the directory.",
+        ),
+    ] = None,
+):
+    from bex_hooks.exec.server import serve as serve_requests
+
+    console: Console = ctx.obj["console"]
+    ui = _create_ui(ctx, console, None)
+
+    token, cancel = with_cancel(default_token())
+    signal.signal(signal.SIGTERM, lambda _, __: cancel())
+    signal.signal(signal.SIGINT, lambda _, __: cancel())
+
+    path = socket or ctx.obj["directory"] / ".bex" / "serve.sock"
+    match serve_requests(token, ui, path):
+        case Ok(_):
+            pass
+        case Error(err):
+            console.print("Failed to serve", style="red")
+            _print_traceback(console, err)
+            ctx.exit(2)
+
+
+@app.command()
+def plan(ctx: typer.Context):
+    from rich.table import Table
+
+    from bex_hooks.exec.executor import plan as plan_environment
+
+    console: Console = ctx.obj["console"]
+    ui = _create_ui(ctx, console, None)
+    env = _load_environment(ctx, ui, None, None)
+
+    match plan_environment(ui, {}, dict(os.environ), env):
+        case Ok(hooks):
+            table = Table("Hook", "Status", "Estimate", "Critical")
+            for planned in hooks:
+                table.add_row(
+                    planned.hook.name or planned.hook.id,
+                    planned.status,
+                    "?" if planned.estimate is None else f"{planned.estimate:.2f}s",
+                    "*" if planned.critical else "",
+                )
+            console.print(table)
+
+            total = sum(planned.estimate or 0 for planned in hooks if planned.critical)
+            unknown = sum(planned.estimate is None for planned in hooks)
+            console.print(f"Estimated duration: {total:.2f}s")
+            if unknown > 0:
+                console.print(
+                    f"  {unknown} hook(s) never ran and are not estimated",
+                    style="yellow",
+                )
+        case Error(err):
+            console.print("Failed to plan environment", style="red")
+            _print_traceback(console, err)
+            ctx.exit(2)
+
+
+@app.command()
+def stats(
+    ctx: typer.Context,
+    threshold: Annotated[
+        float, typer.Option(help="Ratio to the median of previous runs.")
+    ] = 1.5,
+):
+    from rich.table import Table
+
+    from bex_hooks.exec.stats import load_records, summarize
+
+    console: Console = ctx.obj["console"]
+    match load_records(ctx.obj["directory"] / ".bex" / "stats" / "hooks.jsonl"):
+        case Ok(records):
+            pass
+        case Error(err):
+            console.print("Failed to load stats", style="red")
+            _print_traceback(console, err)
+            ctx.exit(1)
+
+    table = Table("Hook", "Runs", "p50", "p90", "p99", "Latest", "CPU", "Downloaded")
+    regressions = 0
+    for hook in summarize(records, threshold=threshold):
+        regressions += hook.regressed
+        table.add_row(
+            hook.name or hook.hook_id,
+            str(hook.runs),
+            f"{hook.p50:.2f}s",
+            f"{hook.p90:.2f}s",
+            f"{hook.p99:.2f}s",
+            f"{hook.latest:.2f}s",
+            "" if hook.cpu_time is None else f"{hook.cpu_time:.2f}s",
+            "" if hook.downloaded_bytes is None else f"{hook.downloaded_bytes:.0f}B",
+            style="red" if hook.regressed else None,
+        )
+    console.print(table)
+    if regressions > 0:
+        console.print(
+            f"{regressions} hook(s) regressed, their latest run took more than "
+            f"{threshold}x the median of the previous runs",
+            style="red",
+        )
+
+
+@cache_app.command("ls")
+def cache_ls(ctx: typer.Context):
+    import datetime as dt
+
+    from rich.table import Table
+
+    from bex_hooks.exec.cache import format_size
+
+    console: Console = ctx.obj["console"]
+    index = _cache_index(ctx)
+    if not index.exists():
+        console.print(f"No cache index in {index.root}")
+        return
+
+    table = Table("Entry", "Size", "Last access", "Workflows")
+    total = 0
+    for entry in reversed(index.entries()):
+        total += entry.size
+        table.add_row(
+            entry.path,
+            format_size(entry.size),
+            dt.datetime.fromtimestamp(entry.accessed).isoformat(" ", "seconds"),
+            "\n".join(sorted(entry.workflows)),
+        )
+    console.print(table)
+    console.print(f"{index.root}: {format_size(total)}")
+
+
+@cache_app.command("gc")
+def cache_gc(
+    ctx: typer.Context,
+    max_size: Annotated[
+        str | None,
+        typer.Option(
+            "--max-size",
+            help="Size to evict down to, e.g. 5G. Defaults to BEX_CACHE_MAX_SIZE.",
+        ),
+    ] = None,
+):
+    from bex_hooks.exec.cache import cache_limit, collect, format_size, parse_size
+
+    console: Console = ctx.obj["console"]
+    index = _cache_index(ctx)
+    match flow(
+        cache_limit(os.environ) if max_size is None else parse_size(max_size),
+        result.and_then(lambda limit: collect(index, limit)),
+    ):
+        case Ok(evicted):
             console.print(
-                Traceback(Traceback.extract(type(err), err, err.__traceback__)),
-                style="dim",
+                f"Evicted {len(evicted)} entry(ies), "
+                f"{format_size(sum(entry.size for entry in evicted))} freed"
             )
+        case Error(err):
+            console.print("Failed to collect the cache", style="red")
+            _print_traceback(console, err)
+            ctx.exit(2)
+
+
+@cache_app.command("verify")
+def cache_verify(ctx: typer.Context):
+    from bex_hooks.exec.cache import verify
+
+    console: Console = ctx.obj["console"]
+    match verify(_cache_index(ctx)):
+        case Ok(problems):
+            pass
+        case Error(err):
+            console.print("Failed to verify the cache", style="red")
+            _print_traceback(console, err)
             ctx.exit(2)
+
+    corrupted = 0
+    for problem in problems:
+        if problem.problem == "untracked":
+            console.print(f"Indexed {problem.entry.path}")
+        else:
+            corrupted += 1
+            console.print(f"Removed {problem.entry.path} ({problem.problem})")
+    if corrupted > 0:
+        console.print(f"{corrupted} corrupted entry(ies) removed", style="red")
+        ctx.exit(1)
+    console.print("Cache is valid", style="green")
+
+
+def _cache_index(ctx: typer.Context) -> CacheIndex:
+    from bex_hooks.exec._store import CacheIndex, cache_dir
+
+    return CacheIndex(cache_dir(str(ctx.obj["directory"]), os.environ))
+
+
+def _print_traceback(console: Console, err: BaseException) -> None:
+    from rich.traceback import Traceback
+
+    console.print(
+        Traceback(Traceback.extract(type(err), err, err.__traceback__)),
+        style="dim",
+    )
@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+import threading
+from typing import TYPE_CHECKING, Any
+
+from bex_hooks.exec._interface import is_layered_mapping
+
+if TYPE_CHECKING:
+    from collections.abc import Mapping
+
+    import cel
+
+    from bex_hooks.exec._interface import ContextLike
+
+# Set by the executor before any hook runs, conditions that only reference
+# these variables always evaluate to the same value.
+_CONSTANT_VARIABLES = frozenset({"platform", "arch"})
+_MISSING = object()
+
+
+def fold_condition(program: cel.Program, metadata: Mapping[str, Any]) -> bool | None:
+    if not set(program.variables()).issubset(_CONSTANT_VARIABLES):
+        return None
+
+    try:
+        return bool(
+            program.execute({key: metadata[key] for key in _CONSTANT_VARIABLES})
+        )
+    except Exception:
+        # Reported when the hook is about to run
+        return None
+
+
+class ConditionEvaluator:
+    __slots__ = ("__cel_ctx", "__environ", "__environ_source", "__lock", "__metadata")
+
+    def __init__(self) -> None:
+        self.__cel_ctx: cel.Context | None = None
+        self.__lock = threading.Lock()
+        self.__metadata: dict[str, Any] = {}
+        self.__environ: Mapping[str, str] | None = None
+        self.__environ_source: Mapping[str, str] | None = None
+
+    def evaluate(self, program: cel.Program, ctx: ContextLike) -> bool:
+        with self.__lock:
+            # Parallel branches evaluate with different contexts, variables
+            # pushed for one branch but missing from this context can not be
+            # removed from cel, the context is then built again.
+            if self.__cel_ctx is None or any(
+                key not in ctx.metadata for key in self.__metadata
+            ):
+                import cel
+
+                self.__cel_ctx = cel.Context()
+                self.__metadata = {}
+                self.__environ = None
+                self.__environ_source = None
+
+            # Each update discards the environment built by cel, so only the
+            # variables that changed since the previous evaluation are pushed.
+            changes: dict[str, Any] = {
+                key: value
+                for key, value in ctx.metadata.items()
+                if key != "env" and self.__metadata.get(key, _MISSING) != value
+            }
+            if ctx.environ is not self.__environ_source:
+                previous, self.__environ_source = self.__environ_source, ctx.environ
+                # A layer over the previous environment always has changes
+                if is_layered_mapping(ctx.environ) and (ctx.environ.parent is previous):
+                    self.__environ = ctx.environ.flatten()
+                    changes["env"] = self.__environ
+                elif ctx.environ != self.__environ:
+                    self.__environ = dict(ctx.environ)
+                    changes["env"] = self.__environ
+
+            if len(changes) > 0:
+                self.__cel_ctx.update(changes)
+                self.__metadata.update(
+                    (key, value) for key, value in changes.items() if key != "env"
+                )
+
+            return bool(program.execute(self.__cel_ctx))
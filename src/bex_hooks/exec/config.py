@@ -1,21 +1,31 @@
 from __future__ import annotations
 
+import hashlib
+import json
+import logging
+import pickle
 from functools import partial
 from pathlib import Path
-from typing import TYPE_CHECKING, Any
+from string import Template
+from typing import TYPE_CHECKING, Any, Literal, Self
 
-from pydantic import BaseModel, ConfigDict, Field
-from ruamel.yaml import YAML
+from pydantic import BaseModel, ConfigDict, Field, PrivateAttr, model_validator
 from stdlibx import option, result
 from stdlibx.compose import flow
+from stdlibx.result.types import Error, Ok
 
 from bex_hooks.exec.errors import BexExecError
+from bex_hooks.exec.plugin import distributions_key
+from bex_hooks.exec.utils import write_atomic
 
 if TYPE_CHECKING:
+    import cel
     from stdlibx.result.types import Result
 
 
-def load_config(directory: Path | None, filename: Path | None):
+def load_config(
+    directory: Path | None, filename: Path | None, *, use_cache: bool = True
+):
     _directory = flow(
         option.maybe(lambda: directory),
         option.map_or_else(lambda: result.try_(Path.cwd), lambda val: result.ok(val)),
@@ -45,7 +55,13 @@ def load_config(directory: Path | None, filename: Path | None):
 
     return flow(
         result.collect(_directory, _file),
-        result.and_then(lambda val: _parse_config(val[0], val[1])),
+        result.and_then(
+            lambda val: (
+                _load_cached_config(val[0], val[1])
+                if use_cache
+                else _parse_config(val[0], val[1])
+            )
+        ),
     )
 
 
@@ -55,7 +71,73 @@ def _get_next_candidate(directory: Path, candidates: set[str]) -> Path:
     )
 
 
+def _load_cached_config(directory: Path, file: Path) -> Result[Environment, Exception]:
+    logger = logging.getLogger("bex_hooks.config")
+    cache_file = (
+        directory
+        / ".bex"
+        / "cache"
+        / "config"
+        / f"{hashlib.sha256(str(file).encode('utf-8')).hexdigest()}.pickle"
+    )
+
+    match result.try_(_config_key, file):
+        case Ok(key):
+            pass
+        case Error(_) as err:
+            return result.error(err.error)
+
+    # The key is stored before the pickle and compared first, so that a
+    # cache file which was not written for this configuration is never
+    # unpickled.
+    header = f"{key}\n".encode()
+    match result.try_(cache_file.read_bytes):
+        case Ok(data) if data.startswith(header):
+            match result.try_(pickle.loads, data[len(header) :]):
+                case Ok(Environment() as env):
+                    return result.ok(env)
+
+    return flow(
+        _parse_config(directory, file),
+        result.inspect(
+            lambda env: flow(
+                result.try_(pickle.dumps, env, protocol=pickle.HIGHEST_PROTOCOL),
+                result.map_(lambda data: header + data),
+                result.and_then(result.safe(partial(write_atomic, cache_file))),
+                result.inspect_err(
+                    lambda err: logger.warning(
+                        "Failed to cache the configuration: %s", err
+                    )
+                ),
+            )
+        ),
+    )
+
+
+def _config_key(file: Path) -> str:
+    # The installed distributions and this module are part of the key, so
+    # that the cache is not loaded with model definitions from a different
+    # version, including editable installs.
+    _stat = file.stat()
+    _module_stat = Path(__file__).stat()
+    return hashlib.sha256(
+        json.dumps(
+            [
+                str(file),
+                _stat.st_size,
+                _stat.st_mtime_ns,
+                hashlib.sha256(file.read_bytes()).hexdigest(),
+                distributions_key(),
+                _module_stat.st_size,
+                _module_stat.st_mtime_ns,
+            ]
+        ).encode("utf-8")
+    ).hexdigest()
+
+
 def _parse_config(directory: Path, file: Path) -> Result[Environment, Exception]:
+    from ruamel.yaml import YAML
+
     return flow(
         result.try_(file.read_text),
         result.and_then(result.safe(YAML(typ="safe").load)),
@@ -76,16 +158,144 @@ class Environment(BaseModel):
     class Config(BaseModel):
         model_config = ConfigDict(extra="allow")
         plugins: list[str] = Field(default_factory=list)
+        max_workers: int | None = Field(default=None, ge=1)
+        executor: Literal["threads", "asyncio"] = Field(default="threads")
 
     class Hook(BaseModel):
         model_config = ConfigDict(extra="allow")
         __pydantic_extra__: dict[str, Any] = Field(init=False)  # type: ignore
 
         id: str
+        name: str | None = Field(default=None)
         if_: str | None = Field(default=None, alias="if")
+        needs: list[str] | None = Field(default=None)
+        foreach: list[Any] | None = Field(default=None, min_length=1)
+        max_parallel: int | None = Field(default=None, ge=1)
+        timeout: float | None = Field(default=None, gt=0)
+
+        _condition: cel.Program | None = PrivateAttr(default=None)
+        _group: int | None = PrivateAttr(default=None)
+
+        @property
+        def condition(self) -> cel.Program | None:
+            # Compiled on first use when loaded from the cache, so that cel is
+            # not imported by runs that do not evaluate any condition.
+            if self._condition is None and self.if_ is not None:
+                import cel
+
+                self._condition = cel.compile(self.if_)
+            return self._condition
+
+        @property
+        def group(self) -> int | None:
+            # Position in the configuration of the hook this one was expanded
+            # from, None when it does not use `foreach`.
+            return self._group
+
+        def expand(self, group: int, item: Any) -> Self:
+            variables = (
+                {str(key): value for key, value in item.items()}
+                if isinstance(item, dict)
+                else {"item": item}
+            )
+            hook = self.model_copy(update={"foreach": None})
+            hook.__pydantic_extra__ = _render_item(self.__pydantic_extra__, variables)
+            hook._group = group
+            return hook
+
+        def __getstate__(self) -> dict[Any, Any]:
+            # Compiled programs can not be pickled, they are compiled again
+            # by `condition` after the configuration is loaded from the cache.
+            state = super().__getstate__()
+            return {
+                **state,
+                "__pydantic_private__": {
+                    **(state["__pydantic_private__"] or {}),
+                    "_condition": None,
+                },
+            }
+
+        @model_validator(mode="after")
+        def _compile_condition(self) -> Self:
+            # Compiled once when loading the configuration, so that syntax
+            # errors are reported before any hook runs. cel is only imported
+            # by workflows that use conditions, as it is slow to import.
+            if self.if_ is not None:
+                import cel
+
+                self._condition = cel.compile(self.if_)
+            return self
 
     directory: Path = Field(alias="_directory")
     filename: Path = Field(alias="_filename")
 
     config: Config
     hooks: list[Hook] = Field(default_factory=list)
+
+    @model_validator(mode="after")
+    def _check_needs(self) -> Self:
+        names: set[str] = set()
+        for hook in self.hooks:
+            for need in hook.needs or []:
+                if need not in names:
+                    msg = (
+                        f"Hook '{hook.name or hook.id}' needs '{need}', "
+                        "which is not the name of a previous hook"
+                    )
+                    raise ValueError(msg)
+
+            if hook.name is not None:
+                if hook.name in names:
+                    msg = f"Duplicate hook name '{hook.name}'"
+                    raise ValueError(msg)
+                names.add(hook.name)
+
+        return self
+
+    @model_validator(mode="after")
+    def _expand_foreach(self) -> Self:
+        # Each item becomes a hook with the same name, the executor runs the
+        # hooks of a group as a single step.
+        hooks: list[Environment.Hook] = []
+        for group, hook in enumerate(self.hooks):
+            if hook.foreach is None:
+                hooks.append(hook)
+            else:
+                hooks.extend(hook.expand(group, item) for item in hook.foreach)
+        self.hooks = hooks
+        return self
+
+
+class ServerRequest(BaseModel):
+    # Sent by the clients of `bex exec serve`, validated here so that the
+    # server, which only imports pydantic to load configurations, stays
+    # cheap to import for its clients.
+    directory: Path
+    file: Path | None = Field(default=None)
+    environ: dict[str, str]
+    use_config_cache: bool = Field(default=True)
+    deadline: float | None = Field(default=None, gt=0)
+
+
+class _ItemTemplate(Template):
+    # `$$` is kept, as hooks render their arguments with their own templates
+    pattern = r"""
+    (?<!\$)\$(?:
+      (?P<escaped>(?!))|
+      (?P<named>[_a-z][_a-z0-9]*)|
+      {(?P<braced>[_a-z][_a-z0-9]*)}|
+      (?P<invalid>(?!))
+    )
+    """
+
+
+def _render_item(value: Any, variables: dict[str, Any]) -> Any:
+    match value:
+        case str():
+            return _ItemTemplate(value).safe_substitute(variables)
+        case dict():
+            return {key: _render_item(item, variables) for key, item in value.items()}
+        case list():
+            return [_render_item(item, variables) for item in value]
+        case _:
+            return value
@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import platform
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any
+
+from bex_hooks.exec._interface import Context, LayeredMapping, is_layered_mapping
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable, Mapping
+
+    from bex_hooks.exec._interface import ContextLike
+
+
+@dataclass(frozen=True)
+class ContextDelta:
+    working_dir: str | None = None
+    metadata: Mapping[str, Any] = field(default_factory=dict)
+    environ: Mapping[str, str] = field(default_factory=dict)
+    removed_metadata: frozenset[str] = field(default_factory=frozenset)
+    removed_environ: frozenset[str] = field(default_factory=frozenset)
+
+    def is_empty(self) -> bool:
+        return (
+            self.working_dir is None
+            and len(self.metadata) == 0
+            and len(self.environ) == 0
+            and len(self.removed_metadata) == 0
+            and len(self.removed_environ) == 0
+        )
+
+
+def initial_context(
+    working_dir: str, metadata: Mapping[str, Any], environ: Mapping[str, str]
+) -> ContextLike:
+    return Context(
+        working_dir=working_dir,
+        metadata={
+            **metadata,
+            "platform": platform.system().lower(),
+            "arch": platform.machine().lower(),
+        },
+        environ=environ,
+    )
+
+
+def diff_context(before: ContextLike, after: ContextLike) -> ContextDelta:
+    if after is before:
+        return ContextDelta()
+
+    metadata, removed_metadata = _diff_mapping(before.metadata, after.metadata)
+    environ, removed_environ = _diff_mapping(before.environ, after.environ)
+    return ContextDelta(
+        working_dir=(
+            after.working_dir if after.working_dir != before.working_dir else None
+        ),
+        metadata=metadata,
+        environ=environ,
+        removed_metadata=removed_metadata,
+        removed_environ=removed_environ,
+    )
+
+
+def apply_deltas(ctx: ContextLike, deltas: Iterable[ContextDelta]) -> ContextLike:
+    working_dir = ctx.working_dir
+    metadata = ctx.metadata
+    environ = ctx.environ
+    for delta in deltas:
+        if delta.working_dir is not None:
+            working_dir = delta.working_dir
+        if len(delta.metadata) > 0 or len(delta.removed_metadata) > 0:
+            metadata = LayeredMapping(metadata, delta.metadata, delta.removed_metadata)
+        if len(delta.environ) > 0 or len(delta.removed_environ) > 0:
+            environ = LayeredMapping(environ, delta.environ, delta.removed_environ)
+
+    return Context(working_dir=working_dir, metadata=metadata, environ=environ)
+
+
+def flatten_context(ctx: ContextLike) -> ContextLike:
+    return Context(
+        working_dir=ctx.working_dir,
+        metadata=_flatten(ctx.metadata),
+        environ=_flatten(ctx.environ),
+    )
+
+
+def _diff_mapping(
+    before: Mapping[str, Any], after: Mapping[str, Any]
+) -> tuple[dict[str, Any], frozenset[str]]:
+    if after is before:
+        return {}, frozenset()
+
+    _missing = object()
+    if is_layered_mapping(after) and after.parent is before:
+        # Only the keys of the last layer can differ
+        return (
+            {
+                key: value
+                for key, value in after.changes.items()
+                if before.get(key, _missing) != value
+            },
+            frozenset(key for key in after.removed if key in before),
+        )
+
+    changed = {
+        key: value for key, value in after.items() if before.get(key, _missing) != value
+    }
+    removed = frozenset(key for key in before if key not in after)
+    return changed, removed
+
+
+def _flatten(mapping: Mapping[str, Any]) -> dict[str, Any]:
+    if is_layered_mapping(mapping):
+        return mapping.flatten()
+    return dict(mapping)
@@ -3,8 +3,11 @@ from __future__ import annotations
 
 class BexExecError(Exception):
     def __init__(self, msg: str) -> None:
-        super().__init__()
+        super().__init__(msg)
         self.msg = msg
 
 
 class BexPluginError(BexExecError): ...
+
+
+class BexTimeoutError(BexExecError): ...
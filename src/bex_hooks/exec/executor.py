@@ -1,30 +1,103 @@
 from __future__ import annotations
 
+import asyncio
+import atexit
+import contextlib
 import functools
+import inspect
 import logging
-import platform
+import threading
 import time
-from typing import TYPE_CHECKING, Any
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Literal, cast
 
-import cel
-from stdlibx import option, result
-from stdlibx.cancel import is_token_cancelled
+from stdlibx import result
+from stdlibx.cancel import (
+    CancellationTokenTimeoutError,
+    is_token_cancelled,
+    with_timeout,
+)
 from stdlibx.compose import flow
-from stdlibx.option.types import Nothing, Some
 from stdlibx.result.types import Error, Ok, Result
 
-from bex_hooks.exec._interface import Context
-from bex_hooks.exec.plugin import plugin_from_entrypoint
+from bex_hooks.exec._store import CacheIndex, cache_dir
+from bex_hooks.exec.cache import cache_limit, collect
+from bex_hooks.exec.conditions import ConditionEvaluator, fold_condition
+from bex_hooks.exec.context import (
+    ContextDelta,
+    apply_deltas,
+    diff_context,
+    flatten_context,
+    initial_context,
+)
+from bex_hooks.exec.errors import BexTimeoutError
+from bex_hooks.exec.plugin import (
+    PluginInfo,
+    PluginRegistry,
+    discover_plugins,
+    distributions_key,
+)
+from bex_hooks.exec.scheduler import schedule, schedule_async
+from bex_hooks.exec.state import (
+    ContextKeys,
+    ContextState,
+    HookState,
+    cached_context,
+    context_key,
+    files_signature,
+    hook_fingerprint,
+    hook_key,
+    load_durations,
+    load_state,
+    save_context_state,
+    save_durations,
+    save_state,
+)
+from bex_hooks.exec.stats import HookRecord, append_records
 
 if TYPE_CHECKING:
-    from collections.abc import Mapping, MutableMapping
+    from collections.abc import (
+        Callable,
+        Iterable,
+        Iterator,
+        Mapping,
+        MutableMapping,
+        Sequence,
+    )
+    from contextlib import AbstractContextManager
 
     from stdlibx.cancel import CancellationToken
 
-    from bex_hooks.exec._interface import UI, ContextLike, HookFunc
+    from bex_hooks.exec._interface import (
+        UI,
+        AsyncHookFunc,
+        ContextLike,
+        HookFunc,
+        UIProgress,
+        UIScope,
+    )
     from bex_hooks.exec.config import Environment
 
 
+PlanStatus = Literal["run", "skip", "cached", "unknown"]
+
+_NO_KEYS = ContextKeys(metadata=frozenset(), environ=frozenset())
+
+_loop: asyncio.AbstractEventLoop | None = None
+_loop_lock = threading.Lock()
+
+
+@dataclass(frozen=True)
+class PlannedHook:
+    hook: Environment.Hook
+    status: PlanStatus
+    # Duration of the last run, None when the hook never ran
+    estimate: float | None
+    # Whether the hook is on the longest path through the needs graph
+    critical: bool
+
+
 def execute(
     token: CancellationToken,
     ui: UI,
@@ -33,95 +106,933 @@ def execute(
     env: Environment,
 ) -> Result[ContextLike, Exception]:
     logger = logging.getLogger("bex_hooks.executor")
+    started = time.time()
+    initial_ctx = initial_context(str(env.directory), metadata, environ)
 
-    match result.collect_all(
-        flow(
-            plugin_from_entrypoint(_plugin),
-            result.inspect(lambda _: logger.info("Imported plugin '%s'", _plugin)),
-            result.inspect_err(
-                lambda _: logger.error("Failed to import plugin '%s'", _plugin)
+    # The whole workflow is skipped when neither the configuration, the
+    # installed plugins, the variables read by the hooks nor the files used
+    # by the hooks changed since the last successful run.
+    state_dir = Path(env.directory) / ".bex" / "state"
+    distributions = distributions_key()
+    with ui.span("check context"):
+        cached = cached_context(
+            state_dir / "context.json", env.filename, distributions, initial_ctx
+        )
+    match cached:
+        case Ok(cached_ctx) if cached_ctx is not None:
+            ui.print("Environment is up to date")
+            return result.ok(cached_ctx)
+        case Error(err):
+            logger.warning("Failed to load the previous context: %s", err)
+
+    match load_plugins(ui, env):
+        case Ok(plugins):
+            pass
+        case Error(_) as err:
+            return result.error(err.error)
+
+    dependencies = _hook_dependencies(env.hooks)
+    ancestors = _hook_ancestors(dependencies)
+    pruned = frozenset(
+        index
+        for index, hook in enumerate(env.hooks)
+        if hook.condition is not None
+        and fold_condition(hook.condition, initial_ctx.metadata) is False
+    )
+    for index in sorted(pruned):
+        ui.print(f"Hook skipped: '{env.hooks[index].id}'")
+
+    contexts: dict[int, tuple[ContextLike, ContextLike]] = {}
+    # Files each hook depends on, None when the hook can not be skipped
+    files: dict[int, Mapping[str, str | None] | None] = {}
+    # Variables of the context each hook and its condition read
+    keys: dict[int, ContextKeys] = {}
+    # Files of the hooks replayed from their state, which did not use the cache
+    replayed: set[str] = set()
+    durations: dict[str, float] = {}
+    records: list[HookRecord] = []
+
+    @functools.cache
+    def _delta(index: int) -> ContextDelta:
+        return diff_context(*contexts[index])
+
+    def _merged_context(indices: frozenset[int]) -> ContextLike:
+        # The changes of each hook are applied in the order the hooks are
+        # declared, so that the result does not depend on which parallel
+        # branch completed first.
+        if len(indices) == 0:
+            return initial_ctx
+        if len(indices) == len(ancestors[_last := max(indices)]) + 1:
+            return contexts[_last][1]
+        return apply_deltas(initial_ctx, (_delta(index) for index in sorted(indices)))
+
+    def _record(index: int, ctx: ContextLike, value: _HookResult) -> ContextLike:
+        contexts[index] = (ctx, value.ctx)
+        files[index] = value.files
+        keys[index] = value.keys.union(_condition_keys(env.hooks[index]))
+        if value.cached and value.files is not None:
+            replayed.update(value.files)
+        if value.duration is not None:
+            hook = env.hooks[index]
+            durations[hook_key(hook.id, hook.name, hook.__pydantic_extra__)] = (
+                value.duration
+            )
+        return value.ctx
+
+    def _run(token_: CancellationToken, index: int):
+        ctx = _merged_context(ancestors[index])
+        if index in pruned:
+            return result.ok(_record(index, ctx, _HookResult(ctx, {})))
+
+        return flow(
+            _execute_hook(
+                token_,
+                ui,
+                plugins,
+                env.hooks[index],
+                ctx,
+                conditions,
+                state_dir,
+                records,
             ),
+            result.map_(functools.partial(_record, index, ctx)),
+        )
+
+    async def _run_async(token_: CancellationToken, index: int):
+        ctx = _merged_context(ancestors[index])
+        if index in pruned:
+            return result.ok(_record(index, ctx, _HookResult(ctx, {})))
+
+        return flow(
+            await _execute_hook_async(
+                token_,
+                ui,
+                plugins,
+                env.hooks[index],
+                ctx,
+                conditions,
+                state_dir,
+                records,
+            ),
+            result.map_(functools.partial(_record, index, ctx)),
+        )
+
+    conditions = ConditionEvaluator()
+    groups = [hook.group for hook in env.hooks]
+    limits = _hook_limits(env.hooks)
+    scheduled = (
+        asyncio.run(
+            schedule_async(
+                token,
+                dependencies,
+                _run_async,
+                max_workers=env.config.max_workers,
+                groups=groups,
+                limits=limits,
+            )
+        )
+        if env.config.executor == "asyncio"
+        else schedule(
+            token,
+            dependencies,
+            _run,
+            max_workers=env.config.max_workers,
+            groups=groups,
+            limits=limits,
+        )
+    )
+    _save_durations(state_dir / "durations.json", durations)
+    flow(
+        append_records(Path(env.directory) / ".bex" / "stats" / "hooks.jsonl", records),
+        result.inspect_err(
+            lambda err: logger.warning("Failed to save the stats of hooks: %s", err)
+        ),
+    )
+    with ui.span("collect cache"):
+        _collect_cache(env, environ, started, replayed)
+    return flow(
+        scheduled,
+        result.map_(
+            lambda _: flatten_context(_merged_context(frozenset(range(len(env.hooks)))))
+        ),
+        result.inspect(
+            lambda ctx: _save_context(
+                state_dir / "context.json",
+                env.filename,
+                distributions,
+                initial_ctx,
+                keys.values(),
+                files.values(),
+                ctx,
+            )
+        ),
+    )
+
+
+def plan(
+    ui: UI,
+    metadata: MutableMapping[str, Any],
+    environ: MutableMapping[str, str],
+    env: Environment,
+) -> Result[list[PlannedHook], Exception]:
+    logger = logging.getLogger("bex_hooks.executor")
+    initial_ctx = initial_context(str(env.directory), metadata, environ)
+
+    match load_plugins(ui, env):
+        case Ok(plugins):
+            pass
+        case Error(_) as err:
+            return result.error(err.error)
+
+    state_dir = Path(env.directory) / ".bex" / "state"
+    match load_durations(state_dir / "durations.json"):
+        case Ok(durations):
+            pass
+        case Error(err):
+            logger.warning("Failed to load the durations of hooks: %s", err)
+            durations = {}
+
+    # Hooks are simulated in order, the changes of a hook are only known when
+    # it is skipped or up to date, hooks that come after one that would run
+    # can only be evaluated by running it.
+    dependencies = _hook_dependencies(env.hooks)
+    ancestors = _hook_ancestors(dependencies)
+    conditions = ConditionEvaluator()
+    statuses: list[PlanStatus] = []
+    deltas: list[ContextDelta | None] = []
+    for index, hook in enumerate(env.hooks):
+        _deltas = [deltas[dep] for dep in sorted(ancestors[index])]
+        if any(delta is None for delta in _deltas):
+            status, delta = ("unknown" if hook.condition is not None else "run"), None
+        else:
+            ctx = apply_deltas(initial_ctx, cast("list[ContextDelta]", _deltas))
+            match _plan_hook(plugins, hook, ctx, conditions, state_dir):
+                case Ok((status, delta)):
+                    pass
+                case Error(_) as err:
+                    return result.error(err.error)
+        statuses.append(status)
+        deltas.append(delta)
+
+    estimates = [
+        durations.get(hook_key(hook.id, hook.name, hook.__pydantic_extra__))
+        if status in ("run", "unknown")
+        else 0.0
+        for hook, status in zip(env.hooks, statuses, strict=True)
+    ]
+
+    # Longest path through the needs graph, based on the estimates
+    finish: list[float] = []
+    for index, deps in enumerate(dependencies):
+        start = max((finish[dep] for dep in deps), default=0.0)
+        finish.append(start + (estimates[index] or 0.0))
+    critical: set[int] = set()
+    last = max(range(len(finish)), key=finish.__getitem__, default=None)
+    while last is not None and finish[last] > 0:
+        critical.add(last)
+        last = max(dependencies[last], key=finish.__getitem__, default=None)
+
+    return result.ok(
+        [
+            PlannedHook(
+                hook=hook,
+                status=statuses[index],
+                estimate=estimates[index],
+                critical=index in critical,
+            )
+            for index, hook in enumerate(env.hooks)
+        ]
+    )
+
+
+def _plan_hook(
+    plugins: PluginRegistry,
+    hook: Environment.Hook,
+    ctx: ContextLike,
+    conditions: ConditionEvaluator,
+    state_dir: Path,
+) -> Result[tuple[PlanStatus, ContextDelta | None], Exception]:
+    match result.try_(
+        lambda: (
+            hook.condition is not None
+            and conditions.evaluate(hook.condition, ctx) is False
         )
-        for _plugin in env.config.plugins
     ):
-        case Ok(value):
-            plugins = list(value)
+        case Ok(True):
+            return result.ok(("skip", ContextDelta()))
+        case Error(_):
+            # e.g. the condition uses metadata that is set when running hooks
+            return result.ok(("unknown", None))
+
+    match plugins.get(hook.id):
+        case Ok(PluginInfo() as plugin):
+            pass
+        case Ok(None):
+            return result.error(Exception(f"Hook '{hook.id}' does not exists"))
+        case Error(_) as err:
+            return result.error(err.error)
+
+    args = hook.__pydantic_extra__
+    match _fingerprint_hook(plugin, hook.id, args, ctx):
+        case Ok((fingerprint, _, _)):
+            match load_state(state_dir, hook_key(hook.id, hook.name, args)):
+                case Ok(HookState() as state) if (
+                    state.fingerprint == fingerprint
+                    and files_signature(state.outputs) == state.outputs
+                ):
+                    return result.ok(("cached", state.delta))
+        case Error(_) as err:
+            return result.error(err.error)
+
+    return result.ok(("run", None))
+
+
+def load_plugins(ui: UI, env: Environment) -> Result[PluginRegistry, Exception]:
+    logger = logging.getLogger("bex_hooks.executor")
+
+    plugins = PluginRegistry()
+    with ui.span("register plugins"):
+        _registered = result.collect_all(
+            plugins.register(_plugin) for _plugin in env.config.plugins
+        )
+    match _registered:
         case Error(_) as err:
             return result.error(err.error)
 
-    hooks: MutableMapping[str, HookFunc] = {}
-    for plugin in plugins:
-        hooks.update(plugin.hooks)
-        logger.info("Loaded hooks from plugin '%s'", plugin.name)
-
-    cel_ctx = cel.Context()
-    return functools.reduce(
-        lambda prev, hook: flow(
-            prev,
-            result.and_then(
-                lambda ctx_: _execute_hook(token, ui, hooks, hook, ctx_, cel_ctx)
+    with ui.span("discover plugins"):
+        _discovered = discover_plugins(
+            Path(env.directory) / ".bex" / "cache" / "plugins.json"
+        )
+    match _discovered:
+        case Ok(discovered):
+            plugins.discover(discovered)
+        case Error(err):
+            logger.warning("Failed to discover installed plugins: %s", err)
+
+    return result.ok(plugins)
+
+
+def _save_durations(file: Path, durations: Mapping[str, float]) -> None:
+    if len(durations) == 0:
+        return
+
+    flow(
+        load_durations(file),
+        result.or_else(lambda _: result.ok({})),
+        result.and_then(
+            lambda previous: save_durations(file, {**previous, **durations})
+        ),
+        result.inspect_err(
+            lambda err: logging.getLogger("bex_hooks.executor").warning(
+                "Failed to save the durations of hooks: %s", err
+            )
+        ),
+    )
+
+
+def _collect_cache(
+    env: Environment, environ: Mapping[str, str], started: float, replayed: set[str]
+) -> None:
+    # Opportunistic, the index is only read when the cache exceeds its limit,
+    # and the entries used by this execution are kept, including the entries
+    # the files of replayed hooks were made from.
+    logger = logging.getLogger("bex_hooks.executor")
+    index = CacheIndex(cache_dir(str(env.directory), environ))
+    if len(replayed) > 0 and index.exists():
+        flow(
+            result.try_(index.touch_targets, replayed),
+            result.inspect_err(
+                lambda err: logger.warning("Failed to update the cache index: %s", err)
             ),
+        )
+    flow(
+        cache_limit(environ),
+        result.and_then(lambda limit: collect(index, limit, before=started)),
+        result.inspect(
+            lambda evicted: (
+                logger.info("Evicted %d cache entries", len(evicted))
+                if len(evicted) > 0
+                else None
+            )
+        ),
+        result.inspect_err(
+            lambda err: logger.warning("Failed to collect the cache: %s", err)
         ),
-        env.hooks,
-        result.ok(
-            Context(
-                working_dir=str(env.directory),
-                metadata={
-                    **metadata,
-                    "platform": platform.system().lower(),
-                    "arch": platform.machine().lower(),
-                },
-                environ=environ,
+    )
+
+
+def _save_context(
+    file: Path,
+    config_file: Path,
+    distributions: str,
+    initial_ctx: ContextLike,
+    keys: Iterable[ContextKeys],
+    files: Iterable[Mapping[str, str | None] | None],
+    ctx: ContextLike,
+) -> None:
+    _files: dict[str, str | None] = {}
+    for _hook_files in files:
+        if _hook_files is None:
+            return
+        _files.update(_hook_files)
+
+    _keys = functools.reduce(ContextKeys.union, keys, _NO_KEYS)
+    flow(
+        context_key(config_file, distributions, initial_ctx, _keys),
+        result.and_then(
+            lambda key: save_context_state(
+                file,
+                ContextState(
+                    key=key,
+                    keys=_keys,
+                    files=_files,
+                    delta=diff_context(initial_ctx, ctx),
+                ),
+            )
+        ),
+        result.inspect_err(
+            lambda err: logging.getLogger("bex_hooks.executor").warning(
+                "Failed to save the context: %s", err
             )
         ),
     )
 
 
+def _condition_keys(hook: Environment.Hook) -> ContextKeys:
+    # Variables of `env` can not be told apart, a condition using it reads
+    # the whole environment.
+    if hook.condition is None:
+        return _NO_KEYS
+    variables = set(hook.condition.variables())
+    return ContextKeys(
+        metadata=frozenset(variables - {"env"}),
+        environ=None if "env" in variables else frozenset(),
+    )
+
+
+def _hook_dependencies(hooks: Sequence[Environment.Hook]) -> list[frozenset[int]]:
+    # Hooks without `needs` depend on the previous hook, so that workflows
+    # which do not use it still run in order. The hooks expanded from one
+    # `foreach` are a single step, which the next hooks depend on as a whole.
+    steps: list[list[int]] = []
+    for index, hook in enumerate(hooks):
+        if (
+            hook.group is not None
+            and index > 0
+            and hooks[index - 1].group == hook.group
+        ):
+            steps[-1].append(index)
+        else:
+            steps.append([index])
+
+    names = {hooks[step[0]].name: step for step in steps if hooks[step[0]].name}
+    dependencies: list[frozenset[int]] = []
+    for position, step in enumerate(steps):
+        hook = hooks[step[0]]
+        deps = (
+            frozenset(index for need in hook.needs for index in names[need])
+            if hook.needs is not None
+            else frozenset(steps[position - 1] if position > 0 else ())
+        )
+        dependencies.extend(deps for _ in step)
+    return dependencies
+
+
+def _hook_limits(hooks: Sequence[Environment.Hook]) -> dict[int, int]:
+    return {
+        hook.group: hook.max_parallel
+        for hook in hooks
+        if hook.group is not None and hook.max_parallel is not None
+    }
+
+
+def _hook_ancestors(dependencies: Sequence[frozenset[int]]) -> list[frozenset[int]]:
+    ancestors: list[frozenset[int]] = []
+    for deps in dependencies:
+        ancestors.append(deps.union(*(ancestors[dep] for dep in deps)))
+    return ancestors
+
+
+@dataclass(frozen=True)
+class _HookResult:
+    ctx: ContextLike
+    # Files the context depends on, None when the hook can not be skipped
+    files: Mapping[str, str | None] | None
+    # None when the hook did not run
+    duration: float | None = None
+    cached: bool = False
+    # Variables of the context the hook read
+    keys: ContextKeys = _NO_KEYS
+
+
+@dataclass(frozen=True)
+class _PreparedHook:
+    hook: Environment.Hook
+    func: HookFunc | AsyncHookFunc
+    plugin: PluginInfo
+    ctx: ContextLike
+    state_key: str
+    fingerprint: str | None
+    inputs: Mapping[str, str | None]
+    keys: ContextKeys
+
+
 def _execute_hook(
     token: CancellationToken,
     ui: UI,
-    hooks: Mapping[str, HookFunc],
+    plugins: PluginRegistry,
     hook: Environment.Hook,
     ctx: ContextLike,
-    cel_ctx: cel.Context,
-) -> Result[ContextLike, Exception]:
-    match flow(
-        result.try_(lambda: cel_ctx.update({**ctx.metadata, "env": ctx.environ})),
-        result.and_then(
-            result.safe(
-                lambda _: (
-                    hook.if_ is not None
-                    and bool(cel.evaluate(hook.if_, cel_ctx)) is False
-                )
+    conditions: ConditionEvaluator,
+    state_dir: Path,
+    records: list[HookRecord],
+) -> Result[_HookResult, Exception]:
+    start_time = time.perf_counter()
+    match _prepare_hook(token, ui, plugins, hook, ctx, conditions, state_dir):
+        case Ok(_PreparedHook() as prepared):
+            pass
+        case Ok(_HookResult(cached=True)) as done:
+            records.append(
+                _hook_record(token, hook, done, time.perf_counter() - start_time)
             )
+            return done
+        case done:
+            return done
+
+    hook_ui = _HookUI(ui)
+    start_time = time.perf_counter()
+    value = _run_hook(token, hook_ui, prepared)
+    duration = time.perf_counter() - start_time
+    records.append(_hook_record(token, hook, value, duration, metrics=hook_ui.metrics))
+    return flow(
+        value,
+        result.and_then(
+            lambda value_: _finish_hook(prepared, value_, duration, state_dir)
         ),
+    )
+
+
+async def _execute_hook_async(
+    token: CancellationToken,
+    ui: UI,
+    plugins: PluginRegistry,
+    hook: Environment.Hook,
+    ctx: ContextLike,
+    conditions: ConditionEvaluator,
+    state_dir: Path,
+    records: list[HookRecord],
+) -> Result[_HookResult, Exception]:
+    # Preparing and finishing a hook reads files, which is done outside of
+    # the event loop.
+    loop = asyncio.get_running_loop()
+    start_time = time.perf_counter()
+    match await loop.run_in_executor(
+        None, _prepare_hook, token, ui, plugins, hook, ctx, conditions, state_dir
     ):
+        case Ok(_PreparedHook() as prepared):
+            pass
+        case Ok(_HookResult(cached=True)) as done:
+            records.append(
+                _hook_record(token, hook, done, time.perf_counter() - start_time)
+            )
+            return done
+        case done:
+            return done
+
+    hook_ui = _HookUI(ui)
+    start_time = time.perf_counter()
+    value = await _run_hook_async(token, hook_ui, prepared)
+    duration = time.perf_counter() - start_time
+    records.append(_hook_record(token, hook, value, duration, metrics=hook_ui.metrics))
+    match value:
+        case Ok(value_):
+            return await loop.run_in_executor(
+                None, _finish_hook, prepared, value_, duration, state_dir
+            )
+        case Error(_) as err:
+            return result.error(err.error)
+
+
+def _prepare_hook(
+    token: CancellationToken,
+    ui: UI,
+    plugins: PluginRegistry,
+    hook: Environment.Hook,
+    ctx: ContextLike,
+    conditions: ConditionEvaluator,
+    state_dir: Path,
+) -> Result[_PreparedHook | _HookResult, Exception]:
+    logger = logging.getLogger("bex_hooks.executor")
+
+    with ui.span("evaluate condition", hook=hook.id):
+        _skip = result.try_(
+            lambda: (
+                hook.condition is not None
+                and conditions.evaluate(hook.condition, ctx) is False
+            )
+        )
+
+    match _skip:
         case Ok(skip_hook) if skip_hook is True:
             ui.print(f"Hook skipped: '{hook.id}'")
-            return result.ok(ctx)
+            return result.ok(_HookResult(ctx, {}))
         case Error(_) as err:
             return result.error(err.error)
 
     if is_token_cancelled(token):
         return result.error(token.get_error())
 
-    match option.maybe(hooks.get, hook.id):
-        case Some(func):
-            hook_func = func
-        case Nothing():
+    with ui.span("load plugin", hook=hook.id):
+        _plugin = plugins.get(hook.id)
+
+    match _plugin:
+        case Ok(PluginInfo() as plugin):
+            hook_func = plugin.hooks[hook.id]
+        case Ok(None):
             return result.error(Exception(f"Hook '{hook.id}' does not exists"))
+        case Error(_) as err:
+            return result.error(err.error)
+
+    args = hook.__pydantic_extra__
+    state_key = hook_key(hook.id, hook.name, args)
+    with ui.span("fingerprint", hook=hook.id):
+        match _fingerprint_hook(plugin, hook.id, args, ctx):
+            case Ok((fingerprint, inputs, keys)):
+                _state = load_state(state_dir, state_key)
+            case Ok(None):
+                fingerprint, inputs, keys, _state = None, {}, ContextKeys(), None
+            case Error(_) as err:
+                return result.error(err.error)
+
+    match _state:
+        case Ok(HookState() as state) if (
+            state.fingerprint == fingerprint
+            and files_signature(state.outputs) == state.outputs
+        ):
+            ui.print(f"Hook is up to date: '{hook.id}'")
+            return result.ok(
+                _HookResult(
+                    apply_deltas(ctx, [state.delta]),
+                    {**state.inputs, **state.outputs},
+                    cached=True,
+                    keys=keys,
+                )
+            )
+        case Error(err):
+            logger.warning("Failed to load state of hook '%s': %s", hook.id, err)
+
+    return result.ok(
+        _PreparedHook(
+            hook=hook,
+            func=hook_func,
+            plugin=plugin,
+            ctx=ctx,
+            state_key=state_key,
+            fingerprint=fingerprint,
+            inputs=inputs,
+            keys=keys,
+        )
+    )
+
+
+def _run_hook(
+    token: CancellationToken, ui: UI, prepared: _PreparedHook
+) -> Result[ContextLike, Exception]:
+    args = prepared.hook.__pydantic_extra__
+    token, stop = _hook_token(token, prepared.hook)
+    try:
+        with _report_hook(token, ui, prepared.hook):
+            if inspect.iscoroutinefunction(prepared.func):
+                return result.ok(
+                    asyncio.run_coroutine_threadsafe(
+                        _await_hook(token, prepared.func, args, prepared.ctx, ui),
+                        _hook_loop(),
+                    ).result()
+                )
+            return result.ok(
+                cast("HookFunc", prepared.func)(token, args, prepared.ctx, ui=ui)
+            )
+    except Exception as e:
+        return result.error(e)
+    finally:
+        stop()
+
+
+async def _run_hook_async(
+    token: CancellationToken, ui: UI, prepared: _PreparedHook
+) -> Result[ContextLike, Exception]:
+    args = prepared.hook.__pydantic_extra__
+    token, stop = _hook_token(token, prepared.hook)
+    try:
+        with _report_hook(token, ui, prepared.hook):
+            if inspect.iscoroutinefunction(prepared.func):
+                return result.ok(
+                    await _await_hook(token, prepared.func, args, prepared.ctx, ui)
+                )
+            return result.ok(
+                await asyncio.get_running_loop().run_in_executor(
+                    None,
+                    functools.partial(
+                        cast("HookFunc", prepared.func),
+                        token,
+                        args,
+                        prepared.ctx,
+                        ui=ui,
+                    ),
+                )
+            )
+    except Exception as e:
+        return result.error(e)
+    finally:
+        stop()
+
 
+def _hook_token(
+    token: CancellationToken, hook: Environment.Hook
+) -> tuple[CancellationToken, Callable[[], None]]:
+    if hook.timeout is None:
+        return token, lambda: None
+    return with_timeout(token, hook.timeout)
+
+
+def _hook_loop() -> asyncio.AbstractEventLoop:
+    # Asynchronous hooks of the threads executor share one event loop for the
+    # process, so that what hooks keep per loop, like their HTTP clients, is
+    # reused by the following hooks and runs.
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(
+                target=loop.run_forever, name="bex-hook-loop", daemon=True
+            )
+            thread.start()
+            atexit.register(_close_hook_loop, loop, thread)
+            _loop = loop
+        return _loop
+
+
+def _close_hook_loop(loop: asyncio.AbstractEventLoop, thread: threading.Thread):
+    # Closes the clients kept by the async generators of the hooks
+    asyncio.run_coroutine_threadsafe(loop.shutdown_asyncgens(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+async def _await_hook(
+    token: CancellationToken,
+    func: AsyncHookFunc,
+    args: Mapping[str, Any],
+    ctx: ContextLike,
+    ui: UI,
+) -> ContextLike:
+    # Cancelling the token cancels the task running the hook, which then
+    # fails with the error of the token.
+    loop = asyncio.get_running_loop()
+    task = asyncio.ensure_future(func(token, args, ctx, ui=ui))
+
+    def _cancel(_: Exception) -> None:
+        with contextlib.suppress(RuntimeError):  # The loop is already closed
+            loop.call_soon_threadsafe(task.cancel)
+
+    token.register(_cancel)
+    if token.is_cancelled():
+        task.cancel()
+
+    try:
+        return await task
+    except asyncio.CancelledError:
+        error = token.get_error()
+        if error is None:
+            raise
+        raise error from None
+
+
+@contextlib.contextmanager
+def _report_hook(
+    token: CancellationToken, ui: UI, hook: Environment.Hook
+) -> Iterator[None]:
     ui.print(f"Running hook '{hook.id}'")
     start_time = time.perf_counter()
     try:
-        hook_result = hook_func(token, hook.__pydantic_extra__, ctx, ui=ui)
+        with ui.span(f"hook {hook.id}", name=hook.name):
+            yield
     except Exception as e:
         duration = time.perf_counter() - start_time
+        # Either the timeout of the hook or the deadline of the workflow
+        if isinstance(token.get_error(), CancellationTokenTimeoutError):
+            ui.print(f"Hook timed out: '{hook.id}' ({duration:.2f}s)")
+            msg = f"Hook '{hook.id}' timed out after {duration:.2f}s"
+            raise BexTimeoutError(msg) from e
+
         ui.print(
             f"Hook failed to run: '{hook.id}' ({duration:.2f}s)",  # style="red"
         )
-        return result.error(e)
+        raise
     else:
         duration = time.perf_counter() - start_time
         ui.print(f"Hook ran successfully: '{hook.id}' ({duration:.2f}s)")
-        return result.ok(hook_result)
+
+
+def _finish_hook(
+    prepared: _PreparedHook,
+    hook_result: ContextLike,
+    duration: float,
+    state_dir: Path,
+) -> Result[_HookResult, Exception]:
+    logger = logging.getLogger("bex_hooks.executor")
+    hook, fingerprint = prepared.hook, prepared.fingerprint
+    if fingerprint is None:
+        return result.ok(_HookResult(hook_result, None, duration))
+
+    match result.try_(
+        lambda: HookState(
+            fingerprint=fingerprint,
+            inputs=prepared.inputs,
+            outputs=files_signature(
+                prepared.plugin.outputs[hook.id](hook.__pydantic_extra__, prepared.ctx)
+            ),
+            delta=diff_context(prepared.ctx, hook_result),
+        )
+    ):
+        case Ok(state):
+            flow(
+                save_state(state_dir, prepared.state_key, state),
+                result.inspect_err(
+                    lambda err: logger.warning(
+                        "Failed to save state of hook '%s': %s", hook.id, err
+                    )
+                ),
+            )
+            return result.ok(
+                _HookResult(
+                    hook_result,
+                    {**state.inputs, **state.outputs},
+                    duration,
+                    keys=prepared.keys,
+                )
+            )
+        case Error(err):
+            logger.warning("Failed to save state of hook '%s': %s", hook.id, err)
+            return result.ok(_HookResult(hook_result, None, duration))
+
+
+def _hook_record(
+    token: CancellationToken,
+    hook: Environment.Hook,
+    value: Result[Any, Exception],
+    duration: float,
+    *,
+    metrics: Mapping[str, float] | None = None,
+) -> HookRecord:
+    match value:
+        case Ok(_HookResult(cached=cached)):
+            outcome = "success"
+        case Ok(_):
+            outcome, cached = "success", False
+        case Error(BexTimeoutError()):
+            outcome, cached = "timeout", False
+        case Error(_) if token.is_cancelled():
+            outcome, cached = "cancelled", False
+        case _:
+            outcome, cached = "failure", False
+
+    # Reported by the hooks for each subprocess they waited for
+    metrics = dict(metrics or {})
+    cpu_time = metrics.pop("cpu_time", None)
+    return HookRecord(
+        time=time.time(),
+        hook_id=hook.id,
+        name=hook.name,
+        key=hook_key(hook.id, hook.name, hook.__pydantic_extra__),
+        duration=duration,
+        outcome=outcome,
+        cached=cached,
+        cpu_time=cpu_time,
+        metrics=metrics,
+    )
+
+
+class _HookUI:
+    # Forwards to the UI of the executor, and collects the metrics reported
+    # by a single hook.
+    __slots__ = ("__lock", "__metrics", "__ui")
+
+    def __init__(self, ui: UI) -> None:
+        self.__ui = ui
+        self.__metrics: dict[str, float] = {}
+        self.__lock = threading.Lock()
+
+    @property
+    def metrics(self) -> dict[str, float]:
+        with self.__lock:
+            return dict(self.__metrics)
+
+    def scope(self, status: str) -> UIScope:
+        return self.__ui.scope(status)
+
+    def progress(self) -> UIProgress:
+        return self.__ui.progress()
+
+    def log(self, *objects: Any, end: str = "\n") -> None:
+        self.__ui.log(*objects, end=end)
+
+    def print(self, *objects: Any, end: str = "\n") -> None:
+        self.__ui.print(*objects, end=end)
+
+    def span(self, name: str, /, **args: Any) -> AbstractContextManager[Any]:
+        return self.__ui.span(name, **args)
+
+    def metric(self, name: str, value: float, /) -> None:
+        with self.__lock:
+            self.__metrics[name] = self.__metrics.get(name, 0) + value
+        self.__ui.metric(name, value)
+
+
+def _fingerprint_hook(
+    plugin: PluginInfo, hook_id: str, args: Mapping[str, Any], ctx: ContextLike
+) -> Result[tuple[str, Mapping[str, str | None], ContextKeys] | None, Exception]:
+    # Only hooks that declare their outputs can be skipped, as the executor
+    # has no other way of knowing that a previous run is still in effect.
+    if hook_id not in plugin.outputs:
+        return result.ok(None)
+
+    return flow(
+        result.try_(
+            lambda: (
+                files_signature(
+                    plugin.inputs[hook_id](args, ctx)
+                    if hook_id in plugin.inputs
+                    else ()
+                ),
+                _hook_keys(plugin, hook_id, args, ctx),
+            )
+        ),
+        result.map_(
+            lambda value: (
+                hook_fingerprint(hook_id, args, ctx, value[0], value[1]),
+                value[0],
+                value[1],
+            )
+        ),
+    )
+
+
+def _hook_keys(
+    plugin: PluginInfo, hook_id: str, args: Mapping[str, Any], ctx: ContextLike
+) -> ContextKeys:
+    # Variables a hook does not declare are all part of its fingerprint, an
+    # unrelated change then runs the hook again instead of skipping it wrongly.
+    return ContextKeys(
+        metadata=(
+            frozenset(plugin.metadata[hook_id](args, ctx))
+            if hook_id in plugin.metadata
+            else None
+        ),
+        environ=(
+            frozenset(plugin.environ[hook_id](args, ctx))
+            if hook_id in plugin.environ
+            else None
+        ),
+    )
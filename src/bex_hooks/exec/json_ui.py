@@ -0,0 +1,210 @@
+from __future__ import annotations
+
+import contextlib
+import itertools
+import json
+import logging
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Self, TextIO
+
+if TYPE_CHECKING:
+    from contextlib import AbstractContextManager
+    from types import TracebackType
+
+    from bex_hooks.exec.trace import Tracer
+
+# Progress of a task is written at most once per interval, a download would
+# otherwise write an event for every chunk.
+_PROGRESS_INTERVAL = 1.0
+
+
+class JsonUI:
+    __slots__ = ("__ids", "__lock", "__stream", "__tracer")
+
+    def __init__(
+        self,
+        stream: TextIO,
+        *,
+        log_level: int = logging.WARNING,
+        tracer: Tracer | None = None,
+    ):
+        self.__stream = stream
+        self.__tracer = tracer
+        self.__lock = threading.Lock()
+        self.__ids = itertools.count(1)
+
+        # Configure logging
+        root_logger = logging.getLogger()
+        root_logger.setLevel(log_level)
+        for handler in root_logger.handlers[:]:
+            root_logger.removeHandler(handler)
+        root_logger.addHandler(_JsonHandler(self))
+
+    def scope(self, status: str) -> _Scope:
+        return _Scope(self, status)
+
+    def log(self, *objects: Any, end: str = "\n") -> None:
+        self._emit("log", message=_text(objects))
+
+    def print(self, *objects: Any, end: str = "\n") -> None:
+        self._emit("print", message=_text(objects))
+
+    def progress(self) -> _Progress:
+        return _Progress(self)
+
+    def span(self, name: str, /, **args: Any) -> AbstractContextManager[Any]:
+        if self.__tracer is None:
+            return contextlib.nullcontext()
+        return self.__tracer.span(name, **args)
+
+    def metric(self, name: str, value: float, /) -> None:
+        if self.__tracer is not None:
+            self.__tracer.counter(name, value)
+        self._emit("metric", name=name, value=value)
+
+    def _next_id(self) -> int:
+        return next(self.__ids)
+
+    def _emit(self, event: str, /, **fields: Any) -> None:
+        # One write per event, so that events of parallel hooks do not
+        # interleave.
+        with self.__lock:
+            line = json.dumps(
+                {"time": time.time(), "event": event, **fields}, default=str
+            )
+            self.__stream.write(line + "\n")
+            self.__stream.flush()
+
+
+class _JsonHandler(logging.Handler):
+    def __init__(self, ui: JsonUI) -> None:
+        super().__init__()
+        self.__ui = ui
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            self.__ui._emit(
+                "log",
+                level=record.levelname,
+                logger=record.name,
+                message=record.getMessage(),
+            )
+        except Exception:  # noqa: BLE001
+            self.handleError(record)
+
+
+class _Scope:
+    __slots__ = ("__id", "__status", "__ui")
+
+    def __init__(self, ui: JsonUI, status: str) -> None:
+        self.__ui = ui
+        self.__status = status
+        self.__id = ui._next_id()
+
+    def update(self, status: str | None) -> None:
+        if status is not None and status != self.__status:
+            self.__status = status
+            self.__ui._emit("scope_update", id=self.__id, status=status)
+
+    def __enter__(self) -> Self:
+        self.__ui._emit("scope_start", id=self.__id, status=self.__status)
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_val: BaseException | None,
+        exc_tb: TracebackType | None,
+    ) -> None:
+        self.__ui._emit("scope_end", id=self.__id, status=self.__status)
+
+
+class _Task:
+    __slots__ = ("completed", "description", "emitted", "total")
+
+    def __init__(self, description: str, total: float | None) -> None:
+        self.description = description
+        self.total = total
+        self.completed = 0.0
+        self.emitted = time.monotonic()
+
+
+class _Progress:
+    __slots__ = ("__lock", "__tasks", "__ui")
+
+    def __init__(self, ui: JsonUI) -> None:
+        self.__ui = ui
+        self.__lock = threading.Lock()
+        self.__tasks: dict[int, _Task] = {}
+
+    def add_task(self, description: str, /, *, total: float | None = None) -> Any:
+        token = self.__ui._next_id()
+        with self.__lock:
+            self.__tasks[token] = _Task(description, total)
+        self.__ui._emit("task_start", id=token, description=description, total=total)
+        return token
+
+    def update(
+        self,
+        token: int,
+        /,
+        *,
+        description: str | None = None,
+        total: float | None = None,
+        completed: float | None = None,
+        advance: float | None = None,
+    ) -> None:
+        with self.__lock:
+            task = self.__tasks[token]
+            changed = (description is not None and description != task.description) or (
+                total is not None and total != task.total
+            )
+            if description is not None:
+                task.description = description
+            if total is not None:
+                task.total = total
+            if advance is not None:
+                task.completed += advance
+            if completed is not None:
+                task.completed = completed
+
+            now = time.monotonic()
+            if not changed and now - task.emitted < _PROGRESS_INTERVAL:
+                return
+            task.emitted = now
+            fields = {
+                "id": token,
+                "description": task.description,
+                "total": task.total,
+                "completed": task.completed,
+            }
+        self.__ui._emit("task_update", **fields)
+
+    def advance(self, token: int, advance: float) -> None:
+        self.update(token, advance=advance)
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_val: BaseException | None,
+        exc_tb: TracebackType | None,
+    ) -> None:
+        with self.__lock:
+            tasks = list(self.__tasks.items())
+            self.__tasks.clear()
+        for token, task in tasks:
+            self.__ui._emit(
+                "task_end",
+                id=token,
+                description=task.description,
+                total=task.total,
+                completed=task.completed,
+            )
+
+
+def _text(objects: tuple[Any, ...]) -> str:
+    return " ".join(str(value) for value in objects)
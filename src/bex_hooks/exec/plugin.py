@@ -1,32 +1,58 @@
 from __future__ import annotations
 
+import ast
 import functools
+import hashlib
 import importlib
+import json
+import logging
+import os
 import re
+import sys
+import threading
 from dataclasses import dataclass
+from pathlib import Path
 from typing import TYPE_CHECKING, Any, Mapping
 
 from stdlibx import option, result
 from stdlibx.compose import flow, pipe
+from stdlibx.result.types import Error, Ok
 
 from bex_hooks.exec.errors import BexPluginError
+from bex_hooks.exec.utils import write_atomic
 
 if TYPE_CHECKING:
+    from collections.abc import Iterable
+    from importlib.metadata import EntryPoints
+    from re import Match
+
     from stdlibx.result.types import Result
 
-    from bex_hooks.exec._interface import HookFunc
+    from bex_hooks.exec._interface import (
+        AsyncHookFunc,
+        HookFilesFunc,
+        HookFunc,
+        HookKeysFunc,
+    )
 
 _ENTRYPOINT_PATTERN = re.compile(
     r"(?P<module>[\w.]+)\s*"
     r"(:\s*(?P<attr>[\w.]+)\s*)?"
     r"((?P<extras>\[.*\])\s*)?$"
 )
+_ENTRYPOINT_GROUP = "bex_hooks.plugins"
 
 
 @dataclass(frozen=True)
 class PluginInfo:
     name: str
-    hooks: Mapping[str, HookFunc]
+    hooks: Mapping[str, HookFunc | AsyncHookFunc]
+    inputs: Mapping[str, HookFilesFunc]
+    outputs: Mapping[str, HookFilesFunc]
+    environ: Mapping[str, HookKeysFunc]
+    metadata: Mapping[str, HookKeysFunc]
+    # Glob patterns of the inputs, matched again by `watch` for new files
+    patterns: Mapping[str, HookFilesFunc]
 
 
 def plugin_from_entrypoint(entrypoint: str):
@@ -40,16 +66,7 @@ def plugin_from_entrypoint(entrypoint: str):
                 return error
 
     return flow(
-        result.try_(_ENTRYPOINT_PATTERN.match, entrypoint),
-        result.and_then(
-            lambda match: (
-                result.ok(match)
-                if match is not None
-                else result.error(
-                    BexPluginError(f"Invalid plugin entrypoint format '{entrypoint}'")
-                )
-            )
-        ),
+        _parse_entrypoint(entrypoint),
         result.and_then(
             result.safe(
                 lambda match_: functools.reduce(
@@ -62,17 +79,226 @@ def plugin_from_entrypoint(entrypoint: str):
         result.and_then(
             lambda module: result.collect(
                 result.ok(getattr(module, "__plugin_name__", module.__name__)),
-                _load_hooks(module),
+                _load_mapping(module, "get_hooks"),
+                _load_mapping(module, "get_hook_inputs"),
+                _load_mapping(module, "get_hook_outputs"),
+                _load_mapping(module, "get_hook_environ"),
+                _load_mapping(module, "get_hook_metadata"),
+                _load_mapping(module, "get_hook_patterns"),
             )
         ),
-        result.map_(lambda value: PluginInfo(value[0], value[1])),
+        result.map_(lambda value: PluginInfo(*value)),
         result.map_err(_map_errors),
     )
 
 
-def _load_hooks(module: Any) -> Result[dict[str, HookFunc], Exception]:
+def manifest_from_entrypoint(
+    entrypoint: str,
+) -> Result[frozenset[str] | None, Exception]:
+    # Read the `__hooks__` attribute of the plugin module from its source, so
+    # that the module is only imported once one of its hooks runs.
+    return flow(
+        _parse_entrypoint(entrypoint),
+        result.and_then(
+            lambda match: (
+                result.ok(None)
+                if match.group("attr") is not None
+                else flow(
+                    result.try_(_read_manifest, match.group("module")),
+                    # Plugins without a readable manifest are imported instead
+                    result.or_(result.ok(None)),
+                )
+            )
+        ),
+    )
+
+
+def discover_plugins(cache_file: Path) -> Result[dict[str, str], Exception]:
+    # Maps the hooks of every installed plugin to its entrypoint. Building it
+    # requires reading (and sometimes importing) each plugin, so it is cached
+    # until the installed distributions change.
+    key = distributions_key()
+    match flow(
+        result.try_(cache_file.read_bytes),
+        result.and_then(result.safe(json.loads)),
+    ):
+        case Ok({"key": cached_key, "hooks": dict() as hooks}) if cached_key == key:
+            return result.ok(hooks)
+
+    return flow(
+        result.try_(_entry_points, group=_ENTRYPOINT_GROUP),
+        result.and_then(
+            lambda entrypoints: result.collect_all(
+                _hooks_from_entrypoint(_entrypoint.value)
+                for _entrypoint in sorted(entrypoints, key=lambda ep: ep.name)
+            )
+        ),
+        result.map_(
+            lambda values: {k: v for value in values for k, v in value.items()}
+        ),
+        result.inspect(
+            lambda hooks: flow(
+                result.try_(
+                    write_atomic, cache_file, json.dumps({"key": key, "hooks": hooks})
+                ),
+                result.inspect_err(
+                    lambda err: logging.getLogger("bex_hooks.plugin").warning(
+                        "Failed to cache plugin registry: %s", err
+                    )
+                ),
+            )
+        ),
+    )
+
+
+def distributions_key() -> str:
+    # Based on the metadata directories found on the path, which are named
+    # after the distribution and its version, without reading them.
+    entries: list[tuple[str, str, int]] = []
+    for path in sys.path:
+        try:
+            with os.scandir(path or ".") as it:
+                entries.extend(
+                    (path, entry.name, entry.stat().st_mtime_ns)
+                    for entry in it
+                    if entry.name.endswith((".dist-info", ".egg-info"))
+                )
+        except OSError:
+            continue
+    return hashlib.sha256(json.dumps(sorted(entries)).encode("utf-8")).hexdigest()
+
+
+class PluginRegistry:
+    __slots__ = ("__entrypoints", "__lock", "__plugins")
+
+    def __init__(self) -> None:
+        self.__entrypoints: dict[str, str] = {}
+        self.__plugins: dict[str, PluginInfo] = {}
+        self.__lock = threading.Lock()
+
+    def discover(self, hooks: Mapping[str, str]) -> None:
+        # Discovered plugins are only used for hooks that no explicitly
+        # registered plugin provides.
+        with self.__lock:
+            for hook_id, entrypoint in hooks.items():
+                if hook_id not in self.__entrypoints and hook_id not in self.__plugins:
+                    self.__entrypoints[hook_id] = entrypoint
+
+    def register(self, entrypoint: str) -> Result[None, Exception]:
+        match manifest_from_entrypoint(entrypoint):
+            case Ok(None):
+                return flow(
+                    self.__import(entrypoint),
+                    result.map_(lambda plugin: self.__add(plugin, plugin.hooks)),
+                )
+            case Ok(hook_ids):
+                with self.__lock:
+                    for hook_id in hook_ids:
+                        self.__entrypoints[hook_id] = entrypoint
+                        self.__plugins.pop(hook_id, None)
+                return result.ok(None)
+            case Error(_) as err:
+                return result.error(err.error)
+
+    def get(self, hook_id: str) -> Result[PluginInfo | None, Exception]:
+        with self.__lock:
+            if hook_id in self.__plugins:
+                return result.ok(self.__plugins[hook_id])
+            if hook_id not in self.__entrypoints:
+                return result.ok(None)
+
+            entrypoint = self.__entrypoints[hook_id]
+            return flow(
+                self.__import(entrypoint),
+                result.inspect(
+                    lambda plugin: self.__add(
+                        plugin,
+                        [
+                            _hook_id
+                            for _hook_id in plugin.hooks
+                            if self.__entrypoints.get(_hook_id) == entrypoint
+                        ],
+                    )
+                ),
+                result.map_(lambda _: self.__plugins.get(hook_id)),
+            )
+
+    def __import(self, entrypoint: str) -> Result[PluginInfo, Exception]:
+        logger = logging.getLogger("bex_hooks.plugin")
+        return flow(
+            plugin_from_entrypoint(entrypoint),
+            result.inspect(lambda _: logger.info("Imported plugin '%s'", entrypoint)),
+            result.inspect_err(
+                lambda _: logger.error("Failed to import plugin '%s'", entrypoint)
+            ),
+        )
+
+    def __add(self, plugin: PluginInfo, hook_ids: Iterable[str]) -> None:
+        for hook_id in hook_ids:
+            self.__entrypoints.pop(hook_id, None)
+            self.__plugins[hook_id] = plugin
+
+
+def _hooks_from_entrypoint(entrypoint: str) -> Result[dict[str, str], Exception]:
+    return flow(
+        manifest_from_entrypoint(entrypoint),
+        result.and_then(
+            lambda manifest: (
+                result.ok(manifest)
+                if manifest is not None
+                else flow(
+                    plugin_from_entrypoint(entrypoint),
+                    result.map_(lambda plugin: frozenset(plugin.hooks)),
+                )
+            )
+        ),
+        result.map_(lambda hook_ids: dict.fromkeys(sorted(hook_ids), entrypoint)),
+    )
+
+
+def _parse_entrypoint(entrypoint: str) -> Result[Match[str], Exception]:
+    return flow(
+        result.try_(_ENTRYPOINT_PATTERN.match, entrypoint),
+        result.and_then(
+            lambda match: (
+                result.ok(match)
+                if match is not None
+                else result.error(
+                    BexPluginError(f"Invalid plugin entrypoint format '{entrypoint}'")
+                )
+            )
+        ),
+    )
+
+
+def _read_manifest(module: str) -> frozenset[str] | None:
+    import importlib.util
+
+    spec = importlib.util.find_spec(module)
+    if spec is None or spec.origin is None or not spec.origin.endswith(".py"):
+        return None
+
+    for node in ast.parse(Path(spec.origin).read_bytes()).body:
+        match node:
+            case ast.Assign(targets=[ast.Name(id="__hooks__")], value=value):
+                return frozenset(ast.literal_eval(value))
+            case ast.AnnAssign(target=ast.Name(id="__hooks__"), value=value) if (
+                value is not None
+            ):
+                return frozenset(ast.literal_eval(value))
+    return None
+
+
+def _entry_points(*, group: str) -> EntryPoints:
+    # Only read when the discovered plugins are not cached, it is slow to import
+    import importlib.metadata
+
+    return importlib.metadata.entry_points(group=group)
+
+
+def _load_mapping(module: Any, attr: str) -> Result[dict[str, Any], Exception]:
     return flow(
-        option.maybe(getattr, module, "get_hooks", None),
+        option.maybe(getattr, module, attr, None),
         option.map_or_else(
             lambda: result.ok({}),
             pipe(
@@ -0,0 +1,197 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import os
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import TYPE_CHECKING, TypeVar
+
+from stdlibx import result
+from stdlibx.cancel import CancellationTokenCancelledError, with_cancel
+from stdlibx.compose import flow
+from stdlibx.result.types import Error, Ok
+
+if TYPE_CHECKING:
+    from collections.abc import (
+        Awaitable,
+        Callable,
+        Collection,
+        Mapping,
+        Sequence,
+    )
+
+    from stdlibx.cancel import CancellationToken
+    from stdlibx.result.types import Result
+
+T = TypeVar("T")
+
+
+def schedule(
+    token: CancellationToken,
+    dependencies: Sequence[Collection[int]],
+    run: Callable[[CancellationToken, int], Result[T, Exception]],
+    *,
+    max_workers: int | None = None,
+    groups: Sequence[int | None] = (),
+    limits: Mapping[int, int] | None = None,
+) -> Result[list[T], Exception]:
+    # The first failure cancels the remaining tasks, and is only reported once
+    # every running task has returned.
+    token_, cancel = with_cancel(token)
+    graph = _Graph(dependencies, groups, limits or {})
+
+    results: dict[int, T] = {}
+    first_error: Exception | None = None
+    # The default of ThreadPoolExecutor
+    workers = max_workers or min(32, (os.cpu_count() or 1) + 4)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bex-hook") as pool:
+        running: dict[Future[Result[T, Exception]], int] = {}
+        while graph.has_ready() or len(running) > 0:
+            # Only submitted when a worker is free, a task queued in the pool
+            # would start even after the first failure.
+            while graph.has_ready() and first_error is None and len(running) < workers:
+                if token_.is_cancelled():
+                    break
+                index = graph.pop()
+                running[pool.submit(run, token_, index)] = index
+
+            if len(running) == 0:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in sorted(done, key=running.__getitem__):
+                index = running.pop(future)
+                match flow(result.try_(future.result), result.flatten()):
+                    case Ok(value):
+                        results[index] = value
+                        graph.complete(index)
+                    case Error(err) if first_error is None:
+                        first_error = err
+                        cancel()
+
+    return _collect(token_, len(dependencies), results, first_error)
+
+
+async def schedule_async(
+    token: CancellationToken,
+    dependencies: Sequence[Collection[int]],
+    run: Callable[[CancellationToken, int], Awaitable[Result[T, Exception]]],
+    *,
+    max_workers: int | None = None,
+    groups: Sequence[int | None] = (),
+    limits: Mapping[int, int] | None = None,
+) -> Result[list[T], Exception]:
+    token_, cancel = with_cancel(token)
+    graph = _Graph(dependencies, groups, limits or {})
+
+    results: dict[int, T] = {}
+    first_error: Exception | None = None
+    running: dict[asyncio.Task[Result[T, Exception]], int] = {}
+    while graph.has_ready() or len(running) > 0:
+        while (
+            graph.has_ready()
+            and first_error is None
+            and (max_workers is None or len(running) < max_workers)
+        ):
+            if token_.is_cancelled():
+                break
+            index = graph.pop()
+            running[asyncio.ensure_future(run(token_, index))] = index
+
+        if len(running) == 0:
+            break
+
+        done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+        for task in sorted(done, key=running.__getitem__):
+            index = running.pop(task)
+            match flow(result.try_(task.result), result.flatten()):
+                case Ok(value):
+                    results[index] = value
+                    graph.complete(index)
+                case Error(err) if first_error is None:
+                    first_error = err
+                    cancel()
+
+    return _collect(token_, len(dependencies), results, first_error)
+
+
+class _Graph:
+    # Tasks of a group with a limit wait, once ready, until fewer than the
+    # limit of that group are running.
+    __slots__ = (
+        "__dependents",
+        "__groups",
+        "__limits",
+        "__ready",
+        "__remaining",
+        "__running",
+        "__waiting",
+    )
+
+    def __init__(
+        self,
+        dependencies: Sequence[Collection[int]],
+        groups: Sequence[int | None] = (),
+        limits: Mapping[int, int] | None = None,
+    ) -> None:
+        self.__groups = groups
+        self.__limits = limits or {}
+        self.__running = dict.fromkeys(self.__limits, 0)
+        self.__waiting: dict[int, list[int]] = {group: [] for group in self.__limits}
+        self.__remaining = [set(deps) for deps in dependencies]
+        self.__dependents: list[list[int]] = [[] for _ in dependencies]
+        for index, deps in enumerate(dependencies):
+            for dep in deps:
+                self.__dependents[dep].append(index)
+
+        self.__ready = [
+            index for index, deps in enumerate(self.__remaining) if len(deps) == 0
+        ]
+        heapq.heapify(self.__ready)
+
+    def has_ready(self) -> bool:
+        while len(self.__ready) > 0:
+            group = self.__group(self.__ready[0])
+            if group is None or self.__running[group] < self.__limits[group]:
+                return True
+            self.__waiting[group].append(heapq.heappop(self.__ready))
+        return False
+
+    def pop(self) -> int:
+        index = heapq.heappop(self.__ready)
+        group = self.__group(index)
+        if group is not None:
+            self.__running[group] += 1
+        return index
+
+    def complete(self, index: int) -> None:
+        group = self.__group(index)
+        if group is not None:
+            self.__running[group] -= 1
+            for waiting in self.__waiting[group]:
+                heapq.heappush(self.__ready, waiting)
+            self.__waiting[group].clear()
+
+        for dependent in self.__dependents[index]:
+            self.__remaining[dependent].discard(index)
+            if len(self.__remaining[dependent]) == 0:
+                heapq.heappush(self.__ready, dependent)
+
+    def __group(self, index: int) -> int | None:
+        # Only groups with a limit are tracked
+        if index < len(self.__groups) and self.__groups[index] in self.__limits:
+            return self.__groups[index]
+        return None
+
+
+def _collect(
+    token: CancellationToken,
+    count: int,
+    results: Mapping[int, T],
+    first_error: Exception | None,
+) -> Result[list[T], Exception]:
+    if first_error is not None:
+        return result.error(first_error)
+    if len(results) < count:
+        return result.error(token.get_error() or CancellationTokenCancelledError())
+    return result.ok([results[index] for index in range(count)])
@@ -0,0 +1,250 @@
+from __future__ import annotations
+
+import contextlib
+import json
+import logging
+import socket
+import socketserver
+import threading
+from collections import defaultdict
+from typing import TYPE_CHECKING, Any
+
+from stdlibx import result
+from stdlibx.cancel import (
+    CancellationTokenCancelledError,
+    CancellationTokenTimeoutError,
+    default_token,
+    with_cancel,
+    with_timeout,
+)
+from stdlibx.compose import flow
+from stdlibx.result.types import Error, Ok
+
+from bex_hooks.exec._interface import Context
+from bex_hooks.exec.errors import BexExecError, BexTimeoutError
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Iterator, Mapping
+    from pathlib import Path
+
+    from stdlibx.cancel import CancellationToken
+    from stdlibx.result.types import Result
+
+    from bex_hooks.exec._interface import UI, ContextLike
+    from bex_hooks.exec.config import Environment
+
+
+def serve(token: CancellationToken, ui: UI, path: Path) -> Result[None, Exception]:
+    # The server keeps what a new process would load again for every request:
+    # the imported plugins, and the parsed configurations with their compiled
+    # conditions. The states of the hooks are read from disk, an unchanged
+    # workflow is answered from its context file without reading them, and
+    # runs outside the server, such as its clients falling back to a local
+    # run, write them too.
+    logger = logging.getLogger("bex_hooks.server")
+    configs = _Configs()
+    requests = _Requests()
+    # Requests for the same workflow run one at a time, the next one is then
+    # usually served from the state of the previous one.
+    locks: defaultdict[Path, threading.Lock] = defaultdict(threading.Lock)
+
+    class _Handler(socketserver.StreamRequestHandler):
+        def handle(self) -> None:
+            match flow(
+                result.try_(self.rfile.readline),
+                result.and_then(result.safe(json.loads)),
+            ):
+                case Ok(request):
+                    response = _handle_request(requests, ui, configs, locks, request)
+                case Error(_) as err:
+                    response = result_document(None, err)
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+    if not hasattr(socketserver, "ThreadingUnixStreamServer"):
+        return result.error(BexExecError("Unix sockets are not supported"))
+
+    def _serve() -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.unlink(missing_ok=True)
+        with socketserver.ThreadingUnixStreamServer(str(path), _Handler) as server:
+            server.daemon_threads = True
+            token.register(lambda _: threading.Thread(target=server.shutdown).start())
+            token.register(lambda _: requests.close())
+            if token.is_cancelled():
+                return
+
+            logger.info("Listening on %s", path)
+            ui.print(f"Serving on {path}")
+            try:
+                server.serve_forever()
+            finally:
+                path.unlink(missing_ok=True)
+
+    return result.try_(_serve)
+
+
+def request(path: Path, data: Mapping[str, Any]) -> Result[dict[str, Any], Exception]:
+    def _request() -> dict[str, Any]:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(str(path))
+            client.sendall(json.dumps(data).encode("utf-8") + b"\n")
+            with client.makefile("rb") as response:
+                return json.loads(response.readline())
+
+    return result.try_(_request)
+
+
+def document_result(document: Mapping[str, Any]) -> Result[ContextLike, Exception]:
+    match document:
+        case {"status": "success", "context": context}:
+            return result.ok(
+                Context(
+                    working_dir=context["working_dir"],
+                    metadata=context["metadata"],
+                    environ=context["environ"],
+                )
+            )
+        case {"status": "cancelled"}:
+            return result.error(CancellationTokenCancelledError())
+        case {"status": "timeout", "error": error}:
+            return result.error(BexTimeoutError(error))
+        case _:
+            return result.error(BexExecError(document.get("error", "Unknown error")))
+
+
+def result_document(
+    file: Path | None, exec_result: Result[ContextLike, Exception]
+) -> dict[str, Any]:
+    match exec_result:
+        case Ok(value):
+            return {
+                "file": str(file) if file is not None else None,
+                "status": "success",
+                "context": {
+                    "working_dir": value.working_dir,
+                    "metadata": dict(value.metadata),
+                    "environ": dict(value.environ),
+                },
+            }
+        case Error(err):
+            match err:
+                case CancellationTokenCancelledError():
+                    status = "cancelled"
+                case BexTimeoutError() | CancellationTokenTimeoutError():
+                    status = "timeout"
+                case _:
+                    status = "failure"
+            return {
+                "file": str(file) if file is not None else None,
+                "status": status,
+                "error": err.msg if isinstance(err, BexExecError) else repr(err),
+            }
+
+
+def _handle_request(
+    requests: _Requests,
+    ui: UI,
+    configs: _Configs,
+    locks: defaultdict[Path, threading.Lock],
+    request: Any,
+) -> dict[str, Any]:
+    from bex_hooks.exec.config import ServerRequest
+    from bex_hooks.exec.executor import execute
+
+    match result.try_(lambda: ServerRequest.model_validate(request)):
+        case Ok(data):
+            with requests.token(data.deadline) as token:
+                match configs.load(
+                    data.directory, data.file, use_cache=data.use_config_cache
+                ):
+                    case Ok(env):
+                        with locks[env.filename]:
+                            return result_document(
+                                env.filename,
+                                execute(token, ui, {}, data.environ, env),
+                            )
+                    case Error(_) as err:
+                        return result_document(data.file, err)
+        case Error(_) as err:
+            return result_document(None, err)
+
+
+class _Requests:
+    # Tokens of the requests being served, cancelled when the server stops.
+    # They are not registered on the token of the server, which would keep
+    # the callbacks of every request until it stops.
+    __slots__ = ("__cancels", "__closed", "__lock")
+
+    def __init__(self) -> None:
+        self.__cancels: set[Callable[[], None]] = set()
+        self.__closed = False
+        self.__lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def token(self, deadline: float | None) -> Iterator[CancellationToken]:
+        token, cancel = with_cancel(default_token())
+        if deadline is not None:
+            # Cancelled with the request token, which also stops its timer
+            token, _ = with_timeout(token, deadline)
+
+        with self.__lock:
+            closed = self.__closed
+            if not closed:
+                self.__cancels.add(cancel)
+        if closed:
+            cancel()
+
+        try:
+            yield token
+        finally:
+            with self.__lock:
+                self.__cancels.discard(cancel)
+            cancel()
+
+    def close(self) -> None:
+        with self.__lock:
+            self.__closed = True
+            cancels, self.__cancels = self.__cancels, set()
+        for cancel in cancels:
+            cancel()
+
+
+class _Configs:
+    # Parsed configurations, loaded again when their file changes
+    __slots__ = ("__entries", "__lock")
+
+    def __init__(self) -> None:
+        self.__entries: dict[
+            tuple[Path, Path | None], tuple[Environment, tuple[int, int] | None]
+        ] = {}
+        self.__lock = threading.Lock()
+
+    def load(
+        self, directory: Path, file: Path | None, *, use_cache: bool
+    ) -> Result[Environment, Exception]:
+        from bex_hooks.exec.config import load_config
+
+        key = (directory, file)
+        with self.__lock:
+            entry = self.__entries.get(key)
+        if entry is not None:
+            signature = _file_signature(entry[0].filename)
+            if signature is not None and signature == entry[1]:
+                return result.ok(entry[0])
+
+        def _store(env: Environment) -> None:
+            with self.__lock:
+                self.__entries[key] = (env, _file_signature(env.filename))
+
+        return flow(
+            load_config(directory, file, use_cache=use_cache),
+            result.inspect(_store),
+        )
+
+
+def _file_signature(file: Path) -> tuple[int, int] | None:
+    try:
+        _stat = file.stat()
+    except OSError:
+        return None
+    return (_stat.st_size, _stat.st_mtime_ns)
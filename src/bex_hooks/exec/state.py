@@ -0,0 +1,315 @@
+from __future__ import annotations
+
+import fnmatch
+import hashlib
+import json
+import os
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+from stdlibx import result
+from stdlibx.compose import flow
+
+from bex_hooks.exec.context import ContextDelta, apply_deltas, flatten_context
+from bex_hooks.exec.utils import write_atomic
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable, Mapping
+
+    from stdlibx.result.types import Result
+
+    from bex_hooks.exec._interface import ContextLike
+
+
+@dataclass(frozen=True)
+class HookState:
+    fingerprint: str
+    inputs: Mapping[str, str | None]
+    outputs: Mapping[str, str | None]
+    delta: ContextDelta
+
+
+@dataclass(frozen=True)
+class ContextState:
+    key: str
+    # Variables of the initial context the key depends on
+    keys: ContextKeys
+    files: Mapping[str, str | None]
+    # Changes of the workflow to the initial context
+    delta: ContextDelta
+
+
+@dataclass(frozen=True)
+class ContextKeys:
+    # Patterns of the metadata and environment variables a hook reads, None
+    # when the hook may read any of them.
+    metadata: frozenset[str] | None = None
+    environ: frozenset[str] | None = None
+
+    def union(self, other: ContextKeys) -> ContextKeys:
+        return ContextKeys(
+            metadata=_union(self.metadata, other.metadata),
+            environ=_union(self.environ, other.environ),
+        )
+
+
+def select_keys(
+    mapping: Mapping[str, Any], patterns: frozenset[str] | None
+) -> dict[str, Any]:
+    if patterns is None:
+        return dict(mapping)
+
+    # Plain names are looked up, only patterns go through every key
+    if not any(char in pattern for pattern in patterns for char in "*?["):
+        return {key: mapping[key] for key in sorted(patterns) if key in mapping}
+
+    matcher = re.compile(
+        "|".join(fnmatch.translate(pattern) for pattern in sorted(patterns))
+    )
+    return {key: value for key, value in mapping.items() if matcher.match(key)}
+
+
+def hook_key(hook_id: str, name: str | None, args: Mapping[str, Any]) -> str:
+    return _digest([hook_id, name, args])
+
+
+def hook_fingerprint(
+    hook_id: str,
+    args: Mapping[str, Any],
+    ctx: ContextLike,
+    inputs: Mapping[str, str | None],
+    keys: ContextKeys,
+) -> str:
+    return _digest(
+        {
+            "id": hook_id,
+            "args": args,
+            "working_dir": ctx.working_dir,
+            "metadata": select_keys(ctx.metadata, keys.metadata),
+            "environ": select_keys(ctx.environ, keys.environ),
+            "inputs": inputs,
+        }
+    )
+
+
+def files_signature(paths: Iterable[str]) -> dict[str, str | None]:
+    return {path: _path_signature(Path(path)) for path in paths}
+
+
+def load_state(directory: Path, key: str) -> Result[HookState | None, Exception]:
+    _file = directory / f"{key}.json"
+    if not _file.is_file():
+        return result.ok(None)
+
+    return flow(
+        result.try_(_file.read_bytes),
+        result.and_then(result.safe(json.loads)),
+        result.and_then(
+            result.safe(
+                lambda data: HookState(
+                    fingerprint=data["fingerprint"],
+                    inputs=data.get("inputs", {}),
+                    outputs=data["outputs"],
+                    delta=_load_delta(data["delta"]),
+                )
+            )
+        ),
+    )
+
+
+def save_state(directory: Path, key: str, state: HookState) -> Result[None, Exception]:
+    return flow(
+        result.try_(
+            json.dumps,
+            {
+                "fingerprint": state.fingerprint,
+                "inputs": state.inputs,
+                "outputs": state.outputs,
+                "delta": _dump_delta(state.delta),
+            },
+        ),
+        result.and_then(
+            result.safe(lambda data: write_atomic(directory / f"{key}.json", data))
+        ),
+    )
+
+
+def context_key(
+    config_file: Path, distributions: str, ctx: ContextLike, keys: ContextKeys
+) -> Result[str, Exception]:
+    return flow(
+        result.try_(config_file.read_bytes),
+        result.map_(
+            lambda data: _digest(
+                {
+                    "config": hashlib.sha256(data).hexdigest(),
+                    "distributions": distributions,
+                    "working_dir": ctx.working_dir,
+                    "metadata": select_keys(ctx.metadata, keys.metadata),
+                    "environ": select_keys(ctx.environ, keys.environ),
+                }
+            )
+        ),
+    )
+
+
+def cached_context(
+    file: Path, config_file: Path, distributions: str, ctx: ContextLike
+) -> Result[ContextLike | None, Exception]:
+    # The changes of the last run are applied to the initial context, which
+    # may differ in the variables that no hook reads.
+    def _cached(state: ContextState | None) -> Result[ContextLike | None, Exception]:
+        if state is None:
+            return result.ok(None)
+        return flow(
+            context_key(config_file, distributions, ctx, state.keys),
+            result.map_(
+                lambda key: (
+                    flatten_context(apply_deltas(ctx, [state.delta]))
+                    if key == state.key and files_signature(state.files) == state.files
+                    else None
+                )
+            ),
+        )
+
+    return flow(load_context_state(file), result.and_then(_cached))
+
+
+def load_context_state(file: Path) -> Result[ContextState | None, Exception]:
+    if not file.is_file():
+        return result.ok(None)
+
+    return flow(
+        result.try_(file.read_bytes),
+        result.and_then(result.safe(json.loads)),
+        result.and_then(
+            result.safe(
+                lambda data: (
+                    ContextState(
+                        key=data["key"],
+                        keys=ContextKeys(
+                            metadata=_load_patterns(data["keys"]["metadata"]),
+                            environ=_load_patterns(data["keys"]["environ"]),
+                        ),
+                        files=data["files"],
+                        delta=_load_delta(data["delta"]),
+                    )
+                    # Saved by a previous version
+                    if "delta" in data
+                    else None
+                )
+            )
+        ),
+    )
+
+
+def save_context_state(file: Path, state: ContextState) -> Result[None, Exception]:
+    return flow(
+        result.try_(
+            json.dumps,
+            {
+                "key": state.key,
+                "keys": {
+                    "metadata": _dump_patterns(state.keys.metadata),
+                    "environ": _dump_patterns(state.keys.environ),
+                },
+                "files": state.files,
+                "delta": _dump_delta(state.delta),
+            },
+        ),
+        result.and_then(result.safe(lambda data: write_atomic(file, data))),
+    )
+
+
+def load_durations(file: Path) -> Result[dict[str, float], Exception]:
+    if not file.is_file():
+        return result.ok({})
+
+    return flow(
+        result.try_(file.read_bytes),
+        result.and_then(result.safe(json.loads)),
+    )
+
+
+def save_durations(
+    file: Path, durations: Mapping[str, float]
+) -> Result[None, Exception]:
+    return flow(
+        result.try_(json.dumps, durations),
+        result.and_then(result.safe(lambda data: write_atomic(file, data))),
+    )
+
+
+def _union(
+    patterns: frozenset[str] | None, other: frozenset[str] | None
+) -> frozenset[str] | None:
+    if patterns is None or other is None:
+        return None
+    return patterns | other
+
+
+def _load_delta(data: Mapping[str, Any]) -> ContextDelta:
+    return ContextDelta(
+        working_dir=data["working_dir"],
+        metadata=data["metadata"],
+        environ=data["environ"],
+        removed_metadata=frozenset(data["removed_metadata"]),
+        removed_environ=frozenset(data["removed_environ"]),
+    )
+
+
+def _dump_delta(delta: ContextDelta) -> dict[str, Any]:
+    return {
+        "working_dir": delta.working_dir,
+        "metadata": dict(delta.metadata),
+        "environ": dict(delta.environ),
+        "removed_metadata": sorted(delta.removed_metadata),
+        "removed_environ": sorted(delta.removed_environ),
+    }
+
+
+def _load_patterns(value: list[str] | None) -> frozenset[str] | None:
+    return frozenset(value) if value is not None else None
+
+
+def _dump_patterns(value: frozenset[str] | None) -> list[str] | None:
+    return sorted(value) if value is not None else None
+
+
+def _path_signature(path: Path) -> str | None:
+    # Based on sizes and modification times, hashing the content of large
+    # outputs (e.g. virtual environments) would cost more than running
+    # most hooks.
+    try:
+        _stat = path.stat()
+    except FileNotFoundError:
+        return None
+
+    if not path.is_dir():
+        return _digest([_stat.st_size, _stat.st_mtime_ns])
+
+    entries: list[tuple[str, int, int]] = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            _file = os.path.join(root, name)
+            try:
+                _file_stat = os.stat(_file)
+            except FileNotFoundError:
+                continue
+            entries.append(
+                (
+                    os.path.relpath(_file, path),
+                    _file_stat.st_size,
+                    _file_stat.st_mtime_ns,
+                )
+            )
+    return _digest(entries)
+
+
+def _digest(value: Any) -> str:
+    return hashlib.sha256(
+        json.dumps(value, sort_keys=True, default=repr).encode("utf-8")
+    ).hexdigest()
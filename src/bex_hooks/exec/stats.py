@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import json
+import math
+import statistics
+from dataclasses import asdict, dataclass, field
+from typing import TYPE_CHECKING, Literal
+
+from stdlibx import result
+from stdlibx.compose import flow
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable, Mapping, Sequence
+    from pathlib import Path
+
+    from stdlibx.result.types import Result
+
+Outcome = Literal["success", "failure", "timeout", "cancelled"]
+
+
+@dataclass(frozen=True)
+class HookRecord:
+    time: float
+    hook_id: str
+    name: str | None
+    key: str
+    duration: float
+    outcome: Outcome
+    cached: bool
+    # CPU time of the subprocesses reported by the hook, None when it did
+    # not report any
+    cpu_time: float | None = None
+    # Reported by the hook through `ui.metric`, e.g. downloaded_bytes
+    metrics: Mapping[str, float] = field(default_factory=dict)
+
+
+@dataclass(frozen=True)
+class HookStats:
+    hook_id: str
+    name: str | None
+    key: str
+    runs: int
+    p50: float
+    p90: float
+    p99: float
+    latest: float
+    regressed: bool
+    cpu_time: float | None
+    downloaded_bytes: float | None
+
+
+def append_records(
+    file: Path, records: Sequence[HookRecord]
+) -> Result[None, Exception]:
+    # Records of one execution are written at once, so that executions
+    # running at the same time do not interleave their lines.
+    def _append(data: str) -> None:
+        file.parent.mkdir(parents=True, exist_ok=True)
+        with open(file, "a", encoding="utf-8") as dest:
+            dest.write(data)
+
+    if len(records) == 0:
+        return result.ok(None)
+
+    return flow(
+        result.try_(
+            lambda: "".join(json.dumps(asdict(record)) + "\n" for record in records)
+        ),
+        result.and_then(result.safe(_append)),
+    )
+
+
+def load_records(file: Path) -> Result[list[HookRecord], Exception]:
+    if not file.is_file():
+        return result.ok([])
+
+    return flow(
+        result.try_(file.read_text, encoding="utf-8"),
+        result.and_then(
+            result.safe(
+                lambda data: [
+                    HookRecord(**json.loads(line))
+                    for line in data.splitlines()
+                    if len(line) > 0
+                ]
+            )
+        ),
+    )
+
+
+def summarize(
+    records: Iterable[HookRecord], *, threshold: float = 1.5, min_runs: int = 3
+) -> list[HookStats]:
+    # Only successful runs are compared, cache hits and failures do not say
+    # anything about how long the hook takes.
+    runs: dict[str, list[HookRecord]] = {}
+    for record in records:
+        if record.outcome == "success" and not record.cached:
+            runs.setdefault(record.key, []).append(record)
+
+    summary: list[HookStats] = []
+    for key, _records in runs.items():
+        durations = [record.duration for record in _records]
+        history = durations[:-1]
+        summary.append(
+            HookStats(
+                hook_id=_records[-1].hook_id,
+                name=_records[-1].name,
+                key=key,
+                runs=len(durations),
+                p50=_percentile(durations, 50),
+                p90=_percentile(durations, 90),
+                p99=_percentile(durations, 99),
+                latest=durations[-1],
+                regressed=(
+                    len(history) >= min_runs
+                    and durations[-1] > threshold * statistics.median(history)
+                ),
+                cpu_time=_records[-1].cpu_time,
+                downloaded_bytes=_records[-1].metrics.get("downloaded_bytes"),
+            )
+        )
+    return summary
+
+
+def _percentile(values: Sequence[float], percent: float) -> float:
+    ordered = sorted(values)
+    return ordered[max(math.ceil(percent / 100 * len(ordered)) - 1, 0)]
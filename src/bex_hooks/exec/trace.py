@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import itertools
+import json
+import os
+import threading
+import time
+import weakref
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+    from pathlib import Path
+
+
+class Tracer:
+    __slots__ = ("__events", "__lock", "__origin", "__task_ids", "__tasks", "__tracks")
+
+    def __init__(self) -> None:
+        self.__events: list[dict[str, Any]] = []
+        self.__lock = threading.Lock()
+        self.__origin = time.perf_counter_ns()
+        self.__tracks: set[int] = set()
+        self.__task_ids = itertools.count(1)
+        self.__tasks: weakref.WeakKeyDictionary[asyncio.Task[Any], int] = (
+            weakref.WeakKeyDictionary()
+        )
+
+    @contextlib.contextmanager
+    def span(self, name: str, /, **args: Any) -> Iterator[None]:
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.perf_counter_ns(), **args)
+
+    def add(self, name: str, start: int, end: int, /, **args: Any) -> None:
+        with self.__lock:
+            tid, track = self.__track()
+            if tid not in self.__tracks:
+                self.__tracks.add(tid)
+                self.__events.append(
+                    {
+                        "name": "thread_name",
+                        "ph": "M",
+                        "pid": os.getpid(),
+                        "tid": tid,
+                        "args": {"name": track},
+                    }
+                )
+            self.__events.append(
+                {
+                    "name": name,
+                    "ph": "X",
+                    "ts": (start - self.__origin) / 1000,
+                    "dur": (end - start) / 1000,
+                    "pid": os.getpid(),
+                    "tid": tid,
+                    "args": {
+                        key: str(value)
+                        for key, value in args.items()
+                        if value is not None
+                    },
+                }
+            )
+
+    def __track(self) -> tuple[int, str]:
+        # The tasks of an event loop run concurrently on its thread, each task
+        # gets a track of its own so that the spans of a track are nested.
+        thread = threading.current_thread()
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        if task is None:
+            return thread.ident or 0, thread.name
+
+        tid = self.__tasks.get(task)
+        if tid is None:
+            # Thread identifiers are addresses, far from these numbers
+            tid = next(self.__task_ids)
+            self.__tasks[task] = tid
+        return tid, f"{thread.name} {task.get_name()}"
+
+    def counter(self, name: str, value: float, /) -> None:
+        event = {
+            "name": name,
+            "ph": "C",
+            "ts": (time.perf_counter_ns() - self.__origin) / 1000,
+            "pid": os.getpid(),
+            "args": {name: value},
+        }
+        with self.__lock:
+            self.__events.append(event)
+
+    def write(self, file: Path) -> None:
+        with self.__lock:
+            data = {"traceEvents": list(self.__events), "displayTimeUnit": "ms"}
+        file.write_text(json.dumps(data))
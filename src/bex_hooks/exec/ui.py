@@ -1,26 +1,48 @@
 from __future__ import annotations
 
+import contextlib
 import logging
+import threading
+import time
 from typing import TYPE_CHECKING, Any, NewType, Self
 
 from rich.logging import RichHandler
 from rich.progress import Progress as RichProgress
-from rich.progress import TaskID
+from rich.progress import SpinnerColumn, TaskID
 
 if TYPE_CHECKING:
+    from contextlib import AbstractContextManager
     from types import TracebackType
 
     from rich.console import Console
-    from rich.status import Status
+
+    from bex_hooks.exec.trace import Tracer
 
 ProgressToken = NewType("ProgressToken", TaskID)
 
+# Rich refreshes the live display 10 times per second, updates in between are
+# coalesced so that downloads do not update the tasks for every chunk.
+_FRAME_INTERVAL = 1 / 10
+
 
 class CliUI:
-    __slots__ = ("__console",)
+    __slots__ = ("__console", "__live", "__live_lock", "__live_users", "__tracer")
 
-    def __init__(self, console: Console, *, log_level: int = logging.WARNING):
+    def __init__(
+        self,
+        console: Console,
+        *,
+        log_level: int = logging.WARNING,
+        tracer: Tracer | None = None,
+    ):
         self.__console = console
+        self.__tracer = tracer
+
+        # Hooks may run in parallel, but rich only supports a single live
+        # display per console, so scopes and progress bars share one.
+        self.__live: RichProgress | None = None
+        self.__live_lock = threading.Lock()
+        self.__live_users = 0
 
         # Configure logging
         root_logger = logging.getLogger()
@@ -33,7 +55,7 @@ class CliUI:
         root_logger.addHandler(handler)
 
     def scope(self, status: str) -> _Scope:
-        return _Scope(self.__console.status(status))
+        return _Scope(self, status)
 
     def log(self, *objects: Any, end: str = "\n") -> None:
         self.__console.log(*objects, end=end)
@@ -42,20 +64,55 @@ class CliUI:
         self.__console.print(*objects, end=end)
 
     def progress(self) -> _Progress:
-        return _Progress(RichProgress(console=self.__console))
+        return _Progress(self)
+
+    def span(self, name: str, /, **args: Any) -> AbstractContextManager[Any]:
+        if self.__tracer is None:
+            return contextlib.nullcontext()
+        return self.__tracer.span(name, **args)
+
+    def metric(self, name: str, value: float, /) -> None:
+        if self.__tracer is not None:
+            self.__tracer.counter(name, value)
+
+    def _acquire_live(self) -> RichProgress:
+        with self.__live_lock:
+            if self.__live is None:
+                self.__live = RichProgress(
+                    SpinnerColumn(),
+                    *RichProgress.get_default_columns(),
+                    console=self.__console,
+                )
+                self.__live.start()
+            self.__live_users += 1
+            return self.__live
+
+    def _release_live(self) -> None:
+        with self.__live_lock:
+            self.__live_users -= 1
+            if self.__live is not None and self.__live_users == 0:
+                self.__live.stop()
+                self.__live = None
 
 
 class _Scope:
-    __slots__ = ("__status",)
+    __slots__ = ("__live", "__status", "__task_id", "__ui")
 
-    def __init__(self, status: Status) -> None:
+    def __init__(self, ui: CliUI, status: str) -> None:
+        self.__ui = ui
         self.__status = status
+        self.__live: RichProgress | None = None
+        self.__task_id: TaskID | None = None
 
     def update(self, status: str | None) -> None:
-        self.__status.update(status)
+        if status is not None:
+            self.__status = status
+        if self.__live is not None and self.__task_id is not None:
+            self.__live.update(self.__task_id, description=status)
 
     def __enter__(self) -> Self:
-        self.__status.__enter__()
+        self.__live = self.__ui._acquire_live()
+        self.__task_id = self.__live.add_task(self.__status, total=None)
         return self
 
     def __exit__(
@@ -64,15 +121,31 @@ class _Scope:
         exc_val: BaseException | None,
         exc_tb: TracebackType | None,
     ) -> None:
-        self.__status.__exit__(exc_type, exc_val, exc_tb)
+        if self.__live is not None and self.__task_id is not None:
+            self.__live.remove_task(self.__task_id)
+            self.__ui._release_live()
+        self.__live = None
+        self.__task_id = None
 
 
 class _Progress:
-    def __init__(self, progress: RichProgress) -> None:
-        self.__progress = progress
+    __slots__ = ("__fields", "__flushed", "__live", "__lock", "__pending", "__ui")
+
+    def __init__(self, ui: CliUI) -> None:
+        self.__ui = ui
+        self.__live: RichProgress | None = None
+        self.__lock = threading.Lock()
+        # Completed value, if set, and advance since, of each task
+        self.__pending: dict[ProgressToken, tuple[float | None, float]] = {}
+        # Description and total shown for each task
+        self.__fields: dict[ProgressToken, tuple[str, float | None]] = {}
+        self.__flushed = 0.0
 
     def add_task(self, description: str, /, *, total: float | None = None) -> Any:
-        return ProgressToken(self.__progress.add_task(description, total=total))
+        token = ProgressToken(self.__progress.add_task(description, total=total))
+        with self.__lock:
+            self.__fields[token] = (description, total)
+        return token
 
     def update(
         self,
@@ -84,19 +157,62 @@ class _Progress:
         completed: float | None = None,
         advance: float | None = None,
     ) -> None:
+        with self.__lock:
+            _completed, _advance = self.__pending.get(token, (None, 0.0))
+            if completed is not None:
+                _completed, _advance = completed, 0.0
+            if advance is not None:
+                _advance += advance
+            self.__pending[token] = (_completed, _advance)
+
+            # Changes of the description or total are shown at once
+            _description, _total = self.__fields[token]
+            if (description is not None and description != _description) or (
+                total is not None and total != _total
+            ):
+                self.__fields[token] = (
+                    _description if description is None else description,
+                    _total if total is None else total,
+                )
+                self.__flush_task(token, description=description, total=total)
+
+            now = time.monotonic()
+            if now - self.__flushed >= _FRAME_INTERVAL:
+                self.__flush(now)
+
+    def advance(self, token: ProgressToken, advance: float) -> None:
+        self.update(token, advance=advance)
+
+    def __flush(self, now: float) -> None:
+        for token in list(self.__pending):
+            self.__flush_task(token)
+        self.__flushed = now
+
+    def __flush_task(
+        self,
+        token: ProgressToken,
+        *,
+        description: str | None = None,
+        total: float | None = None,
+    ) -> None:
+        completed, advance = self.__pending.pop(token, (None, 0.0))
         self.__progress.update(
             token,
             description=description,
             total=total,
-            completed=completed,
-            advance=advance,
+            completed=completed + advance if completed is not None else None,
+            advance=advance if completed is None and advance != 0 else None,
         )
 
-    def advance(self, token: ProgressToken, advance: float) -> None:
-        self.__progress.advance(token, advance)
+    @property
+    def __progress(self) -> RichProgress:
+        if self.__live is None:
+            msg = "Progress must be entered before adding tasks"
+            raise RuntimeError(msg)
+        return self.__live
 
     def __enter__(self) -> Self:
-        self.__progress.__enter__()
+        self.__live = self.__ui._acquire_live()
         return self
 
     def __exit__(
@@ -105,4 +221,8 @@ class _Progress:
         exc_val: BaseException | None,
         exc_tb: TracebackType | None,
     ) -> None:
-        return self.__progress.__exit__(exc_type, exc_val, exc_tb)
+        if self.__live is not None:
+            with self.__lock:
+                self.__flush(time.monotonic())
+            self.__ui._release_live()
+        self.__live = None
@@ -0,0 +1,17 @@
+from __future__ import annotations
+
+import os
+import tempfile
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+def write_atomic(file: Path, data: str | bytes) -> None:
+    file.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        "wb", dir=file.parent, suffix=".tmp", delete=False
+    ) as dest:
+        dest.write(data.encode("utf-8") if isinstance(data, str) else data)
+    os.replace(dest.name, file)
@@ -0,0 +1,166 @@
+from __future__ import annotations
+
+import glob
+import itertools
+import os
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+from stdlibx import result
+from stdlibx.compose import flow
+from stdlibx.result.types import Error, Ok
+
+from bex_hooks.exec.context import initial_context
+from bex_hooks.exec.executor import execute, load_plugins
+from bex_hooks.exec.state import HookState, hook_key, load_state
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Iterable, Mapping, MutableMapping
+
+    from stdlibx.cancel import CancellationToken
+    from stdlibx.result.types import Result
+
+    from bex_hooks.exec._interface import UI, ContextLike, HookFilesFunc
+    from bex_hooks.exec.config import Environment
+    from bex_hooks.exec.plugin import PluginRegistry
+
+
+def watch(
+    token: CancellationToken,
+    ui: UI,
+    load: Callable[[], Result[Environment, Exception]],
+    metadata: MutableMapping[str, Any],
+    environ: MutableMapping[str, str],
+    *,
+    interval: float = 0.5,
+    debounce: float = 0.2,
+) -> Result[None, Exception]:
+    # Each change executes the workflow again, the hooks whose inputs did not
+    # change are skipped with their saved state, so only the changed hooks
+    # and the hooks depending on their changes run.
+    watched: tuple[set[str], set[str]] | None = None
+    while not token.is_cancelled():
+        match load():
+            case Ok(env):
+                ctx = initial_context(str(env.directory), dict(metadata), dict(environ))
+                match execute(token, ui, dict(metadata), dict(environ), env):
+                    case Ok(ctx):
+                        ui.print("Watching for changes")
+                    case Error(_) if token.is_cancelled():
+                        break
+                    case Error(err):
+                        ui.print(f"Failed to execute environment: {err!r}")
+                watched = watched_paths(ui, env, ctx)
+            case Error(_) as err if watched is None:
+                return result.error(err.error)
+            case Error(err):
+                ui.print(f"Failed to load environment: {err!r}")
+
+        _wait_for_change(token, *watched, interval, debounce)
+
+    return result.ok(None)
+
+
+def watched_paths(
+    ui: UI, env: Environment, ctx: ContextLike
+) -> tuple[set[str], set[str]]:
+    # The files the plugin of each hook declares for the context of the last
+    # run, which includes the metadata set by every hook, and the patterns of
+    # its inputs, matched again at each interval so that new files are seen
+    # wherever the patterns reach and other new files are not. The files
+    # recorded at the last run of a hook are used when its plugin can not
+    # tell them, along with the directories of its inputs.
+    state_dir = Path(env.directory) / ".bex" / "state"
+    paths = {str(env.filename)}
+    patterns: set[str] = set()
+    plugins = load_plugins(ui, env)
+    for hook in env.hooks:
+        match _declared_files(plugins, hook, ctx):
+            case Ok((inputs, outputs, None)):
+                paths.update(inputs, outputs)
+                paths.update(os.path.dirname(path) or "." for path in inputs)
+            case Ok((inputs, outputs, hook_patterns)):
+                paths.update(inputs, outputs)
+                patterns.update(hook_patterns)
+            case _:
+                match load_state(
+                    state_dir, hook_key(hook.id, hook.name, hook.__pydantic_extra__)
+                ):
+                    case Ok(HookState() as state):
+                        paths.update(state.inputs, state.outputs)
+                        paths.update(
+                            os.path.dirname(path) or "." for path in state.inputs
+                        )
+    return paths, patterns
+
+
+def _declared_files(
+    plugins: Result[PluginRegistry, Exception],
+    hook: Environment.Hook,
+    ctx: ContextLike,
+) -> Result[tuple[list[str], list[str], list[str] | None] | None, Exception]:
+    args = hook.__pydantic_extra__
+
+    def _files(funcs: Mapping[str, HookFilesFunc]) -> list[str]:
+        return list(funcs[hook.id](args, ctx)) if hook.id in funcs else []
+
+    return flow(
+        plugins,
+        result.and_then(lambda registry: registry.get(hook.id)),
+        result.and_then(
+            result.safe(
+                lambda plugin: (
+                    (
+                        _files(plugin.inputs),
+                        _files(plugin.outputs),
+                        _files(plugin.patterns) if hook.id in plugin.patterns else None,
+                    )
+                    if plugin is not None
+                    else None
+                )
+            )
+        ),
+    )
+
+
+def _wait_for_change(
+    token: CancellationToken,
+    paths: Iterable[str],
+    patterns: Iterable[str],
+    interval: float,
+    debounce: float,
+) -> None:
+    snapshot = _snapshot(paths, patterns)
+    while not token.is_cancelled():
+        token.wait(interval)
+        current = _snapshot(paths, patterns)
+        if current == snapshot:
+            continue
+
+        # Editors and tools write files in several steps, the workflow runs
+        # once they stopped changing.
+        while current != snapshot and not token.is_cancelled():
+            snapshot = current
+            token.wait(debounce)
+            current = _snapshot(paths, patterns)
+        return
+
+
+def _snapshot(
+    paths: Iterable[str], patterns: Iterable[str]
+) -> Mapping[str, tuple[int, int] | None]:
+    # Only the entries themselves, walking the outputs (e.g. virtual
+    # environments) at every interval would cost more than the hooks. Only
+    # the patterns of the inputs are walked, from their roots.
+    snapshot: dict[str, tuple[int, int] | None] = {}
+    for path in itertools.chain(
+        paths,
+        *(glob.iglob(pattern, recursive=True) for pattern in patterns),
+    ):
+        try:
+            _stat = os.stat(path)
+        except OSError:
+            snapshot[path] = None
+        else:
+            snapshot[path] = (_stat.st_size, _stat.st_mtime_ns)
+    return snapshot
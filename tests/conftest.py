@@ -0,0 +1,183 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import glob
+import json
+import sys
+import time
+import types
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Self
+
+import pytest
+from stdlibx import result
+from stdlibx.cancel import default_token
+from stdlibx.compose import flow
+from stdlibx.result.types import Error, Ok
+
+from bex_hooks.exec._interface import Context, LayeredMapping
+from bex_hooks.exec.config import load_config
+from bex_hooks.exec.executor import execute
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Iterable, Mapping
+
+    from bex_hooks.exec._interface import ContextLike
+
+PLUGIN = "bex_tests_plugin"
+
+
+class NullUI:
+    def scope(self, status: str) -> _NullProgress:
+        return _NullProgress()
+
+    def progress(self) -> _NullProgress:
+        return _NullProgress()
+
+    def log(self, *objects: Any, end: str = "\n") -> None:
+        pass
+
+    def print(self, *objects: Any, end: str = "\n") -> None:
+        pass
+
+    def span(self, name: str, /, **args: Any) -> contextlib.nullcontext[None]:
+        return contextlib.nullcontext()
+
+    def metric(self, name: str, value: float, /) -> None:
+        pass
+
+
+class _NullProgress:
+    def update(self, *args: Any, **kwargs: Any) -> None:
+        pass
+
+    def add_task(self, description: str, /, *, total: float | None = None) -> Any:
+        return 0
+
+    def advance(self, token: Any, advance: float) -> None:
+        pass
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        pass
+
+
+class RecordingPlugin:
+    # `test/write` writes `content` to `target` and sets the metadata of
+    # `set`, with the files matching the patterns of `inputs` as inputs,
+    # each run is recorded in `runs`. `test/step` records when the step
+    # `label` starts and ends in `events`, after it slept `sleep` seconds,
+    # failed with `fail` or waited for its token with `block`. `test/loop`
+    # records the event loop it is awaited on in `loops`.
+    def __init__(self) -> None:
+        self.runs: list[str] = []
+        self.events: list[tuple[str, str]] = []
+        self.loops: list[asyncio.AbstractEventLoop] = []
+        self.environ: list[str] | None = ["VALUE"]
+
+    def module(self) -> types.ModuleType:
+        module = types.ModuleType(PLUGIN)
+        module.get_hooks = lambda: {
+            "test/write": self.write,
+            "test/step": self.step,
+            "test/loop": self.loop,
+        }
+        module.get_hook_inputs = lambda: {"test/write": self.inputs}
+        module.get_hook_outputs = lambda: {"test/write": self.outputs}
+        module.get_hook_patterns = lambda: {"test/write": self.patterns}
+        if self.environ is not None:
+            module.get_hook_environ = lambda: {"test/write": self.keys}
+            module.get_hook_metadata = lambda: {"test/write": self.keys}
+        return module
+
+    def write(
+        self, token: Any, args: Mapping[str, Any], ctx: ContextLike, *, ui: Any
+    ) -> ContextLike:
+        self.runs.append(args["target"])
+        if "cpu_time" in args:
+            ui.metric("cpu_time", args["cpu_time"])
+        Path(ctx.working_dir, args["target"]).write_text(
+            args.get("content", "") + ctx.environ.get("VALUE", "")
+        )
+        return Context(
+            ctx.working_dir,
+            LayeredMapping(ctx.metadata, args.get("set", {})),
+            ctx.environ,
+        )
+
+    def step(
+        self, token: Any, args: Mapping[str, Any], ctx: ContextLike, *, ui: Any
+    ) -> ContextLike:
+        self.events.append(("start", args["label"]))
+        if args.get("block", False):
+            token.wait(None)
+            token.raise_if_cancelled()
+        time.sleep(args.get("sleep", 0))
+        if args.get("fail", False):
+            msg = f"{args['label']} failed"
+            raise ValueError(msg)
+        self.events.append(("end", args["label"]))
+        return ctx
+
+    async def loop(
+        self, token: Any, args: Mapping[str, Any], ctx: ContextLike, *, ui: Any
+    ) -> ContextLike:
+        self.loops.append(asyncio.get_running_loop())
+        return ctx
+
+    def inputs(self, args: Mapping[str, Any], ctx: ContextLike) -> Iterable[str]:
+        return [
+            path
+            for pattern in self.patterns(args, ctx)
+            for path in glob.iglob(pattern, recursive=True)
+        ]
+
+    def patterns(self, args: Mapping[str, Any], ctx: ContextLike) -> Iterable[str]:
+        return [
+            str(Path(ctx.working_dir, pattern)) for pattern in args.get("inputs", [])
+        ]
+
+    def outputs(self, args: Mapping[str, Any], ctx: ContextLike) -> Iterable[str]:
+        return [str(Path(ctx.working_dir, args["target"]))]
+
+    def keys(self, args: Mapping[str, Any], ctx: ContextLike) -> Iterable[str]:
+        return self.environ or []
+
+
+@pytest.fixture
+def plugin(monkeypatch: pytest.MonkeyPatch) -> RecordingPlugin:
+    _plugin = RecordingPlugin()
+    monkeypatch.setitem(sys.modules, PLUGIN, _plugin.module())
+    return _plugin
+
+
+@pytest.fixture
+def run_workflow(tmp_path: Path, plugin: RecordingPlugin) -> Callable[..., ContextLike]:
+    def _run(
+        hooks: list[dict[str, Any]],
+        environ: Mapping[str, str] | None = None,
+        **config: Any,
+    ) -> ContextLike:
+        # Registered again, the test may have changed what the plugin declares
+        sys.modules[PLUGIN] = plugin.module()
+        file = tmp_path / "bex.yaml"
+        file.write_text(
+            json.dumps({"config": {"plugins": [PLUGIN], **config}, "hooks": hooks})
+        )
+        match flow(
+            load_config(tmp_path, file, use_cache=False),
+            result.and_then(
+                lambda env: execute(
+                    default_token(), NullUI(), {}, dict(environ or {}), env
+                )
+            ),
+        ):
+            case Ok(ctx):
+                return ctx
+            case Error(err):
+                raise err
+
+    return _run
@@ -0,0 +1,48 @@
+from __future__ import annotations
+
+import cel
+import pytest
+
+from bex_hooks.exec._interface import Context
+from bex_hooks.exec.conditions import ConditionEvaluator
+from bex_hooks.exec.context import ContextDelta, apply_deltas
+
+
+@pytest.fixture
+def root() -> Context:
+    return Context(working_dir=".", metadata={"stage": "dev"}, environ={"A": "1"})
+
+
+def test_parallel_branches_do_not_share_metadata(root: Context):
+    # `a` sets `flag`, `b` runs in a parallel branch which does not see it
+    branch_a = apply_deltas(root, [ContextDelta(metadata={"flag": "yes"})])
+    branch_b = apply_deltas(root, [ContextDelta(metadata={"other": "value"})])
+    program = cel.compile('flag == "yes"')
+    conditions = ConditionEvaluator()
+
+    assert conditions.evaluate(program, branch_a) is True
+    with pytest.raises(RuntimeError, match="flag"):
+        conditions.evaluate(program, branch_b)
+    assert conditions.evaluate(program, branch_a) is True
+
+
+def test_removed_metadata_is_not_visible(root: Context):
+    before = apply_deltas(root, [ContextDelta(metadata={"flag": "yes"})])
+    after = apply_deltas(before, [ContextDelta(removed_metadata=frozenset({"flag"}))])
+    program = cel.compile('flag == "yes"')
+    conditions = ConditionEvaluator()
+
+    assert conditions.evaluate(program, before) is True
+    with pytest.raises(RuntimeError, match="flag"):
+        conditions.evaluate(program, after)
+
+
+def test_parallel_branches_use_their_environment(root: Context):
+    branch_a = apply_deltas(root, [ContextDelta(environ={"A": "2"})])
+    branch_b = apply_deltas(root, [ContextDelta(environ={"B": "1"})])
+    program = cel.compile('env.A == "2"')
+    conditions = ConditionEvaluator()
+
+    assert conditions.evaluate(program, branch_a) is True
+    assert conditions.evaluate(program, branch_b) is False
+    assert conditions.evaluate(program, branch_a) is True
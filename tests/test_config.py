@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+import pickle
+import sys
+from typing import TYPE_CHECKING
+
+import pytest
+from stdlibx.result.types import Ok
+
+from bex_hooks.exec.config import load_config
+from bex_hooks.exec.state import hook_key
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+    from bex_hooks.exec.config import Environment
+
+
+class _Planted:
+    def __reduce__(self):
+        return (pytest.fail, ("the cache file was unpickled",))
+
+
+def _write_config(directory: Path) -> Path:
+    file = directory / "bex.yaml"
+    file.write_text('{"config": {}, "hooks": [{"id": "a/b", "if": "x == 1"}]}')
+    return file
+
+
+def test_cache_is_not_unpickled_for_another_key(tmp_path: Path):
+    file = _write_config(tmp_path)
+    load_config(tmp_path, file)
+    (cache_file,) = (tmp_path / ".bex" / "cache" / "config").iterdir()
+    cache_file.write_bytes(b"0" * 64 + b"\n" + pickle.dumps(_Planted()))
+
+    match load_config(tmp_path, file):
+        case Ok(env):
+            assert env.hooks[0].if_ == "x == 1"
+        case other:
+            pytest.fail(f"unexpected result {other}")
+
+
+def test_cached_conditions_are_compiled_on_use(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    file = _write_config(tmp_path)
+    load_config(tmp_path, file)
+    monkeypatch.delitem(sys.modules, "cel", raising=False)
+
+    match load_config(tmp_path, file):
+        case Ok(env):
+            assert "cel" not in sys.modules
+            assert env.hooks[0].condition is not None
+            assert "cel" in sys.modules
+        case other:
+            pytest.fail(f"unexpected result {other}")
+
+
+def _load_hooks(directory: Path, hooks: str) -> list[Environment.Hook]:
+    file = directory / "bex.yaml"
+    file.write_text(f'{{"config": {{}}, "hooks": {hooks}}}')
+    match load_config(directory, file, use_cache=False):
+        case Ok(env):
+            return env.hooks
+        case other:
+            pytest.fail(f"unexpected result {other}")
+
+
+def test_foreach_substitutes_items(tmp_path: Path):
+    hooks = _load_hooks(
+        tmp_path,
+        '[{"id": "a/b", "name": "x", "foreach": ["one", 2],'
+        ' "path": "$item.txt", "args": ["${item}s", {"key": "$item"}]}]',
+    )
+
+    assert [hook.__pydantic_extra__ for hook in hooks] == [
+        {"path": "one.txt", "args": ["ones", {"key": "one"}]},
+        {"path": "2.txt", "args": ["2s", {"key": "2"}]},
+    ]
+    assert [hook.group for hook in hooks] == [0, 0]
+    assert all(hook.foreach is None and hook.name == "x" for hook in hooks)
+
+
+def test_foreach_substitutes_dict_items(tmp_path: Path):
+    hooks = _load_hooks(
+        tmp_path,
+        '[{"id": "a/b", "foreach": [{"name": "uv", "version": 1}],'
+        ' "package": "${name}==$version", "count": 3}]',
+    )
+
+    assert hooks[0].__pydantic_extra__ == {"package": "uv==1", "count": 3}
+
+
+def test_foreach_keeps_other_variables(tmp_path: Path):
+    hooks = _load_hooks(
+        tmp_path,
+        '[{"id": "a/b", "foreach": ["one"],'
+        ' "text": "$$item $metadata ${environ} $working_dir/$item"}]',
+    )
+
+    assert hooks[0].__pydantic_extra__ == {
+        "text": "$$item $metadata ${environ} $working_dir/one"
+    }
+
+
+def test_expanded_hooks_have_distinct_state_keys(tmp_path: Path):
+    hooks = _load_hooks(
+        tmp_path,
+        '[{"id": "a/b", "name": "x", "foreach": ["one", "two", "three"],'
+        ' "path": "$item"}]',
+    )
+
+    keys = {hook_key(hook.id, hook.name, hook.__pydantic_extra__) for hook in hooks}
+    assert len(keys) == 3
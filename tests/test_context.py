@@ -0,0 +1,33 @@
+from __future__ import annotations
+
+from bex_hooks.exec import _interface
+from bex_hooks.exec.context import _diff_mapping, flatten_context
+from bex_hooks.hooks.python import _interface as _plugin_interface
+
+
+def test_layers_of_plugins_are_diffed_from_their_changes():
+    class _Environ(dict):
+        def __iter__(self):
+            raise AssertionError("the whole environment was compared")
+
+        keys = items = __iter__
+
+    environ = _Environ(PATH="/bin")
+    after = _plugin_interface.LayeredMapping(environ, {"A": "1"}, ["PATH"])
+
+    assert _diff_mapping(environ, after) == ({"A": "1"}, frozenset({"PATH"}))
+
+
+def test_mixed_layers_are_flattened():
+    count = _interface._MAX_LAYERS * 2 + 1
+    mapping: dict[str, int] | _interface.LayeredMapping[int] = {"a": 0}
+    for index in range(count):
+        layers = _interface if index % 2 == 0 else _plugin_interface
+        mapping = layers.LayeredMapping(mapping, {"a": index + 1})
+
+    assert isinstance(mapping, _interface.LayeredMapping)
+    assert mapping.depth <= _interface._MAX_LAYERS
+    assert mapping["a"] == count
+    assert flatten_context(_interface.Context(".", mapping, {})).metadata == {
+        "a": count
+    }
@@ -0,0 +1,170 @@
+from __future__ import annotations
+
+import contextlib
+import json
+import signal
+import sqlite3
+from typing import TYPE_CHECKING, Any
+
+import pytest
+from typer.testing import CliRunner
+
+from bex_hooks.exec._store import CacheIndex
+from bex_hooks.exec.cli import app
+from bex_hooks.exec.errors import BexTimeoutError
+from tests.conftest import PLUGIN
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+    from pathlib import Path
+
+    from bex_hooks.exec._interface import ContextLike
+    from tests.conftest import RecordingPlugin
+
+
+def test_unrelated_variables_do_not_run_hooks(
+    run_workflow: Callable[..., object], plugin: RecordingPlugin
+):
+    hooks = [{"id": "test/write", "target": "out.txt"}]
+
+    run_workflow(hooks, {"VALUE": "1", "SHLVL": "1"})
+    run_workflow(hooks, {"VALUE": "1", "SHLVL": "2"})
+    assert plugin.runs == ["out.txt"]
+
+    run_workflow(hooks, {"VALUE": "2", "SHLVL": "2"})
+    assert plugin.runs == ["out.txt", "out.txt"]
+
+
+def test_undeclared_variables_run_hooks(
+    run_workflow: Callable[..., object], plugin: RecordingPlugin
+):
+    plugin.environ = None
+    hooks = [{"id": "test/write", "target": "out.txt"}]
+
+    run_workflow(hooks, {"VALUE": "1", "SHLVL": "1"})
+    run_workflow(hooks, {"VALUE": "1", "SHLVL": "2"})
+    assert plugin.runs == ["out.txt", "out.txt"]
+
+
+def test_context_is_reused_with_unrelated_variables(
+    run_workflow: Callable[..., ContextLike], plugin: RecordingPlugin, tmp_path: Path
+):
+    hooks = [{"id": "test/write", "target": "out.txt", "set": {"done": "yes"}}]
+    run_workflow(hooks, {"VALUE": "1", "SHLVL": "1"})
+    # Only the saved context can skip the hook
+    for file in (tmp_path / ".bex" / "state").glob("*.json"):
+        if file.name != "context.json":
+            file.unlink()
+
+    ctx = run_workflow(hooks, {"VALUE": "1", "SHLVL": "2"})
+    assert plugin.runs == ["out.txt"]
+    assert ctx.environ["SHLVL"] == "2"
+    assert ctx.metadata["done"] == "yes"
+
+    run_workflow(hooks, {"VALUE": "2", "SHLVL": "2"})
+    assert plugin.runs == ["out.txt", "out.txt"]
+
+
+def test_context_depends_on_conditions(
+    run_workflow: Callable[..., ContextLike], plugin: RecordingPlugin
+):
+    hooks = [{"id": "test/write", "target": "out.txt", "if": 'env.CI == "true"'}]
+    run_workflow(hooks, {"CI": "false"})
+    run_workflow(hooks, {"CI": "true"})
+    assert plugin.runs == ["out.txt"]
+
+
+def test_replayed_hooks_touch_their_cache_entries(
+    run_workflow: Callable[..., ContextLike], plugin: RecordingPlugin, tmp_path: Path
+):
+    hooks = [{"id": "test/write", "target": "out.txt"}]
+    run_workflow(hooks, {"VALUE": "1"})
+    (tmp_path / ".bex" / "state" / "context.json").unlink()
+
+    # As if the output had been made from a stored file long ago
+    index = CacheIndex(tmp_path / ".bex" / "cache")
+    stored = index.root / "files" / "sha256" / "0123"
+    stored.parent.mkdir(parents=True)
+    stored.write_text("content")
+    index.touch(stored, target=tmp_path / "out.txt")
+    with contextlib.closing(sqlite3.connect(index.root / "index.sqlite")) as conn:
+        conn.execute("UPDATE entries SET accessed = 0")
+        conn.commit()
+
+    run_workflow(hooks, {"VALUE": "1"})
+    assert plugin.runs == ["out.txt"]
+    assert [entry.accessed > 0 for entry in index.entries()] == [True]
+
+
+def test_cpu_time_is_reported_by_hooks(
+    run_workflow: Callable[..., ContextLike], plugin: RecordingPlugin, tmp_path: Path
+):
+    run_workflow([{"id": "test/write", "target": "out.txt", "cpu_time": 0.5}])
+
+    (line,) = (tmp_path / ".bex" / "stats" / "hooks.jsonl").read_text().splitlines()
+    record = json.loads(line)
+    assert record["cpu_time"] == 0.5
+    assert "cpu_time" not in record["metrics"]
+
+
+def _outcomes(directory: Path) -> list[str]:
+    lines = (directory / ".bex" / "stats" / "hooks.jsonl").read_text().splitlines()
+    return [json.loads(line)["outcome"] for line in lines]
+
+
+@pytest.mark.parametrize("executor", ["threads", "asyncio"])
+def test_hooks_time_out(
+    run_workflow: Callable[..., ContextLike],
+    plugin: RecordingPlugin,
+    tmp_path: Path,
+    executor: str,
+):
+    hooks = [{"id": "test/step", "label": "a", "block": True, "timeout": 0.1}]
+
+    with pytest.raises(BexTimeoutError):
+        run_workflow(hooks, executor=executor)
+    assert plugin.events == [("start", "a")]
+    assert _outcomes(tmp_path) == ["timeout"]
+
+
+@pytest.mark.parametrize(
+    ("hook", "args"),
+    [
+        ({"timeout": 0.1}, []),
+        ({}, ["--deadline", "0.1"]),
+    ],
+)
+def test_timeouts_exit_with_code_5(
+    plugin: RecordingPlugin,
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    hook: dict[str, Any],
+    args: list[str],
+):
+    # The handlers of the command would outlive the test
+    monkeypatch.setattr(signal, "signal", lambda *_: None)
+    (tmp_path / "bex.yaml").write_text(
+        json.dumps(
+            {
+                "config": {"plugins": [PLUGIN]},
+                "hooks": [{"id": "test/step", "label": "a", "block": True, **hook}],
+            }
+        )
+    )
+
+    outcome = CliRunner().invoke(app, ["-C", str(tmp_path), "run", *args, "--", "true"])
+
+    assert outcome.exit_code == 5, outcome.output
+    assert plugin.events == [("start", "a")]
+    assert _outcomes(tmp_path) == ["timeout"]
+
+
+def test_async_hooks_share_an_event_loop(
+    run_workflow: Callable[..., ContextLike], plugin: RecordingPlugin
+):
+    hooks = [{"id": "test/loop", "needs": []}, {"id": "test/loop", "needs": []}]
+    run_workflow(hooks)
+    run_workflow([{"id": "test/loop", "name": "other"}])
+
+    assert len(plugin.loops) == 3
+    assert len(set(plugin.loops)) == 1
@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+import pytest
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+    from bex_hooks.exec._interface import ContextLike
+    from tests.conftest import RecordingPlugin
+
+_EXECUTORS = pytest.mark.parametrize("executor", ["threads", "asyncio"])
+
+
+def _step(label: str, **args: object) -> dict[str, object]:
+    return {"id": "test/step", "label": label, **args}
+
+
+def _max_running(events: list[tuple[str, str]]) -> int:
+    running = highest = 0
+    for kind, _ in events:
+        running += 1 if kind == "start" else -1
+        highest = max(highest, running)
+    return highest
+
+
+@_EXECUTORS
+def test_needs_run_after_their_dependencies(
+    run_workflow: Callable[..., ContextLike], plugin: RecordingPlugin, executor: str
+):
+    run_workflow(
+        [
+            {**_step("a", sleep=0.05), "name": "a"},
+            {**_step("b", sleep=0.05), "needs": []},
+            {**_step("c"), "needs": ["a"]},
+        ],
+        executor=executor,
+    )
+
+    assert plugin.events.index(("end", "a")) < plugin.events.index(("start", "c"))
+    assert len(plugin.events) == 6
+
+
+@_EXECUTORS
+def test_hooks_without_needs_run_in_order(
+    run_workflow: Callable[..., ContextLike], plugin: RecordingPlugin, executor: str
+):
+    run_workflow([_step("a", sleep=0.02), _step("b"), _step("c")], executor=executor)
+
+    assert plugin.events == [
+        ("start", "a"),
+        ("end", "a"),
+        ("start", "b"),
+        ("end", "b"),
+        ("start", "c"),
+        ("end", "c"),
+    ]
+
+
+@_EXECUTORS
+def test_independent_hooks_run_in_parallel(
+    run_workflow: Callable[..., ContextLike], plugin: RecordingPlugin, executor: str
+):
+    run_workflow(
+        [
+            {**_step("a", sleep=0.1), "needs": []},
+            {**_step("b", sleep=0.1), "needs": []},
+        ],
+        executor=executor,
+    )
+
+    assert _max_running(plugin.events) == 2
+
+
+@_EXECUTORS
+def test_max_parallel_limits_a_group(
+    run_workflow: Callable[..., ContextLike], plugin: RecordingPlugin, executor: str
+):
+    run_workflow(
+        [
+            {
+                **_step("$item", sleep=0.02),
+                "foreach": ["a", "b", "c", "d"],
+                "max_parallel": 2,
+            },
+            {**_step("other", sleep=0.05), "needs": []},
+        ],
+        executor=executor,
+    )
+
+    foreach = [event for event in plugin.events if event[1] != "other"]
+    assert len(foreach) == 8
+    assert _max_running(foreach) == 2
+
+
+@_EXECUTORS
+def test_first_failure_stops_the_workflow(
+    run_workflow: Callable[..., ContextLike], plugin: RecordingPlugin, executor: str
+):
+    with pytest.raises(ValueError, match="a failed"):
+        run_workflow(
+            [
+                {**_step("a", fail=True), "name": "a"},
+                {**_step("after"), "needs": ["a"]},
+                {**_step("blocked", block=True), "needs": []},
+                {**_step("next"), "needs": []},
+            ],
+            executor=executor,
+            max_workers=2,
+        )
+
+    # The running hook is cancelled, the others do not start
+    labels = {label for _, label in plugin.events}
+    assert labels == {"a", "blocked"}
+    assert ("end", "blocked") not in plugin.events
@@ -0,0 +1,80 @@
+from __future__ import annotations
+
+import json
+import threading
+from collections import defaultdict
+from typing import TYPE_CHECKING, Any
+
+import pytest
+from stdlibx.cancel import (
+    CancellationTokenCancelledError,
+    CancellationTokenTimeoutError,
+)
+
+from bex_hooks.exec.server import _Configs, _handle_request, _Requests
+from tests.conftest import PLUGIN, NullUI
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+    from tests.conftest import RecordingPlugin
+
+
+def _handle(request: Any) -> dict[str, Any]:
+    return _handle_request(
+        _Requests(), NullUI(), _Configs(), defaultdict(threading.Lock), request
+    )
+
+
+def test_requests_are_cancelled_on_close():
+    requests = _Requests()
+    with requests.token(None) as token:
+        assert not token.is_cancelled()
+        requests.close()
+        assert isinstance(token.get_error(), CancellationTokenCancelledError)
+
+    with requests.token(None) as token:
+        assert token.is_cancelled()
+
+
+def test_deadline_tokens_are_cancelled_with_the_request():
+    requests = _Requests()
+    with requests.token(60.0) as token:
+        assert not token.is_cancelled()
+    assert isinstance(token.get_error(), CancellationTokenCancelledError)
+
+    with requests.token(0.01) as token:
+        assert isinstance(token.wait(5), CancellationTokenTimeoutError)
+
+
+@pytest.mark.parametrize(
+    "request_",
+    [
+        ["directory"],
+        {"environ": {}},
+        {"directory": "."},
+        {"directory": ".", "environ": {"VALUE": 1}},
+        {"directory": ".", "environ": {}, "deadline": 0},
+    ],
+)
+def test_invalid_requests_fail(request_: Any):
+    document = _handle(request_)
+    assert document["status"] == "failure"
+    assert "validation error for ServerRequest" in document["error"]
+
+
+def test_requests_execute_the_workflow(plugin: RecordingPlugin, tmp_path: Path):
+    (tmp_path / "bex.yaml").write_text(
+        json.dumps(
+            {
+                "config": {"plugins": [PLUGIN]},
+                "hooks": [{"id": "test/write", "target": "out.txt"}],
+            }
+        )
+    )
+
+    document = _handle({"directory": str(tmp_path), "environ": {"VALUE": "1"}})
+
+    assert document["status"] == "success", document
+    assert document["file"] == str(tmp_path / "bex.yaml")
+    assert (tmp_path / "out.txt").read_text() == "1"
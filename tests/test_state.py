@@ -0,0 +1,31 @@
+from __future__ import annotations
+
+from bex_hooks.exec._interface import Context
+from bex_hooks.exec.state import ContextKeys, hook_fingerprint, select_keys
+
+
+def test_select_keys():
+    environ = {"PATH": "/bin", "UV_INDEX": "a", "UV_CACHE": "b", "SHLVL": "1"}
+
+    assert select_keys(environ, None) == environ
+    assert select_keys(environ, frozenset()) == {}
+    assert select_keys(environ, frozenset({"PATH", "HOME"})) == {"PATH": "/bin"}
+    assert select_keys(environ, frozenset({"PATH", "UV_*"})) == {
+        "PATH": "/bin",
+        "UV_INDEX": "a",
+        "UV_CACHE": "b",
+    }
+
+
+def test_fingerprint_ignores_undeclared_variables():
+    keys = ContextKeys(metadata=frozenset(), environ=frozenset({"PATH"}))
+    before = Context(".", {"platform": "linux"}, {"PATH": "/bin", "SHLVL": "1"})
+    after = Context(".", {"platform": "linux", "x": 1}, {"PATH": "/bin", "SHLVL": "2"})
+    changed = Context(".", {"platform": "linux"}, {"PATH": "/usr/bin"})
+
+    fingerprint = hook_fingerprint("test/write", {}, before, {}, keys)
+    assert hook_fingerprint("test/write", {}, after, {}, keys) == fingerprint
+    assert hook_fingerprint("test/write", {}, changed, {}, keys) != fingerprint
+    assert hook_fingerprint("test/write", {}, after, {}, ContextKeys()) != (
+        hook_fingerprint("test/write", {}, before, {}, ContextKeys())
+    )
@@ -0,0 +1,65 @@
+from __future__ import annotations
+
+import contextlib
+import sqlite3
+import stat
+from typing import TYPE_CHECKING
+
+from bex_hooks.exec import _store
+from bex_hooks.exec._store import CacheIndex, ContentStore, materialize
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+    import pytest
+
+
+def _stored(tmp_path: Path) -> Path:
+    source = tmp_path / "download"
+    source.write_text("content")
+    return ContentStore(tmp_path / "files").add("sha256", "0123", source)
+
+
+def test_targets_are_writable_copies(tmp_path: Path):
+    stored = _stored(tmp_path)
+    target = tmp_path / "workspace" / "file"
+
+    assert materialize(stored, target) in ("reflink", "copy")
+    target.write_text("patched")
+    assert stored.read_text() == "content"
+    assert stat.S_IMODE(stored.stat().st_mode) & stat.S_IWUSR == 0
+
+
+def test_targets_are_hard_linked_on_request(tmp_path: Path):
+    stored = _stored(tmp_path)
+    target = tmp_path / "workspace" / "file"
+
+    assert materialize(stored, target, hardlink=True) in ("reflink", "hardlink")
+    assert target.read_text() == "content"
+
+
+def test_index_schema_is_created_once(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    created: list[sqlite3.Connection] = []
+    create_index = _store._create_index
+
+    def _create_index(conn: sqlite3.Connection) -> None:
+        created.append(conn)
+        create_index(conn)
+
+    monkeypatch.setattr(_store, "_create_index", _create_index)
+    index = CacheIndex(tmp_path / "cache")
+    stored = index.root / "files" / "0123"
+    stored.parent.mkdir(parents=True)
+    stored.write_text("content")
+
+    index.touch(stored)
+    CacheIndex(tmp_path / "cache").touch(stored)
+    assert len(created) == 1
+    with contextlib.closing(sqlite3.connect(index.root / "index.sqlite")) as conn:
+        assert conn.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+
+    # Created again once the cache was removed
+    (index.root / "index.sqlite").unlink()
+    index.touch(stored)
+    assert len(created) == 2
+    assert [entry.path for entry in index.entries()] == ["files/0123"]
@@ -0,0 +1,44 @@
+from __future__ import annotations
+
+import asyncio
+import json
+from typing import TYPE_CHECKING
+
+from bex_hooks.exec.trace import Tracer
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+def test_concurrent_tasks_have_their_own_tracks(tmp_path: Path):
+    tracer = Tracer()
+
+    async def _hook(name: str) -> None:
+        with tracer.span(name):
+            await asyncio.sleep(0.01)
+
+    async def _run() -> None:
+        with tracer.span("workflow"):
+            await asyncio.gather(_hook("a"), _hook("b"))
+
+    asyncio.run(_run())
+    tracer.write(tmp_path / "trace.json")
+
+    events = json.loads((tmp_path / "trace.json").read_text())["traceEvents"]
+    tids = {event["name"]: event["tid"] for event in events if event["ph"] == "X"}
+    assert len(set(tids.values())) == 3
+    names = [event["args"]["name"] for event in events if event["ph"] == "M"]
+    assert len(names) == 3
+    assert all(name.startswith("MainThread Task-") for name in names)
+
+
+def test_threads_have_their_own_tracks(tmp_path: Path):
+    tracer = Tracer()
+    with tracer.span("a"):
+        pass
+    tracer.write(tmp_path / "trace.json")
+
+    events = json.loads((tmp_path / "trace.json").read_text())["traceEvents"]
+    assert [event["args"]["name"] for event in events if event["ph"] == "M"] == [
+        "MainThread"
+    ]
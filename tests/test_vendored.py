@@ -0,0 +1,19 @@
+from __future__ import annotations
+
+from pathlib import Path
+
+import pytest
+
+_ROOT = Path(__file__).parents[1]
+_SOURCE = _ROOT / "src" / "bex_hooks" / "exec"
+_COPIES = (
+    _ROOT / "hooks" / "bex-hooks-files" / "src" / "bex_hooks" / "hooks" / "files",
+    _ROOT / "hooks" / "bex-hooks-python" / "src" / "bex_hooks" / "hooks" / "python",
+)
+
+
+@pytest.mark.parametrize("name", ["_interface.py", "_store.py"])
+@pytest.mark.parametrize("directory", _COPIES, ids=lambda path: path.name)
+def test_copies_are_identical(name: str, directory: Path):
+    # Plugins ship their own copy, changes are made in bex_hooks.exec
+    assert (directory / name).read_bytes() == (_SOURCE / name).read_bytes()
@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import json
+from typing import TYPE_CHECKING
+
+import pytest
+from stdlibx.result.types import Ok
+
+from bex_hooks.exec.config import load_config
+from bex_hooks.exec.context import initial_context
+from bex_hooks.exec.watch import _snapshot, watched_paths
+from tests.conftest import PLUGIN, NullUI
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+    from bex_hooks.exec.config import Environment
+    from tests.conftest import RecordingPlugin
+
+
+def _environment(directory: Path) -> Environment:
+    file = directory / "bex.yaml"
+    file.write_text(
+        json.dumps(
+            {
+                "config": {"plugins": [PLUGIN]},
+                "hooks": [
+                    {
+                        "id": "test/write",
+                        "target": "out.txt",
+                        "inputs": ["src/**/*.in"],
+                    }
+                ],
+            }
+        )
+    )
+    match load_config(directory, file, use_cache=False):
+        case Ok(env):
+            return env
+        case other:
+            pytest.fail(f"unexpected result {other}")
+
+
+def test_hooks_that_never_ran_are_watched(plugin: RecordingPlugin, tmp_path: Path):
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src" / "a.in").write_text("a")
+    env = _environment(tmp_path)
+
+    paths, patterns = watched_paths(
+        NullUI(), env, initial_context(str(tmp_path), {}, {})
+    )
+
+    assert str(tmp_path / "src" / "a.in") in paths
+    assert str(tmp_path / "out.txt") in paths
+    assert patterns == {str(tmp_path / "src" / "**" / "*.in")}
+    assert plugin.runs == []
+
+
+def test_new_files_matching_the_patterns_are_seen(tmp_path: Path):
+    patterns = [str(tmp_path / "src" / "**" / "*.in")]
+    (tmp_path / "src" / "deep").mkdir(parents=True)
+    snapshot = _snapshot([], patterns)
+
+    (tmp_path / "src" / "deep" / ".a.in.swp").write_text("")
+    (tmp_path / "src" / "deep" / "a.in~").write_text("")
+    assert _snapshot([], patterns) == snapshot
+
+    (tmp_path / "src" / "deep" / "a.in").write_text("a")
+    assert _snapshot([], patterns) != snapshot